@@ -0,0 +1,472 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import resource
+import subprocess
+from queue import Queue, Empty
+from threading import Thread
+from src import tracker, async_tracker, node, async_node, blockchain, \
+    util
+
+# runs a tracker and a number of nodes on loopback, each in a process of
+# its own, drives transactions through them and reports how it went as
+# JSON:
+#
+#   python3 -m bench.cluster --nodes 4 --rate 20 --duration 30
+#
+# every process is this module run again with --role. such an agent
+# takes commands one per line on stdin and answers with one JSON object
+# per line on stdout; whatever the tracker or node logs is thrown away.
+
+# how often an agent looks at its chain for new blocks (seconds)
+POLL_INTERVAL = 0.002
+
+# how long to wait for an agent to answer (seconds)
+REPLY_TIMEOUT = 60
+
+# how long the nodes have to make the links the tracker gave them,
+# once they've all joined, before the missing ones count (seconds)
+LINK_TIMEOUT = 5
+
+
+def max_rss_kb(usage):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return usage.ru_maxrss // 1024
+    return usage.ru_maxrss
+
+
+def usage_report():
+    """ CPU time and peak memory of this process and its children """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"cpu_seconds": own.ru_utime + own.ru_stime,
+            "children_cpu_seconds": children.ru_utime + children.ru_stime,
+            "max_rss_kb": max_rss_kb(own),
+            "children_max_rss_kb": max_rss_kb(children)}
+
+
+# the agent's side of the channel with the harness. stdout is pointed
+# elsewhere, so that the logging can't get in the way, and so is stdin:
+# a process started by the miner closes sys.stdin, which would hang if
+# it was forked while we were blocked reading from it.
+class Channel:
+    def __init__(self):
+        self.out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        self.commands = os.fdopen(os.dup(sys.stdin.fileno()))
+        sys.stdout = open(os.devnull, "w")
+        sys.stdin = open(os.devnull)
+
+    def __call__(self, event, **fields):
+        fields["event"] = event
+        self.out.write(json.dumps(fields) + "\n")
+        self.out.flush()
+
+    def __iter__(self):
+        # the commands from the harness, until it goes away
+        for line in self.commands:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def loop(f):
+    def run():
+        while f():
+            continue
+    Thread(target=run, daemon=True).start()
+
+
+def run_tracker(args):
+    harness = Channel()
+
+    if args.async_tracker:
+        t = async_tracker.AsyncTracker(args.port, degree=args.degree)
+    else:
+        t = tracker.Tracker(args.port, degree=args.degree)
+    t.start()
+    if not args.async_tracker:
+        loop(t.accept)
+    harness("ready")
+
+    for command in harness:
+        if command == "status":
+            harness("status", height=len(t.chain.blocks),
+                    tip=t.chain.hash_at(len(t.chain.blocks) - 1),
+                    links=dict((ident, sorted(neighbours)) for
+                               ident, neighbours in list(t.links.items())))
+        elif command == "quit":
+            break
+
+    t.stop()
+    harness("exit", **usage_report())
+
+
+# the first time a node had each block, by hash, from the height it
+# joined at onwards
+class BlockWatcher:
+    def __init__(self, chain):
+        self.chain = chain
+        self.start = len(chain.blocks)
+        self.height = self.start
+        self.first_seen = {}
+        Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while True:
+            height = len(self.chain.blocks)
+            now = time.time()
+            for h in range(min(self.height, height), height):
+                self.first_seen.setdefault(self.chain.hash_at(h), now)
+            self.height = height
+            time.sleep(POLL_INTERVAL)
+
+
+class Workload:
+    def __init__(self, n, rate, duration, amount):
+        self.sent = 0
+        self.running = True
+        Thread(target=self.__run, args=(n, rate, duration, amount),
+               daemon=True).start()
+
+    def __run(self, n, rate, duration, amount):
+        # sends are paced against the clock, so a slow send
+        # doesn't lower the rate that was asked for
+        start = time.monotonic()
+        for k in range(int(rate * duration)):
+            delay = start + k / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            peers = list(n.peers)
+            if peers:
+                n.send_transaction(random.choice(peers), amount)
+                self.sent += 1
+        self.running = False
+
+
+def run_node(args):
+    harness = Channel()
+
+    if args.async_nodes:
+        n = async_node.AsyncNode("localhost", args.tracker_port, args.port,
+                                 miners=args.miners)
+    else:
+        n = node.Node("localhost", args.tracker_port, args.port,
+                      miners=args.miners, gossip=args.gossip)
+
+    start = time.monotonic()
+    if not n.connect():
+        harness("failed")
+        return
+    join_seconds = time.monotonic() - start
+
+    if not args.async_nodes:
+        loop(n.accept)
+        loop(n.recv_tracker)
+
+    watcher = BlockWatcher(n.chain)
+    workload = None
+    harness("joined", ident=n.ident, join_seconds=join_seconds,
+            height=watcher.start)
+
+    for command in harness:
+        if command == "start":
+            workload = Workload(n, args.rate, args.duration, args.amount)
+        elif command == "status":
+            height = len(n.chain.blocks)
+            harness("status", height=height,
+                    tip=n.chain.hash_at(height - 1),
+                    unconfirmed=len(n.chain.unconfirmed),
+                    sending=bool(workload and workload.running),
+                    sent=workload.sent if workload else 0,
+                    peers=sorted(n.peer_writers if args.async_nodes
+                                 else n.peer_sockets))
+        elif command == "report":
+            harness("report", blocks=dict(watcher.first_seen),
+                    confirmed=confirmed(n.chain, watcher.start),
+                    sent=workload.sent if workload else 0)
+        elif command == "quit":
+            break
+
+    n.disconnect()
+    # the miner's processes only count once they've been waited for
+    if n.miner:
+        n.miner.thread.join(REPLY_TIMEOUT)
+    harness("exit", **usage_report())
+
+
+def confirmed(chain, start):
+    """ distinct transactions in the blocks from height `start` onwards """
+    return len(set(blockchain.transaction_id(t)
+                   for h in range(start, len(chain.blocks))
+                   for t in chain.blocks[h].transactions))
+
+
+# the harness's side of an agent
+class Agent:
+    def __init__(self, name, argv):
+        self.name = name
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "bench.cluster"] + argv,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            text=True, start_new_session=True)
+        self.replies = Queue()
+        Thread(target=self.__read, daemon=True).start()
+
+    def __read(self):
+        for line in self.process.stdout:
+            self.replies.put(json.loads(line))
+        self.replies.put(None)
+
+    def send(self, command):
+        self.process.stdin.write(command + "\n")
+        self.process.stdin.flush()
+
+    def expect(self, *events, timeout=REPLY_TIMEOUT):
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except Empty:
+            reply = None
+        if reply is None or reply["event"] not in events:
+            raise RuntimeError("%s: expected %s, got %s" %
+                               (self.name, " or ".join(events), reply))
+        return reply
+
+    def ask(self, command, event):
+        self.send(command)
+        return self.expect(event)
+
+    def kill(self):
+        # the miner's processes go too
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            self.send("quit")
+            return self.expect("exit")
+        finally:
+            self.process.wait(REPLY_TIMEOUT)
+
+
+def percentiles(values):
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    def rank(p):
+        # nearest rank
+        return values[max(0, -(-len(values) * p // 100) - 1)]
+
+    return {"count": len(values),
+            "p50": rank(50),
+            "p90": rank(90),
+            "p99": rank(99),
+            "max": values[-1]}
+
+
+def propagation_ms(reports):
+    """ how long after the first node had a block each other one did """
+    first_seen = {}
+    for report in reports:
+        for block_hash, t in report["blocks"].items():
+            first_seen.setdefault(block_hash, []).append(t)
+
+    delays = []
+    for times in first_seen.values():
+        origin = min(times)
+        delays += [(t - origin) * 1000 for t in times if t != origin]
+    return percentiles(delays)
+
+
+def wait_for_convergence(agents, deadline):
+    """ the common status of every agent, once they agree, if they do """
+    while True:
+        statuses = [a.ask("status", "status") for a in agents]
+        tips = set(s["tip"] for s in statuses)
+        settled = all(not s.get("sending") and not s.get("unconfirmed")
+                      for s in statuses)
+        if len(tips) == 1 and settled:
+            return statuses[0]
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(0.2)
+
+
+def missing_links(t, nodes, joins, deadline):
+    """ the links the tracker made that each node doesn't have, if any """
+    while True:
+        links = t.ask("status", "status")["links"]
+        missing = {}
+        for a, j in zip(nodes, joins):
+            peers = a.ask("status", "status")["peers"]
+            lost = sorted(set(links.get(str(j["ident"]), ())) - set(peers))
+            if lost:
+                missing[str(j["ident"])] = lost
+        if not missing or time.monotonic() > deadline:
+            return missing
+        time.sleep(0.2)
+
+
+def run_cluster(args):
+    config = dict((k, v) for k, v in vars(args).items()
+                  if k not in ("role", "output", "tracker_port"))
+    for port in range(args.port, args.port + args.nodes + 1):
+        if util.is_port_in_use(port):
+            raise RuntimeError("port %d is already in use" % port)
+
+    common = ["--miners", str(args.miners),
+              "--rate", str(args.rate),
+              "--duration", str(args.duration),
+              "--amount", str(args.amount)]
+    if args.degree:
+        common += ["--degree", str(args.degree)]
+    for flag in ("async_tracker", "async_nodes", "gossip"):
+        if getattr(args, flag):
+            common.append("--" + flag.replace("_", "-"))
+
+    agents = []
+    try:
+        t = Agent("tracker", ["--role", "tracker", "--port",
+                              str(args.port)] + common)
+        agents.append(t)
+        t.expect("ready")
+
+        nodes = []
+        joins = []
+        failed = []
+        for i in range(args.nodes):
+            if i and args.join_gap:
+                time.sleep(args.join_gap)
+            a = Agent("node %d" % (i + 1),
+                      ["--role", "node", "--port", str(args.port + 1 + i),
+                       "--tracker-port", str(args.port)] + common)
+            agents.append(a)
+            reply = a.expect("joined", "failed")
+            if reply["event"] == "failed":
+                # the node gives up and exits, and the rest carry on
+                failed.append(a.name)
+                agents.remove(a)
+                a.process.wait(REPLY_TIMEOUT)
+                continue
+            nodes.append(a)
+            joins.append(reply)
+        if not nodes:
+            raise RuntimeError("none of the nodes joined")
+
+        # joins that raced each other leave nodes without some of the
+        # links the tracker made for them
+        missing = missing_links(t, nodes, joins,
+                                time.monotonic() + LINK_TIMEOUT)
+
+        # drive the workload, then wait for the chains to agree
+        start_height = t.ask("status", "status")["height"]
+        start = time.monotonic()
+        for a in nodes:
+            a.send("start")
+        time.sleep(args.duration)
+        status = wait_for_convergence(agents,
+                                      time.monotonic() + args.settle)
+        elapsed = time.monotonic() - start
+
+        # the nodes go first, so none of them sees the tracker go away
+        reports = [a.ask("report", "report") for a in nodes]
+        usage = [a.close() for a in nodes] + [t.close()]
+        agents = []
+    finally:
+        for a in agents:
+            a.kill()
+
+    sent = sum(r["sent"] for r in reports)
+    confirmed = max(r["confirmed"] for r in reports)
+    join_seconds = [j["join_seconds"] for j in joins]
+    for u in usage:
+        del u["event"]
+
+    return {"config": config,
+            "join_seconds": {"mean": sum(join_seconds) / len(join_seconds),
+                             "max": max(join_seconds),
+                             "each": join_seconds},
+            "joins": {"joined": len(joins),
+                      "failed": failed,
+                      "missing_links": missing},
+            "transactions": {"sent": sent,
+                             "confirmed": confirmed,
+                             "sent_per_second": sent / args.duration,
+                             "confirmed_per_second": confirmed / elapsed},
+            "propagation_ms": propagation_ms(reports),
+            "convergence": {"converged": status is not None,
+                            "seconds": elapsed - args.duration,
+                            "blocks": (status["height"] - start_height
+                                       if status else None)},
+            "processes": {"tracker": usage[-1],
+                          "nodes": dict((str(j["ident"]), u) for j, u
+                                        in zip(joins, usage))}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark a tracker and nodes running on loopback")
+    parser.add_argument("--nodes", type=int, default=3,
+                        help="number of nodes to start")
+    parser.add_argument("--port", type=int, default=24000,
+                        help="tracker port; nodes listen on the ones after")
+    parser.add_argument("--rate", type=float, default=5,
+                        help="transactions each node sends per second")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to send transactions for")
+    parser.add_argument("--amount", type=int, default=0,
+                        help="amount of each transaction (the default of "
+                             "0 means no account ever runs dry)")
+    parser.add_argument("--settle", type=float, default=60,
+                        help="seconds to wait for the chains to agree "
+                             "once sending stops")
+    parser.add_argument("--miners", type=int, default=1,
+                        help="mining processes per node")
+    parser.add_argument("--degree", type=int, default=None,
+                        help="peers the tracker gives each node")
+    parser.add_argument("--gossip", action="store_true",
+                        help="have the nodes gossip")
+    parser.add_argument("--async-tracker", action="store_true",
+                        help="run the asynchronous tracker")
+    parser.add_argument("--async-nodes", action="store_true",
+                        help="run asynchronous nodes")
+    parser.add_argument("--join-gap", type=float, default=0,
+                        help="seconds to wait between starting one node "
+                             "and the next")
+    parser.add_argument("--output", default=None,
+                        help="file to write the results to "
+                             "(default: standard output)")
+    parser.add_argument("--role", choices=("cluster", "tracker", "node"),
+                        default="cluster", help=argparse.SUPPRESS)
+    parser.add_argument("--tracker-port", type=int, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.gossip and args.async_nodes:
+        parser.error("--gossip is not supported with --async-nodes")
+
+    if args.role != "cluster":
+        (run_tracker if args.role == "tracker" else run_node)(args)
+        # don't wait on whatever threads the tracker or node left behind
+        os._exit(0)
+    else:
+        results = json.dumps(run_cluster(args), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(results + "\n")
+        else:
+            print(results)
+
+
+if __name__ == "__main__":
+    main()
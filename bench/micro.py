@@ -0,0 +1,424 @@
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tracemalloc
+from hashlib import sha256
+from threading import Thread
+from src import blockchain, message, pkc
+
+# times the inner loops one at a time and compares them with a stored
+# baseline:
+#
+#   python3 -m bench.micro                  compare with the baseline
+#   python3 -m bench.micro --update         make this run the baseline
+#
+# every benchmark is run for a number of sizes (payload bytes,
+# transactions per message or block, blocks in the chain), and the
+# result is the best time per call out of several repeats. the run fails
+# if any benchmark takes more than `tolerance` longer than its baseline.
+#
+# a machine can be slower as a whole from one run to the next (another
+# busy tenant, a lower clock), so every run also times a fixed reference
+# workload that doesn't touch our code, and times are compared relative
+# to it unless --absolute is given.
+
+# bumped whenever the benchmarks change in a way that makes older
+# baselines meaningless; a baseline of another version isn't compared
+BASELINE_VERSION = 1
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+
+DEFAULT_PAYLOADS = [64, 1024, 65536]
+DEFAULT_TRANSACTIONS = [1, 100, 1000]
+DEFAULT_CHAINS = [10, 100, 1000]
+
+# blocks and transactions per block held in memory to see what a
+# million transactions take up, and the most that may be (MB). held as a
+# dict apiece, they took about 285 MB; column-wise, about 36 MB.
+MEMORY_BLOCKS = 1000
+MEMORY_TRANSACTIONS = 1000
+DEFAULT_MEMORY_LIMIT = 64
+
+# the benchmark that the others are measured against
+REFERENCE = "reference"
+
+# transactions in each block of the chains that transactions are
+# checked against
+CHAIN_BLOCK_SIZE = 10
+
+# how long each repeat of a benchmark runs for at least (seconds), how
+# many repeats there are, and how much slower than the baseline a
+# benchmark may be before the run fails
+DEFAULT_MIN_TIME = 0.1
+DEFAULT_REPEAT = 15
+DEFAULT_TOLERANCE = 0.25
+
+
+def transactions(count):
+    return [blockchain.new_transaction(i % 100, (i + 1) % 100, i)
+            for i in range(count)]
+
+
+def timed(f, number):
+    """ the time of a call to f, in seconds, averaged over `number` """
+    # as timeit does, so that a collection doesn't land in one repeat
+    # and not another
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            f()
+        return (time.perf_counter() - start) / number
+    finally:
+        gc.enable()
+
+
+def calibrate(f, min_time):
+    """ how many calls to f take long enough to time reliably """
+    number = 1
+    while True:
+        elapsed = timed(f, number) * number
+        if elapsed >= min_time:
+            return number
+        number *= 2 if elapsed == 0 else \
+            max(2, min(10, int(1.2 * min_time / elapsed)))
+
+
+def bench_reference():
+    data = bytes(4096)
+
+    def run():
+        sum(i * i for i in range(1000))
+        sha256(data).digest()
+
+    return run
+
+
+def bench_block_hash(count):
+    block = blockchain.Block(transactions(count), "0" * 64, None)
+    return block.hash
+
+
+def bench_merkle_root(count):
+    block = blockchain.Block(transactions(count), "0" * 64, None)
+    return lambda: blockchain.merkle_root(block.transactions)
+
+
+def bench_framing(count):
+    # messages are sent over a socket pair by one thread and received by
+    # another, so that a frame bigger than the socket's buffer can't
+    # block. starting the thread is timed too, so it is done per batch.
+    msg = message.PeerTransactions(transactions(count))
+    sender, receiver = socket.socketpair()
+    batch = 64
+
+    def send():
+        for _ in range(batch):
+            msg.send(sender)
+
+    def run():
+        t = Thread(target=send)
+        t.start()
+        for _ in range(batch):
+            message.recv(receiver)
+        t.join()
+
+    def close():
+        sender.close()
+        receiver.close()
+
+    return run, batch, close
+
+
+def bench_of_string(count):
+    s = message.PeerTransactions(transactions(count)).to_string()
+    return lambda: message.of_string(s)
+
+
+def bench_encrypt(size):
+    ours = pkc.KeyPair()
+    theirs = pkc.KeyPair().public_key()
+    data = os.urandom(size)
+    return lambda: ours.encrypt(data, theirs)
+
+
+def bench_sign(size):
+    ours = pkc.KeyPair()
+    data = os.urandom(size)
+    return lambda: ours.sign(data)
+
+
+def bench_verify(size):
+    ours = pkc.KeyPair()
+    signed = ours.sign(os.urandom(size))
+    verify_key = ours.verify_key()
+    return lambda: pkc.verify(signed, verify_key)
+
+
+def bench_check_transaction(length):
+    blocks, unconfirmed = blockchain.Blockchain.get_genesis_block_list(0)
+    chain = blockchain.Blockchain(blocks, unconfirmed)
+    while len(chain.blocks) < length:
+        chain.add_block(blockchain.Block(transactions(CHAIN_BLOCK_SIZE),
+                                         chain.hash_at(-1), None))
+
+    # with some of the sender's money already promised
+    chain.hold(transactions(CHAIN_BLOCK_SIZE))
+    t = blockchain.new_transaction(1, 2, 1)
+    return lambda: chain.check_transaction_validity(t)
+
+
+def block_memory(blocks, count):
+    """ MB taken up by a million transactions held in blocks """
+    # what is allocated is counted rather than the resident size, since
+    # it doesn't vary from run to run. the dicts that the blocks are made
+    # from are gone by the end, as they would be once received.
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        held = [blockchain.Block(transactions(count), "0" * 64, None)
+                for _ in range(blocks)]
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    del held
+    return allocated / (blocks * count) * 1e6 / (1 << 20)
+
+
+def memory(args):
+    """ {name: MB per million transactions} """
+    name = "block_memory[blocks=%d,transactions=%d]" % \
+        (args.memory_blocks, MEMORY_TRANSACTIONS)
+    if args.filter is not None and args.filter not in name:
+        return {}
+
+    mb = block_memory(args.memory_blocks, MEMORY_TRANSACTIONS)
+    print("%-44s %.1f MB per million transactions" % (name, mb),
+          file=sys.stderr)
+    return {name: mb}
+
+
+def benchmarks(args):
+    """ (name, setup) for every benchmark, in the order they run """
+    cases = []
+    for count in args.transactions:
+        cases += [("block_hash[transactions=%d]" % count,
+                   lambda c=count: bench_block_hash(c)),
+                  ("merkle_root[transactions=%d]" % count,
+                   lambda c=count: bench_merkle_root(c)),
+                  ("framing[transactions=%d]" % count,
+                   lambda c=count: bench_framing(c)),
+                  ("of_string[transactions=%d]" % count,
+                   lambda c=count: bench_of_string(c))]
+    for size in args.payloads:
+        cases += [("encrypt[bytes=%d]" % size,
+                   lambda s=size: bench_encrypt(s)),
+                  ("sign[bytes=%d]" % size,
+                   lambda s=size: bench_sign(s)),
+                  ("verify[bytes=%d]" % size,
+                   lambda s=size: bench_verify(s))]
+    for length in args.chains:
+        cases.append(("check_transaction[blocks=%d]" % length,
+                      lambda n=length: bench_check_transaction(n)))
+
+    return [(REFERENCE, bench_reference)] + \
+        [(name, setup) for name, setup in cases
+         if args.filter is None or args.filter in name]
+
+
+def run(args):
+    """ {name: seconds per operation} """
+    cases = []
+    try:
+        for name, setup in benchmarks(args):
+            # a setup returns the call to time, or the call along with
+            # how many operations it does and how to clean up afterwards
+            case = setup()
+            f, operations, close = case if isinstance(case, tuple) else \
+                (case, 1, None)
+            cases.append((name, f, operations, close,
+                          calibrate(f, args.min_time)))
+
+        # the repeats of a benchmark are spread out over the run, so that
+        # a moment when the machine is busy can't spoil all of them. each
+        # benchmark keeps its best time.
+        results = {}
+        for _ in range(args.repeat):
+            for name, f, operations, _, number in cases:
+                t = timed(f, number) / operations
+                results[name] = min(results.get(name, t), t)
+    finally:
+        for _, _, _, close, _ in cases:
+            if close:
+                close()
+
+    for name, t in results.items():
+        print("%-44s %s" % (name, human(t)), file=sys.stderr)
+    return results
+
+
+def human(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return "%.2f %s" % (seconds * scale, unit)
+    return "%.0f ns" % (seconds * 1e9)
+
+
+def machine():
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "processor": platform.machine()}
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if baseline.get("version") != BASELINE_VERSION:
+        print("%s is version %s, not %d, so it isn't compared with" %
+              (path, baseline.get("version"), BASELINE_VERSION),
+              file=sys.stderr)
+        return None
+    return baseline
+
+
+def save(path, results, megabytes):
+    with open(path, "w") as f:
+        json.dump({"version": BASELINE_VERSION,
+                   "machine": machine(),
+                   "results": results,
+                   "memory": megabytes}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(baseline, results, tolerance, absolute=False):
+    """ the names of the benchmarks that regressed """
+    if baseline["machine"] != machine():
+        print("the baseline was taken on another machine: %s" %
+              baseline["machine"], file=sys.stderr)
+
+    # how much slower the machine is than when the baseline was taken
+    slowdown = 1
+    if not absolute and REFERENCE in baseline["results"]:
+        slowdown = results[REFERENCE] / baseline["results"][REFERENCE]
+        print("the reference took %.2f times as long as in the baseline, "
+              "which the changes allow for" % slowdown, file=sys.stderr)
+
+    regressed = []
+    print("%-44s %10s %10s %8s" % ("benchmark", "baseline", "now", "change"))
+    for name, now in results.items():
+        before = baseline["results"].get(name, None)
+        if before is None:
+            print("%-44s %10s %10s %8s" % (name, "-", human(now), "new"))
+            continue
+        if name == REFERENCE:
+            continue
+
+        change = now / (before * slowdown) - 1
+        flag = ""
+        if change > tolerance:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print("%-44s %10s %10s %+7.1f%%%s" % (name, human(before), human(now),
+                                             100 * change, flag))
+    return regressed
+
+
+def compare_memory(baseline, megabytes, tolerance, limit):
+    """ the names of the memory measurements that regressed """
+    regressed = []
+    for name, now in megabytes.items():
+        before = baseline.get("memory", {}).get(name, None)
+        flag = ""
+        if now > limit or (before is not None and
+                           now > before * (1 + tolerance)):
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print("%-44s %8s MB %7.1f MB %8s%s" %
+              (name, "-" if before is None else "%.1f" % before, now,
+               "limit %d" % limit, flag))
+    return regressed
+
+
+def sizes(s):
+    return [int(n) for n in s.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time the hot paths and compare with a baseline")
+    parser.add_argument("--payloads", type=sizes, default=DEFAULT_PAYLOADS,
+                        help="comma-separated payload sizes in bytes for "
+                             "encrypt, sign and verify")
+    parser.add_argument("--transactions", type=sizes,
+                        default=DEFAULT_TRANSACTIONS,
+                        help="comma-separated numbers of transactions per "
+                             "block or message")
+    parser.add_argument("--chains", type=sizes, default=DEFAULT_CHAINS,
+                        help="comma-separated chain lengths in blocks for "
+                             "check_transaction")
+    parser.add_argument("--filter", default=None,
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME,
+                        help="seconds each repeat runs for at least")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="repeats of each benchmark, the best is kept")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fraction by which a benchmark may be slower "
+                             "than its baseline (default: %(default)s)")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="baseline file (default: bench/baseline.json)")
+    parser.add_argument("--update", action="store_true",
+                        help="write this run's results to the baseline "
+                             "instead of comparing with it")
+    parser.add_argument("--output", default=None,
+                        help="also write this run's results to this file")
+    parser.add_argument("--memory-blocks", type=int, default=MEMORY_BLOCKS,
+                        help="blocks of %d transactions to measure the "
+                             "memory of" % MEMORY_TRANSACTIONS)
+    parser.add_argument("--memory-limit", type=float,
+                        default=DEFAULT_MEMORY_LIMIT,
+                        help="most MB a million transactions in blocks may "
+                             "take up (default: %(default)s)")
+    parser.add_argument("--absolute", action="store_true",
+                        help="compare times as they are, without allowing "
+                             "for the speed of the machine")
+    args = parser.parse_args()
+
+    results = run(args)
+    megabytes = memory(args)
+    if args.output:
+        save(args.output, results, megabytes)
+
+    baseline = None if args.update else load_baseline(args.baseline)
+    if baseline is None:
+        # the first run, or a deliberate new baseline. the memory limit
+        # holds all the same.
+        save(args.baseline, results, megabytes)
+        print("wrote the baseline to %s" % args.baseline, file=sys.stderr)
+        baseline = {"memory": {}}
+        regressed = []
+    else:
+        regressed = compare(baseline, results, args.tolerance,
+                            args.absolute)
+
+    regressed += compare_memory(baseline, megabytes, args.tolerance,
+                                args.memory_limit)
+    if regressed:
+        print("%d benchmark(s) regressed: %s" %
+              (len(regressed), ", ".join(regressed)), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,9 @@
 import signal
 import sys
 import cmd
+import argparse
 from threading import current_thread, Thread
-from src import node, util
+from src import node, async_node, pipeline, util, ledger, mempool
 
 # global node object
 n = None
@@ -69,6 +70,19 @@ class NodeShell(cmd.Cmd):
         "Display balance"
         print(n.balance())
 
+    def do_balances(self, line):
+        "Display the balance of every account, worked out from the chain"
+        credit, balances = ledger.balances(n.chain.blocks)
+        for ident in sorted(balances):
+            print("%d: %d" % (ident, balances[ident]))
+        print("any other account: %d" % credit)
+
+    def do_seen(self, line):
+        "Show how many incoming transactions and blocks were duplicates"
+        stats = n.seen.stats()
+        print("remembered: %d, new: %d, duplicates: %d" %
+              (stats["size"], stats["misses"], stats["hits"]))
+
     def postcmd(self, stop, line):
         return not n.connected
 
@@ -84,10 +98,47 @@ def main():
                          (name, port))
             sys.exit(1)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tracker_port", type=int)
+    parser.add_argument("listen_port", type=int)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run networking on a single event loop")
+    parser.add_argument("--miners", type=int, default=None,
+                        help="number of mining processes (default: one "
+                             "per core)")
+    parser.add_argument("--workers", type=int,
+                        default=pipeline.DEFAULT_WORKERS,
+                        help="threads decrypting messages from peers")
+    parser.add_argument("--queue-depth", type=int,
+                        default=pipeline.DEFAULT_DEPTH,
+                        help="messages from a peer that may wait to be "
+                             "decrypted")
+    parser.add_argument("--batch-window", type=float,
+                        default=pipeline.DEFAULT_WINDOW,
+                        help="milliseconds to gather outgoing transactions "
+                             "into a batch (0 sends each one at once)")
+    parser.add_argument("--batch-size", type=int,
+                        default=pipeline.DEFAULT_BATCH,
+                        help="most transactions sent in one batch")
+    parser.add_argument("--gossip", action="store_true",
+                        help="relay transactions and blocks to peers by "
+                             "announcing them first")
+    parser.add_argument("--mempool-size", type=int,
+                        default=mempool.DEFAULT_SIZE,
+                        help="most unconfirmed transactions to hold; the "
+                             "oldest are dropped first")
+    parser.add_argument("--data-dir", default=None,
+                        help="directory to keep the chain in between runs")
+    args = parser.parse_args()
+
+    if args.gossip and args.use_async:
+        util.printts("Node: --gossip is not supported with --async")
+        sys.exit(1)
+
     # do some sanity checks
-    tracker_port = int(sys.argv[1])
+    tracker_port = args.tracker_port
     check_port(tracker_port, "tracker")
-    port = int(sys.argv[2])
+    port = args.listen_port
     check_port(port, "listening")
     if util.is_port_in_use(port):
         util.printts("Node: port %d is already in use" % port)
@@ -95,7 +146,19 @@ def main():
 
     # create our node
     global n
-    n = node.Node("localhost", tracker_port, port)
+    if args.use_async:
+        n = async_node.AsyncNode("localhost", tracker_port, port,
+                                 miners=args.miners,
+                                 mempool_size=args.mempool_size,
+                                 data_dir=args.data_dir)
+    else:
+        n = node.Node("localhost", tracker_port, port, miners=args.miners,
+                      workers=args.workers, depth=args.queue_depth,
+                      batch_window=args.batch_window,
+                      batch_size=args.batch_size,
+                      gossip=args.gossip,
+                      mempool_size=args.mempool_size,
+                      data_dir=args.data_dir)
 
     # establish a connection with the tracker
     try:
@@ -113,13 +176,16 @@ def main():
         thread.start()
         return thread
 
-    # the accepter thread will run forever
-    # but we don't care about when it finishes
-    new_thread(accepter)
+    # the asynchronous node accepts peers and receives
+    # from the tracker on its own event loop
+    if not args.use_async:
+        # the accepter thread will run forever
+        # but we don't care about when it finishes
+        new_thread(accepter)
 
-    # the tracker_receiver thread will finish when
-    # the connection with the tracker is broken
-    new_thread(tracker_receiver)
+        # the tracker_receiver thread will finish when
+        # the connection with the tracker is broken
+        new_thread(tracker_receiver)
 
     # the node will stay up as long as the REPL is running
     NodeShell().cmdloop()
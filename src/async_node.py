@@ -0,0 +1,748 @@
+import asyncio
+from queue import Queue
+from threading import Thread
+from . import blockchain, message, peer, util, pkc, proof_of_work, seen
+from . import store, mempool
+
+# how long to wait for the tracker to announce a peer
+# that is already trying to connect to us (seconds)
+ANNOUNCE_TIMEOUT = 5
+
+# this node doesn't relay announcements or rebuild compact blocks,
+# so peers should send it transactions and blocks outright
+FEATURES = [f for f in message.FEATURES
+            if f not in (message.FEATURE_GOSSIP, message.FEATURE_COMPACT)]
+
+
+# a node whose networking runs on a single asyncio event loop rather
+# than a thread per peer. the event loop runs on its own thread so
+# that the blocking interface used by the shell stays the same.
+class AsyncNode:
+    def __init__(self, tracker_hostname, tracker_port, port,
+                 hostname="localhost", miners=None,
+                 mempool_size=mempool.DEFAULT_SIZE, data_dir=None):
+        self.tracker_addr = (tracker_hostname, tracker_port)
+        self.addr = (hostname, port)
+        self.peers = {}
+        self.peer_writers = {}
+        self.peer_codecs = {}
+        self.peer_sessions = {}
+        self.ident = None
+        self.server = None
+        self.tracker_reader = None
+        self.tracker_writer = None
+        self.chain = None
+        self.connected = False
+        self.key_pair = pkc.KeyPair()
+        self.tracker_public_key = None
+        self.tracker_verify_key = None
+        self.tracker_codec = message.Codec.JSON
+        self.tracker_session = None
+        # the miner, and the blocks it finds
+        self.miner = None
+        self.block_queue = None
+        self.miners = miners
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.announced = None
+        # most unconfirmed transactions we hold at once
+        self.mempool_size = mempool_size
+        # where the chain is kept between runs, if anywhere
+        self.store = store.BlockStore(data_dir) if data_dir else None
+        self.tasks = set()
+        # the transactions and blocks we've seen, by identifier
+        self.seen = seen.SeenCache()
+
+    def __call(self, coro):
+        # run a coroutine on the event loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def __spawn(self, coro):
+        # keep a reference to running tasks so they aren't collected
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def connect(self):
+        self.thread.start()
+
+        connected = self.__call(self.__connect())
+        if not connected:
+            self.__call(self.__disconnect())
+
+        return connected
+
+    def disconnect(self):
+        if self.connected:
+            self.__call(self.__disconnect())
+
+    def send_transaction(self, receiver, amount):
+        if self.connected:
+            self.__call(self.__send_transaction(receiver, amount))
+
+    def balance(self):
+        return self.chain.balance(self.ident)
+
+    # what to encrypt messages to/from the tracker with: the session
+    # once the handshake has established one, otherwise our keys
+    def __tracker_enc(self, send=True):
+        if self.tracker_session:
+            return self.tracker_session
+        elif send:
+            return (self.tracker_public_key, self.key_pair)
+        return (self.tracker_verify_key,
+                self.tracker_public_key,
+                self.key_pair)
+
+    def __peer_enc(self, ident, send=True):
+        session = self.peer_sessions.get(ident, None)
+        if session:
+            return session
+
+        p = self.peers[ident]
+        if send:
+            return (p.public_key, self.key_pair)
+        return (p.verify_key, p.public_key, self.key_pair)
+
+    async def __recv_expect(self, reader, kind, enc=None):
+        try:
+            msg = await message.recv_async(reader, enc)
+            if not msg or msg.kind != kind:
+                raise ValueError
+        except ValueError:
+            return False
+
+        return msg
+
+    async def __connect(self):
+        self.announced = asyncio.Condition()
+
+        # connect to the tracker
+        try:
+            self.tracker_reader, self.tracker_writer = \
+                await asyncio.open_connection(*self.tracker_addr)
+        except ConnectionRefusedError:
+            util.printts("Node: connection to tracker on %s:%d refused" %
+                         (self.tracker_addr[0], self.tracker_addr[1]))
+            return False
+
+        util.printts("Node: connected to tracker on %s:%d" %
+                     (self.tracker_addr[0], self.tracker_addr[1]))
+
+        self.connected = True
+
+        await message.NodeKeys(self.key_pair.serialize_public_key(),
+                               self.key_pair.serialize_verify_key(),
+                               FEATURES) \
+                     .send_async(self.tracker_writer)
+
+        # receive our identifier from the tracker
+        msg = await self.__recv_expect(self.tracker_reader,
+                                       message.Kind.TRACKER_IDENT)
+        if msg is False:
+            util.printts("Node: failed to receive TRACKER_IDENT")
+            return False
+
+        self.ident = msg.msg["ident"]
+        self.tracker_public_key = \
+            pkc.deserialize_public_key(msg.msg["public_key"])
+        self.tracker_verify_key = \
+            pkc.deserialize_verify_key(msg.msg["verify_key"])
+        self.tracker_codec = message.negotiate_codec(msg.msg.get("features"))
+        util.printts("Node: received ident %d" % self.ident)
+
+        # if the tracker can sync us, tell it how much of the chain we have
+        features = msg.msg.get("features")
+        sync = message.supports(features, message.FEATURE_SYNC)
+        stream = message.supports(features, message.FEATURE_STREAM)
+        salt = pkc.new_salt()
+        if sync:
+            self.chain = blockchain.Blockchain.by_sync(self.store)
+            reply = message.NodeIdent(len(self.chain.blocks),
+                                      self.chain.locator(), salt)
+        else:
+            reply = message.NodeIdent(salt=salt)
+
+        codec = self.tracker_codec
+        await reply.send_async(self.tracker_writer, self.__tracker_enc(),
+                               codec)
+
+        # having proven who we are, switch to a session if we can
+        self.tracker_session = \
+            message.negotiate_session(msg.msg.get("features"),
+                                      self.key_pair,
+                                      self.tracker_public_key,
+                                      salt, msg.msg.get("salt"))
+        enc_send = self.__tracker_enc()
+        enc_recv = self.__tracker_enc(send=False)
+
+        # receive our blockchain from the tracker
+        if sync:
+            if not await self.__sync_with_tracker(enc_send, enc_recv,
+                                                  stream):
+                return False
+        else:
+            msg = await self.__recv_expect(self.tracker_reader,
+                                           message.Kind.TRACKER_CHAIN,
+                                           enc_recv)
+            if msg is False:
+                util.printts("Node %d: failed to receive TRACKER_CHAIN" %
+                             self.ident)
+                return False
+
+            self.chain = blockchain.Blockchain.by_serialized(
+                msg.msg["blockchain"], self.store)
+        self.chain.unconfirmed.limit(self.mempool_size)
+        util.printts("Node %d: received chain" % self.ident)
+
+        # reply with the port we want to listen on
+        await message.NodePort(self.addr[1]).send_async(self.tracker_writer,
+                                                        enc_send, codec)
+
+        msg = await self.__recv_expect(self.tracker_reader,
+                                       message.Kind.NODE_LISTEN,
+                                       enc_recv)
+        if msg is False:
+            util.printts("Node %d: failed to receive NODE_LISTEN" % self.ident)
+            return False
+
+        # start listening on our desired port
+        self.server = await asyncio.start_server(self.__accept,
+                                                 self.addr[0],
+                                                 self.addr[1])
+        util.printts("Node %d: listen on %s:%d" %
+                     (self.ident, self.addr[0], self.addr[1]))
+
+        # tell the tracker we've started listening
+        await message.NodeListen().send_async(self.tracker_writer, enc_send,
+                                              codec)
+
+        # receive our peers
+        msg = await self.__recv_expect(self.tracker_reader,
+                                       message.Kind.TRACKER_PEERS,
+                                       enc_recv)
+        if msg is False:
+            util.printts("Node %d: failed to receive TRACKER_PEERS" %
+                         self.ident)
+            return False
+
+        # populate with the current peers
+        for p in msg.msg["peers"]:
+            ident = p["ident"]
+            public_key = pkc.deserialize_public_key(p["public_key"])
+            verify_key = pkc.deserialize_verify_key(p["verify_key"])
+            self.peers[ident] = peer.Peer(p["host"],
+                                          ident,
+                                          p["port"],
+                                          public_key,
+                                          verify_key)
+
+        # tell the tracker we received the peers
+        await message.NodePeers().send_async(self.tracker_writer, enc_send,
+                                             codec)
+
+        # wait for acceptance
+        msg = await self.__recv_expect(self.tracker_reader,
+                                       message.Kind.TRACKER_ACCEPT,
+                                       enc_recv)
+        if msg is False:
+            util.printts("Node %d: failed to receive TRACKER_ACCEPT" %
+                         self.ident)
+            return False
+
+        util.printts("Node %d: accepted by tracker" % self.ident)
+
+        # nodes that join after us may try to connect while we are still
+        # connecting to our own peers, so start listening for their
+        # announcements right away
+        self.__spawn(self.__recv_tracker())
+
+        # connect with all of our peers at once
+        await asyncio.gather(*[self.__connect_peer(p)
+                               for p in list(self.peers.values())])
+
+        # the miner runs for as long as we're connected,
+        # mining whatever unconfirmed transactions we have
+        self.block_queue = Queue()
+        self.miner = proof_of_work.ProofOfWork(self.chain, self.block_queue,
+                                               processes=self.miners)
+        self.miner.thread.start()
+        self.__spawn(self.__block_waiter())
+
+        return True
+
+    async def __sync_with_tracker(self, enc_send, enc_recv, stream=False):
+        msg = await self.__recv_expect(self.tracker_reader,
+                                       message.Kind.TRACKER_SYNC,
+                                       enc_recv)
+        if msg is False:
+            util.printts("Node %d: failed to receive TRACKER_SYNC" %
+                         self.ident)
+            return False
+
+        # drop whatever we have past the point where we and the
+        # tracker agree, then fetch the rest a range at a time
+        height = msg.msg["height"]
+        unconfirmed = msg.msg["unconfirmed"]
+        self.chain.replace_blocks(msg.msg["common"], [])
+        util.printts("Node %d: have %d of %d blocks" %
+                     (self.ident, len(self.chain.blocks), height))
+
+        if stream and len(self.chain.blocks) < height:
+            if not await self.__stream_from_tracker(enc_send, enc_recv):
+                return False
+
+        while len(self.chain.blocks) < height:
+            await message.SyncGetBlocks(len(self.chain.blocks)) \
+                         .send_async(self.tracker_writer, enc_send,
+                                     self.tracker_codec)
+
+            msg = await self.__recv_expect(self.tracker_reader,
+                                           message.Kind.SYNC_BLOCKS,
+                                           enc_recv)
+            if msg is False:
+                util.printts("Node %d: failed to receive SYNC_BLOCKS" %
+                             self.ident)
+                return False
+
+            if msg.msg["start"] != len(self.chain.blocks) or \
+               not msg.msg["blocks"]:
+                util.printts("Node %d: tracker sent the wrong blocks" %
+                             self.ident)
+                return False
+
+            for block in msg.msg["blocks"]:
+                self.__append_block(blockchain.Block.deserialize(block))
+
+        self.chain.hold(unconfirmed)
+        return True
+
+    async def __stream_from_tracker(self, enc_send, enc_recv):
+        # everything we're missing comes in one go, a chunk at a time
+        await message.SyncGetChain(len(self.chain.blocks)) \
+                     .send_async(self.tracker_writer, enc_send,
+                                 self.tracker_codec)
+
+        stream = message.ChainStream()
+        try:
+            while True:
+                msg = await message.recv_async(self.tracker_reader, enc_recv)
+                if msg and msg.kind == message.Kind.SYNC_CHUNK:
+                    for serialized in stream.chunk(msg):
+                        block = blockchain.Block.deserialize(serialized)
+                        stream.add(block.hexdigest())
+                        if not self.chain.add_block(block):
+                            raise ValueError
+                elif msg and msg.kind == message.Kind.SYNC_END:
+                    stream.end(msg)
+                    return True
+                else:
+                    raise ValueError
+        except ValueError:
+            util.printts("Node %d: failed to receive the chain" % self.ident)
+            return False
+
+    async def __connect_peer(self, p):
+        # establish connection
+        try:
+            reader, writer = await asyncio.open_connection(p.host, p.port)
+        except OSError:
+            util.printts("Node %d: connection to peer %d on %s:%d refused" %
+                         (self.ident, p.ident, p.host, p.port))
+            self.peers.pop(p.ident, None)
+            return
+
+        util.printts("Node %d: connected to peer %d on %s:%d" %
+                     (self.ident, p.ident, p.host, p.port))
+
+        # tell them our identifier
+        await message.PeerIdent(self.ident, FEATURES) \
+                     .send_async(writer)
+
+        enc_send = (p.public_key, self.key_pair)
+        enc_recv = (p.verify_key, p.public_key, self.key_pair)
+
+        # wait for the peer to ask for verification
+        reply = await self.__recv_expect(reader, message.Kind.PEER_VERIFY,
+                                         enc_recv)
+        if reply is False:
+            util.printts("Node %d: rejected by peer %d on %s:%d, "
+                         "verify failed" %
+                         (self.ident, p.ident, p.host, p.port))
+            self.__remove_peer(writer, p.ident)
+            return
+
+        # the peer told us what it supports while asking
+        features = reply.msg.get("features")
+        codec = message.negotiate_codec(features)
+        salt = pkc.new_salt()
+        session = message.negotiate_session(features, self.key_pair,
+                                            p.public_key, salt,
+                                            reply.msg.get("salt"))
+
+        util.printts("Node %d: verifying identity with peer %d" %
+                     (self.ident, p.ident))
+        await message.PeerVerify(salt=salt).send_async(writer, enc_send,
+                                                       codec)
+
+        # wait for acceptance, which comes over the session if any
+        reply = await self.__recv_expect(reader, message.Kind.PEER_ACCEPT,
+                                         session or enc_recv)
+        if reply is False:
+            util.printts("Node %d: rejected by peer %d on %s:%d, "
+                         "accept failed" %
+                         (self.ident, p.ident, p.host, p.port))
+            self.__remove_peer(writer, p.ident)
+            return
+
+        # register the connection
+        util.printts("Node %d: accepted by peer %d on %s:%d" %
+                     (self.ident, p.ident, p.host, p.port))
+        self.peer_writers[p.ident] = writer
+        self.peer_codecs[p.ident] = codec
+        self.peer_sessions[p.ident] = session
+        self.__spawn(self.__recv_peer(p.ident, reader))
+
+    async def __accept(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        util.printts("Node %d: opened connection %s:%d" %
+                     (self.ident, addr[0], addr[1]))
+
+        # the peer must identify themselves
+        msg = await self.__recv_expect(reader, message.Kind.PEER_IDENT)
+        if msg is not False and msg.msg["ident"] not in self.peers:
+            # the peer may have beaten the tracker's announcement of it
+            try:
+                async with self.announced:
+                    await asyncio.wait_for(
+                        self.announced.wait_for(
+                            lambda: msg.msg["ident"] in self.peers),
+                        ANNOUNCE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+        if msg is False or msg.msg["ident"] not in self.peers:
+            util.printts("Node %d: rejecting connection %s:%d" %
+                         (self.ident, addr[0], addr[1]))
+            writer.close()
+            return
+
+        ident = msg.msg["ident"]
+        pk = self.peers[ident].public_key
+        enc_send = (pk, self.key_pair)
+        enc_recv = (self.peers[ident].verify_key, pk, self.key_pair)
+        features = msg.msg.get("features")
+        codec = message.negotiate_codec(features)
+
+        # the peer should verify their identity with us
+        # since we were provided by the tracker with their
+        # public key and verify key.
+        salt = pkc.new_salt()
+        await message.PeerVerify(FEATURES, salt).send_async(writer, enc_send,
+                                                            codec)
+
+        msg = await self.__recv_expect(reader, message.Kind.PEER_VERIFY,
+                                       enc_recv)
+        if msg is False:
+            util.printts("Node %d: rejecting connection %s:%d from peer %d" %
+                         (self.ident, addr[0], addr[1], ident))
+            writer.close()
+            return
+
+        # tell them we've accepted them. they have proven who
+        # they are, so this is where the session starts.
+        session = message.negotiate_session(features, self.key_pair, pk,
+                                            salt, msg.msg.get("salt"))
+        await message.PeerAccept().send_async(writer, session or enc_send,
+                                              codec)
+        util.printts("Node %d: accepting connection from peer %d on %s:%d" %
+                     (self.ident, ident, addr[0], addr[1]))
+
+        self.peer_writers[ident] = writer
+        self.peer_codecs[ident] = codec
+        self.peer_sessions[ident] = session
+
+        # this task now becomes the receiver for the peer
+        await self.__recv_peer(ident, reader)
+
+    async def __recv_tracker(self):
+        enc_recv = self.__tracker_enc(send=False)
+
+        while self.connected:
+            try:
+                msg = await message.recv_async(self.tracker_reader, enc_recv)
+            except ValueError:
+                if self.connected:
+                    util.printts("Node %d: connection with tracker broken" %
+                                 self.ident)
+                    await self.__disconnect()
+                break
+
+            # a new peer connected, and they will soon attempt to establish
+            # a direct connection with us, so register them so that we can
+            # recognize them in such an event.
+            if msg and msg.kind == message.Kind.TRACKER_NEW_PEER:
+                p = msg.msg["peer"]
+                ident = p["ident"]
+                util.printts("Node %d: received new peer %d on %s:%d" %
+                             (self.ident, ident, p["host"], p["port"]))
+                self.peers[ident] = \
+                    peer.Peer(p["host"],
+                              ident,
+                              p["port"],
+                              pkc.deserialize_public_key(p["public_key"]),
+                              pkc.deserialize_verify_key(p["verify_key"]))
+
+                async with self.announced:
+                    self.announced.notify_all()
+
+                # the tracker may ask us to make the connection ourselves,
+                # when neither of us was told about the other on joining
+                if msg.msg.get("connect"):
+                    self.__spawn(self.__connect_peer(self.peers[ident]))
+
+    async def __recv_peer(self, ident, reader):
+        util.printts("Node %d: monitoring messages from peer %d" %
+                     (self.ident, ident))
+
+        writer = self.peer_writers[ident]
+        enc_recv = self.__peer_enc(ident, send=False)
+
+        while self.connected:
+            try:
+                msg = await message.recv_async(reader, enc_recv)
+            except ValueError:
+                util.printts("Node %d: connection with peer %d broken" %
+                             (self.ident, ident))
+                self.__remove_peer(writer, ident)
+                break
+
+            if not msg or not self.__fresh(msg):
+                continue
+
+            if msg.kind == message.Kind.NODE_DISCONNECT:
+                util.printts("Node %d: peer %d is disconnecting" %
+                             (self.ident, ident))
+                self.__remove_peer(writer, ident)
+                break
+            elif msg.kind == message.Kind.PEER_TRANSACTION:
+                util.printts("Node %d: received transaction from peer %s" %
+                             (self.ident, ident))
+                await self.__recv_transaction(msg.msg["transaction"])
+            elif msg.kind == message.Kind.PEER_TRANSACTIONS:
+                util.printts("Node %d: received %d transactions from peer %s" %
+                             (self.ident, len(msg.msg["transactions"]), ident))
+                await self.__recv_transactions(msg.msg["transactions"])
+            elif msg.kind == message.Kind.PEER_BLOCK:
+                util.printts("Node %d: received block from peer %s" %
+                             (self.ident, ident))
+                self.__recv_block(msg.msg["block"])
+            elif msg.kind == message.Kind.SYNC_GET_BLOCKS:
+                # a peer that has fallen behind is catching up with us
+                try:
+                    await message.sync_blocks(self.chain, msg.msg) \
+                                 .send_async(writer, self.__peer_enc(ident),
+                                             self.peer_codecs[ident])
+                except Exception:
+                    pass
+
+    def __remove_peer(self, writer, ident):
+        if writer:
+            writer.close()
+
+        self.peers.pop(ident, None)
+        self.peer_writers.pop(ident, None)
+        self.peer_codecs.pop(ident, None)
+        self.peer_sessions.pop(ident, None)
+
+    async def __disconnect(self):
+        if not self.connected:
+            return
+
+        if self.ident is None:
+            util.printts("Node: disconnecting")
+        else:
+            util.printts("Node %d: disconnecting" % self.ident)
+
+        self.connected = False
+        msg = message.NodeDisconnect()
+
+        async def do_send(writer, enc=None, codec=message.Codec.JSON):
+            try:
+                # the connection might already be gone,
+                # so just continue as normal if sending fails
+                await msg.send_async(writer, enc, codec)
+            except Exception:
+                pass
+            writer.close()
+
+        sends = []
+        if self.tracker_writer:
+            if self.tracker_public_key:
+                sends.append(do_send(self.tracker_writer,
+                                     self.__tracker_enc(),
+                                     self.tracker_codec))
+            else:
+                sends.append(do_send(self.tracker_writer))
+
+        for ident, writer in self.peer_writers.items():
+            p = self.peers.get(ident, None)
+            if p:
+                sends.append(do_send(writer, self.__peer_enc(ident),
+                                     self.peer_codecs[ident]))
+
+        await asyncio.gather(*sends)
+
+        if self.server:
+            self.server.close()
+            self.server = None
+
+        self.tracker_reader = None
+        self.tracker_writer = None
+        self.peers = {}
+        self.peer_writers = {}
+        self.peer_codecs = {}
+        self.peer_sessions = {}
+
+        if self.chain:
+            self.chain.close()
+
+        # stop the miner, and unblock the block waiter
+        # so that it can gracefully terminate
+        if self.miner:
+            self.miner.stop()
+            self.block_queue.put("STOP")
+
+    async def __broadcast_message(self, msg):
+        if not self.connected:
+            return
+
+        util.printts("Node %d: sending a broadcast message" % self.ident)
+
+        sends = []
+        if msg.kind == message.Kind.PEER_BLOCK:
+            sends.append(msg.send_async(self.tracker_writer,
+                                        self.__tracker_enc(),
+                                        self.tracker_codec))
+
+        invalid = []
+        for ident, p in self.peers.items():
+            writer = self.peer_writers.get(ident, None)
+            if writer:
+                sends.append(msg.send_async(writer,
+                                            self.__peer_enc(ident),
+                                            self.peer_codecs[ident]))
+            else:
+                invalid.append(ident)
+
+        # we may have tried to send to peers that we never
+        # established a connection with, so it's best to
+        # remove them once we attempt to send them a message.
+        for ident in invalid:
+            self.__remove_peer(None, ident)
+
+        # every peer is sent to concurrently, a broken
+        # connection will be noticed by its receiver
+        await asyncio.gather(*sends, return_exceptions=True)
+
+    async def __send_transaction(self, receiver, amount):
+        # sending to ourselves is a no-op
+        if self.ident == receiver:
+            return
+
+        # don't allow sending to a peer that doesn't exist
+        if receiver not in self.peers:
+            util.printts("Node %d: peer %d doesn't exist" %
+                         (self.ident, receiver))
+            return
+
+        transaction = blockchain.new_transaction(self.ident, receiver, amount)
+        self.seen.add(blockchain.transaction_id(transaction), transaction)
+
+        await self.__broadcast_message(message.PeerTransaction(transaction))
+
+        # make sure it is added to this node's list of unconfirmed transactions
+        await self.__recv_transaction(transaction)
+
+    async def __recv_transaction(self, transaction):
+        await self.__recv_transactions([transaction])
+
+    async def __recv_transactions(self, transactions):
+        invalid = self.chain.add_unconfirmed_transactions(transactions)
+        for transaction in invalid:
+            util.printts("Node %d: received invalid transaction from peer %d" %
+                         (self.ident, transaction["sender"]))
+
+        # the miner takes the new transactions on board
+        if len(invalid) < len(transactions) and self.miner:
+            self.miner.update()
+
+    async def __block_waiter(self):
+        # the miner runs on its own thread and processes,
+        # we only wait on its blocks from the executor
+        while True:
+            val = await self.loop.run_in_executor(None, self.block_queue.get)
+            if val == "STOP" or not self.connected:
+                util.printts("Node %d: miner stopped" % self.ident)
+                break
+
+            # a block found just as the chain moved on is of no use
+            if val.previous_block_hash != self.chain.blocks[-1].hexdigest():
+                continue
+
+            util.printts("Node %d: finished mining" % self.ident)
+            await self.__send_block(val)
+
+    async def __send_block(self, block):
+        # make sure it is added to this node's chain
+        s = block.serialize()
+        self.seen.add(block.hexdigest(), s)
+        if not self.__append_block(block):
+            return
+        await self.__broadcast_message(message.PeerBlock(s))
+
+    def __fresh(self, msg):
+        """ False for transactions or a block we've already had """
+        # peers that relay may get the same items to us more than once,
+        # so they are dropped as soon as the message is decrypted
+        if msg.kind == message.Kind.PEER_TRANSACTION:
+            transaction = msg.msg["transaction"]
+            return self.seen.add(blockchain.transaction_id(transaction),
+                                 transaction)
+        elif msg.kind == message.Kind.PEER_TRANSACTIONS:
+            msg.msg["transactions"] = \
+                [t for t in msg.msg["transactions"]
+                 if self.seen.add(blockchain.transaction_id(t), t)]
+            return len(msg.msg["transactions"]) > 0
+        elif msg.kind == message.Kind.PEER_BLOCK:
+            # a block is only remembered once it has been verified
+            block = msg.msg["block"]
+            return not self.seen.known(blockchain.block_id(block))
+        return True
+
+    def __recv_block(self, block):
+        i = blockchain.block_id(block)
+        if i in self.seen or self.chain.height(i) is not None:
+            return
+
+        # the one check of a peer's block against its hash
+        verified = blockchain.Block.deserialize(block)
+        if not verified.verify():
+            util.printts("Node %d: block doesn't match its hash" %
+                         self.ident)
+            return
+        if not self.seen.add(i, block):
+            return
+
+        self.__append_block(verified)
+
+    def __append_block(self, block):
+        """ False if the block doesn't follow our newest one """
+        if not self.chain.add_block(block):
+            return False
+
+        # whatever the miner was working on is out of date
+        if self.miner:
+            self.miner.update()
+        return True
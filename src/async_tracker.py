@@ -0,0 +1,344 @@
+import asyncio
+from threading import Thread
+from . import blockchain, message, peer, util, pkc, store
+from .tracker import INITIAL_BALANCE, select_peers, link, unlink, relink
+from .tracker import append_block
+
+# how many handshakes may be in flight at once
+DEFAULT_MAX_JOINS = 64
+
+# how long each step of a handshake may take (seconds)
+DEFAULT_TIMEOUT = 10
+
+DEFAULT_BACKLOG = 128
+
+
+# a tracker whose join handshakes all run on a single asyncio event loop,
+# so that one slow node can't hold up the admission of the others.
+class AsyncTracker:
+    def __init__(self, port, hostname="localhost",
+                 backlog=DEFAULT_BACKLOG,
+                 max_joins=DEFAULT_MAX_JOINS,
+                 timeout=DEFAULT_TIMEOUT,
+                 degree=None,
+                 data_dir=None):
+        self.addr = (hostname, port)
+        self.nodes = {}
+        self.node_writers = {}
+        self.node_codecs = {}
+        self.node_sessions = {}
+        # who each node was told to connect to, or was told about.
+        # without a degree, every node is connected to every other.
+        self.links = {}
+        self.degree = degree
+        self.ident_count = 1
+        # the chain carries on from the data directory, if there is one
+        self.chain = blockchain.Blockchain.by_tracker(
+            INITIAL_BALANCE, store.BlockStore(data_dir) if data_dir else None)
+        self.key_pair = pkc.KeyPair()
+        self.backlog = backlog
+        self.max_joins = max_joins
+        self.timeout = timeout
+        self.server = None
+        self.lock = None
+        self.admissions = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+
+    def __call(self, coro):
+        # run a coroutine on the event loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def start(self):
+        self.thread.start()
+        self.__call(self.__start())
+
+    def stop(self):
+        if self.server:
+            self.__call(self.__stop())
+
+    async def __start(self):
+        # guards the choice of a node's peers and its registration. it is
+        # never held across a send or a receive, so that a slow node
+        # can't hold up anyone else's admission.
+        self.lock = asyncio.Lock()
+        # limits the number of handshakes in flight
+        self.admissions = asyncio.Semaphore(self.max_joins)
+
+        self.server = await asyncio.start_server(self.__accept,
+                                                 self.addr[0],
+                                                 self.addr[1],
+                                                 backlog=self.backlog)
+        util.printts("Tracker: listen on %s:%d" % (self.addr[0], self.addr[1]))
+
+    async def __stop(self):
+        util.printts("Tracker: shutting down")
+
+        self.server.close()
+        self.server = None
+
+        for writer in self.node_writers.values():
+            writer.close()
+
+        self.nodes = {}
+        self.node_writers = {}
+        self.node_codecs = {}
+        self.node_sessions = {}
+        self.links = {}
+        self.chain.close()
+
+    async def __recv_stage(self, reader, kind, enc=None, others=()):
+        # every step of the handshake gets its own deadline.
+        # `others` are the kinds that may come instead.
+        msg = await asyncio.wait_for(message.recv_async(reader, enc),
+                                     self.timeout)
+        assert(msg and (msg.kind == kind or msg.kind in others))
+        return msg
+
+    async def __send_stage(self, writer, msg, enc=None,
+                           codec=message.Codec.JSON):
+        await asyncio.wait_for(msg.send_async(writer, enc, codec),
+                               self.timeout)
+
+    async def __accept(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        util.printts("Tracker: opened connection %s:%d" % (addr[0], addr[1]))
+
+        async with self.admissions:
+            ident = await self.__join(reader, writer, addr)
+
+        # the handshake is over, so this task
+        # now listens for the node's messages
+        if ident is not None:
+            await self.__recv_node(ident, reader)
+
+    async def __join(self, reader, writer, addr):
+        # reserve the next identifier up front, since
+        # other handshakes may finish before this one
+        ident = self.ident_count
+        self.ident_count += 1
+
+        try:
+            initial = await self.__recv_stage(reader, message.Kind.NODE_KEYS)
+
+            public_key = pkc.deserialize_public_key(initial.msg["public_key"])
+            verify_key = pkc.deserialize_verify_key(initial.msg["verify_key"])
+            codec = message.negotiate_codec(initial.msg.get("features"))
+
+            salt = pkc.new_salt()
+            await self.__send_stage(writer, message.TrackerIdent(
+                ident,
+                self.key_pair.serialize_public_key(),
+                self.key_pair.serialize_verify_key(),
+                message.FEATURES, salt))
+
+            enc_send = (public_key, self.key_pair)
+            enc_recv = (verify_key, public_key, self.key_pair)
+
+            reply = await self.__recv_stage(reader, message.Kind.NODE_IDENT,
+                                            enc_recv)
+            util.printts("Tracker: node %d (connection %s:%d) "
+                         "received identifier" %
+                         (ident, addr[0], addr[1]))
+
+            # the node has proven who it is, so switch to a session if we can
+            session = message.negotiate_session(initial.msg.get("features"),
+                                                self.key_pair, public_key,
+                                                salt, reply.msg.get("salt"))
+            if session:
+                enc_send = enc_recv = session
+
+            # a node that syncs only fetches the blocks it is missing,
+            # otherwise send the most current blockchain
+            features = initial.msg.get("features")
+            if message.supports(features, message.FEATURE_SYNC):
+                height = len(self.chain.blocks)
+                common = self.chain.common_height(reply.msg.get("height", 0),
+                                                  reply.msg.get("locator", []))
+                await self.__send_stage(writer,
+                                        message.TrackerSync(
+                                            height, common,
+                                            list(self.chain.unconfirmed)),
+                                        enc_send, codec)
+                util.printts("Tracker: node %d has %d of %d blocks" %
+                             (ident, common, height))
+            else:
+                await self.__send_stage(writer,
+                                        message.TrackerChain(
+                                            self.chain.serialize()),
+                                        enc_send, codec)
+
+            # node must tell us what port they intend to listen on,
+            # once it has all the blocks it asked for
+            sync = (message.Kind.SYNC_GET_BLOCKS, message.Kind.SYNC_GET_CHAIN)
+            reply = await self.__recv_stage(reader, message.Kind.NODE_PORT,
+                                            enc_recv, sync)
+            while reply.kind in sync:
+                if reply.kind == message.Kind.SYNC_GET_BLOCKS:
+                    await self.__send_stage(writer,
+                                            message.sync_blocks(self.chain,
+                                                                reply.msg),
+                                            enc_send, codec)
+                else:
+                    for msg in message.stream_chain(self.chain,
+                                                    reply.msg["start"]):
+                        await self.__send_stage(writer, msg, enc_send, codec)
+                reply = await self.__recv_stage(reader,
+                                                message.Kind.NODE_PORT,
+                                                enc_recv, sync)
+            port = reply.msg["port"]
+            util.printts("Tracker: node %d will listen on port %d" %
+                         (ident, port))
+
+            # tell the node that it must start listening
+            await self.__send_stage(writer, message.NodeListen(), enc_send,
+                                    codec)
+
+            await self.__recv_stage(reader, message.Kind.NODE_LISTEN,
+                                    enc_recv)
+            util.printts("Tracker: node %d is ready to listen on port %d" %
+                         (ident, port))
+
+            new_peer = peer.Peer(addr[0], ident, port, public_key, verify_key)
+
+            async with self.lock:
+                chosen = select_peers(self.nodes, self.links, self.degree)
+                known = set(self.nodes)
+
+            await self.__admit(reader, writer, new_peer, chosen, enc_send,
+                               enc_recv, codec)
+
+            async with self.lock:
+                self.nodes[ident] = new_peer
+                self.node_writers[ident] = writer
+                self.node_codecs[ident] = codec
+                self.node_sessions[ident] = session
+                link(self.links, ident, chosen)
+
+                # nodes admitted while this one was joining weren't
+                # told about it, and it wasn't told about them
+                missed = [n for n in self.nodes
+                          if n not in known and n != ident]
+
+            for n in missed:
+                if self.degree is not None and \
+                   len(self.links.get(ident, ())) >= self.degree:
+                    break
+                await self.__introduce(ident, n)
+
+        except (AssertionError, asyncio.TimeoutError):
+            util.printts("Tracker: rejecting connection %s:%d" %
+                         (addr[0], addr[1]))
+            writer.close()
+            return None
+
+        except (ValueError, OSError):
+            util.printts("Tracker: connection %s:%d broken" %
+                         (addr[0], addr[1]))
+            await self.__remove_node(writer, ident)
+            return None
+
+        return ident
+
+    async def __admit(self, reader, writer, new_peer, chosen, enc_send,
+                      enc_recv, codec):
+        ident = new_peer.ident
+
+        # inform the node of its peers, as long as they're still here
+        peers = [self.nodes[n].serialize() for n in chosen if n in self.nodes]
+        await self.__send_stage(writer, message.TrackerPeers(peers), enc_send,
+                                codec)
+
+        # wait for the node to inform us that it received the peers
+        await self.__recv_stage(reader, message.Kind.NODE_PEERS, enc_recv)
+        util.printts("Tracker: node %d accepted peers" % ident)
+
+        # inform the chosen nodes of their new peer, all at once.
+        # a node that can't be reached will be noticed by its receiver.
+        new_peer_s = new_peer.serialize()
+        sends = []
+        for n in [self.nodes[c] for c in chosen if c in self.nodes]:
+            nwriter = self.node_writers[n.ident]
+            nenc = self.node_sessions[n.ident] or \
+                (n.public_key, self.key_pair)
+            sends.append(self.__send_stage(nwriter,
+                                           message.TrackerNewPeer(new_peer_s),
+                                           nenc,
+                                           self.node_codecs[n.ident]))
+        await asyncio.gather(*sends, return_exceptions=True)
+
+        # inform the node that it has been accepted
+        await self.__send_stage(writer, message.TrackerAccept(), enc_send,
+                                codec)
+
+    async def __announce(self, ident, about, connect=False):
+        # tell a node about another. a node that can't be
+        # reached will be noticed by its receiver.
+        n = self.nodes.get(ident, None)
+        other = self.nodes.get(about, None)
+        if n is None or other is None:
+            return False
+
+        enc = self.node_sessions[ident] or (n.public_key, self.key_pair)
+        try:
+            await self.__send_stage(self.node_writers[ident],
+                                    message.TrackerNewPeer(other.serialize(),
+                                                           connect),
+                                    enc, self.node_codecs[ident])
+        except (asyncio.TimeoutError, ValueError, OSError):
+            return False
+        return True
+
+    async def __introduce(self, ident, other):
+        """ have two registered nodes connect, `ident` calling `other` """
+        util.printts("Tracker: linking node %d to node %d" % (ident, other))
+        # the one called hears of it first, so that it knows who's calling
+        if await self.__announce(other, ident) and \
+           await self.__announce(ident, other, connect=True):
+            async with self.lock:
+                link(self.links, ident, [other])
+
+    async def __recv_node(self, ident, reader):
+        util.printts("Tracker: monitoring messages from node %d" % ident)
+
+        writer = self.node_writers[ident]
+        n = self.nodes[ident]
+        enc_recv = self.node_sessions[ident] or \
+            (n.verify_key, n.public_key, self.key_pair)
+
+        while True:
+            try:
+                msg = await message.recv_async(reader, enc_recv)
+            except Exception:
+                util.printts("Tracker: connection with node %d was broken" %
+                             ident)
+                await self.__remove_node(writer, ident)
+                break
+
+            if not msg:
+                continue
+
+            if msg.kind == message.Kind.NODE_DISCONNECT:
+                util.printts("Tracker: node %d is disconnecting" % ident)
+                await self.__remove_node(writer, ident)
+                break
+            elif msg.kind == message.Kind.PEER_BLOCK:
+                util.printts("Tracker: received block from node %s" % ident)
+                append_block(self.chain, ident, msg.msg["block"])
+
+    async def __remove_node(self, writer, ident):
+        writer.close()
+
+        pairs = []
+        async with self.lock:
+            if ident is not None and ident in self.nodes:
+                self.nodes.pop(ident, None)
+                self.node_writers.pop(ident, None)
+                self.node_codecs.pop(ident, None)
+                self.node_sessions.pop(ident, None)
+                # its neighbours make up for the link they lost
+                pairs = relink(self.links, unlink(self.links, ident),
+                               self.degree)
+
+        for n, other in pairs:
+            await self.__introduce(n, other)
@@ -0,0 +1,341 @@
+import base64
+import struct
+
+# binary encoding of messages. a binary message starts with MAGIC, which
+# can never start a JSON document, so a receiver can always tell the two
+# encodings apart without knowing which one the sender picked.
+#
+# header: MAGIC, VERSION, kind, layout
+# body:   the fields of the kind's schema, in order, followed by a
+#         generic map of any fields the schema doesn't cover.
+# if a message doesn't fit its schema, the whole message is
+# encoded as a generic map instead (layout GENERIC).
+MAGIC = 0xB7
+VERSION = 2
+
+SCHEMA = 0
+GENERIC = 1
+
+# tags for generic values
+T_NONE = 0
+T_TRUE = 1
+T_FALSE = 2
+T_INT = 3
+T_STR = 4
+T_LIST = 5
+T_DICT = 6
+T_FLOAT = 7
+
+# tags for block hashes, which are hex digests except for the genesis block
+H_RAW = 0
+H_DIGEST = 1
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def byte(self):
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def take(self, n):
+        if self.pos + n > len(self.data):
+            raise ValueError
+        b = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return b
+
+
+def put_uint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def get_uint(r):
+    n = 0
+    shift = 0
+    while True:
+        b = r.byte()
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n
+        shift += 7
+
+
+# signed integers are zigzag encoded so that small
+# negative numbers (e.g. GENESIS_IDENT) stay small
+def put_int(out, n):
+    if type(n) is not int:
+        raise TypeError
+    put_uint(out, (n << 1) if n >= 0 else ((-n << 1) - 1))
+
+
+def get_int(r):
+    n = get_uint(r)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+
+def put_str(out, s):
+    b = s.encode()
+    put_uint(out, len(b))
+    out += b
+
+
+def get_str(r):
+    return bytes(r.take(get_uint(r))).decode()
+
+
+# keys travel as base64 strings in the message, but as their raw bytes here
+def put_key(out, k):
+    raw = base64.b64decode(k, validate=True)
+    if len(raw) != 32:
+        raise ValueError
+    out += raw
+
+
+def get_key(r):
+    return base64.b64encode(r.take(32)).decode()
+
+
+# short transaction ids are hex strings too, and also travel as raw bytes
+SHORT_ID_SIZE = 8
+
+
+def put_short_id(out, s):
+    raw = bytes.fromhex(s)
+    if len(raw) != SHORT_ID_SIZE or raw.hex() != s:
+        raise ValueError
+    out += raw
+
+
+def get_short_id(r):
+    return bytes(r.take(SHORT_ID_SIZE)).hex()
+
+
+def put_hash(out, h):
+    if isinstance(h, str) and len(h) == 64:
+        try:
+            raw = bytes.fromhex(h)
+        except ValueError:
+            raw = None
+        # only use the compact form if it comes back out identically
+        if raw is not None and raw.hex() == h:
+            out.append(H_DIGEST)
+            out += raw
+            return
+
+    out.append(H_RAW)
+    put_value(out, h)
+
+
+def get_hash(r):
+    if r.byte() == H_DIGEST:
+        return r.take(32).hex()
+    return get_value(r)
+
+
+def put_value(out, v):
+    if v is None:
+        out.append(T_NONE)
+    elif v is True:
+        out.append(T_TRUE)
+    elif v is False:
+        out.append(T_FALSE)
+    elif type(v) is int:
+        out.append(T_INT)
+        put_int(out, v)
+    elif isinstance(v, str):
+        out.append(T_STR)
+        put_str(out, v)
+    elif isinstance(v, (list, tuple)):
+        out.append(T_LIST)
+        put_uint(out, len(v))
+        for x in v:
+            put_value(out, x)
+    elif isinstance(v, dict):
+        out.append(T_DICT)
+        put_map(out, v, ())
+    elif isinstance(v, float):
+        out.append(T_FLOAT)
+        out += struct.pack(">d", v)
+    else:
+        raise TypeError
+
+
+def get_value(r):
+    t = r.byte()
+    if t == T_NONE:
+        return None
+    elif t == T_TRUE:
+        return True
+    elif t == T_FALSE:
+        return False
+    elif t == T_INT:
+        return get_int(r)
+    elif t == T_STR:
+        return get_str(r)
+    elif t == T_LIST:
+        return [get_value(r) for _ in range(get_uint(r))]
+    elif t == T_DICT:
+        return get_map(r, {})
+    elif t == T_FLOAT:
+        return struct.unpack(">d", r.take(8))[0]
+    raise ValueError
+
+
+# a map of every key in `d` that isn't one of `skip`
+def put_map(out, d, skip):
+    keys = [k for k in d if k not in skip]
+    put_uint(out, len(keys))
+    for k in keys:
+        put_str(out, k)
+        put_value(out, d[k])
+
+
+def get_map(r, d):
+    for _ in range(get_uint(r)):
+        k = get_str(r)
+        d[k] = get_value(r)
+    return d
+
+
+# a record is a fixed list of typed fields followed by a map of the rest
+def put_record(out, d, fields):
+    for name, t in fields:
+        PUT[t](out, d[name])
+    put_map(out, d, [name for name, _ in fields])
+
+
+def get_record(r, fields):
+    d = {}
+    for name, t in fields:
+        d[name] = GET[t](r)
+    return get_map(r, d)
+
+
+def put_list(t):
+    def put(out, xs):
+        put_uint(out, len(xs))
+        for x in xs:
+            PUT[t](out, x)
+    return put
+
+
+def get_list(t):
+    def get(r):
+        return [GET[t](r) for _ in range(get_uint(r))]
+    return get
+
+
+TRANSACTION = [("sender", "int"), ("receiver", "int"), ("amount", "int")]
+
+BLOCK = [("transactions", "txs"),
+         ("previous_block_hash", "hash"),
+         ("timestamp", "str"),
+         ("nonce", "int"),
+         ("hash", "hash")]
+
+PEER = [("host", "str"),
+        ("ident", "int"),
+        ("port", "int"),
+        ("public_key", "key"),
+        ("verify_key", "key")]
+
+CHAIN = [("blocks", "blocks"), ("unconfirmed", "txs")]
+
+HEADER = [("previous_block_hash", "hash"),
+          ("timestamp", "str"),
+          ("nonce", "int")]
+
+PUT = {"int": put_int,
+       "str": put_str,
+       "key": put_key,
+       "hash": put_hash,
+       "any": put_value,
+       "tx": lambda out, d: put_record(out, d, TRANSACTION),
+       "block": lambda out, d: put_record(out, d, BLOCK),
+       "peer": lambda out, d: put_record(out, d, PEER),
+       "chain": lambda out, d: put_record(out, d, CHAIN),
+       "header": lambda out, d: put_record(out, d, HEADER),
+       "short_id": put_short_id,
+       "ints": put_list("int"),
+       "short_ids": put_list("short_id"),
+       "txs": put_list("tx"),
+       "blocks": put_list("block"),
+       "peers": put_list("peer"),
+       "hashes": put_list("hash")}
+
+GET = {"int": get_int,
+       "str": get_str,
+       "key": get_key,
+       "hash": get_hash,
+       "any": get_value,
+       "tx": lambda r: get_record(r, TRANSACTION),
+       "block": lambda r: get_record(r, BLOCK),
+       "peer": lambda r: get_record(r, PEER),
+       "chain": lambda r: get_record(r, CHAIN),
+       "header": lambda r: get_record(r, HEADER),
+       "short_id": get_short_id,
+       "ints": get_list("int"),
+       "short_ids": get_list("short_id"),
+       "txs": get_list("tx"),
+       "blocks": get_list("block"),
+       "peers": get_list("peer"),
+       "hashes": get_list("hash")}
+
+# the fixed fields of each kind of message, keyed by message.Kind.
+# kinds that aren't listed carry all of their fields in the map.
+SCHEMAS = {}
+
+
+def schema(kind, fields):
+    SCHEMAS[int(kind)] = fields
+
+
+def encode(msg):
+    kind = int(msg["kind"])
+    fields = SCHEMAS.get(kind, [])
+
+    out = bytearray((MAGIC, VERSION, kind, SCHEMA))
+    try:
+        for name, t in fields:
+            PUT[t](out, msg[name])
+        # the kind is already in the header
+        put_map(out, msg, ["kind"] + [name for name, _ in fields])
+    except (KeyError, TypeError, ValueError):
+        # the message doesn't fit its schema, so fall back to
+        # encoding it generically. this still beats JSON.
+        out = bytearray((MAGIC, VERSION, kind, GENERIC))
+        put_map(out, msg, ("kind",))
+
+    return bytes(out)
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def decode(data):
+    r = Reader(data)
+    if r.byte() != MAGIC or r.byte() != VERSION:
+        raise ValueError
+
+    kind = r.byte()
+    layout = r.byte()
+    if layout == GENERIC:
+        fields = []
+    else:
+        fields = SCHEMAS.get(kind, [])
+
+    try:
+        msg = get_record(r, fields)
+    except IndexError:
+        raise ValueError
+
+    msg["kind"] = kind
+    return msg
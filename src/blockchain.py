@@ -1,46 +1,419 @@
 import json
+import struct
 import datetime
-from random import randint
+from array import array
+from random import randint, getrandbits
 from hashlib import sha256
-from . import util
+from threading import RLock, Thread, Event
+from .mempool import Mempool
 
 
 GENESIS_IDENT = -1
 
+# the keys of a transaction, in the order they are serialized in
+TRANSACTION_KEYS = ("sender", "receiver", "amount", "nonce")
+
+# stands in for the nonce of a transaction that doesn't have one
+NO_NONCE = -1
+
+INT64 = (-(1 << 63), 1 << 63)
+
+# leading zero hex digits a block's hash must have
+DEFAULT_DIFFICULTY = 5
+
+# a block is hashed by its header alone: the previous block's hash, the
+# merkle root of its transactions, its timestamp in microseconds, its
+# nonce and its difficulty. the nonce and difficulty come last, so that
+# a miner can hash the rest once and only append them for each attempt.
+HEADER_PREFIX = struct.Struct(">32s32sq")
+HEADER_TAIL = struct.Struct(">QI")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# the transactions of a block, stored column-wise in arrays of 64-bit
+# integers rather than as a dict apiece. they read back as the same dicts
+# in the same key order, so blocks serialize (and hash) just the same.
+class Transactions:
+    __slots__ = ("senders", "receivers", "amounts", "nonces")
+
+    def __init__(self):
+        self.senders = array("q")
+        self.receivers = array("q")
+        self.amounts = array("q")
+        self.nonces = array("q")
+
+    @staticmethod
+    def fits(transaction):
+        """ whether a transaction can be stored without changing it """
+        keys = tuple(transaction.keys())
+        if keys != TRANSACTION_KEYS and keys != TRANSACTION_KEYS[:3]:
+            return False
+        if keys == TRANSACTION_KEYS and \
+           (type(transaction["nonce"]) is not int or
+                transaction["nonce"] < 0):
+            return False
+
+        return all(type(v) is int and INT64[0] <= v < INT64[1]
+                   for v in transaction.values())
+
+    @classmethod
+    def of(cls, transactions):
+        """ the transactions column-wise, or as they are if they don't fit """
+        if isinstance(transactions, cls) or \
+           not all(cls.fits(t) for t in transactions):
+            return transactions
+
+        columns = cls()
+        for t in transactions:
+            columns.senders.append(t["sender"])
+            columns.receivers.append(t["receiver"])
+            columns.amounts.append(t["amount"])
+            columns.nonces.append(t.get("nonce", NO_NONCE))
+        return columns
+
+    def __len__(self):
+        return len(self.senders)
+
+    def __getitem__(self, n):
+        t = {"sender": self.senders[n],
+             "receiver": self.receivers[n],
+             "amount": self.amounts[n]}
+        if self.nonces[n] != NO_NONCE:
+            t["nonce"] = self.nonces[n]
+        return t
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+def transfers(transactions):
+    """ the sender, receiver and amount of each transaction """
+    if isinstance(transactions, Transactions):
+        return zip(transactions.senders, transactions.receivers,
+                   transactions.amounts)
+    return ((t["sender"], t["receiver"], t["amount"]) for t in transactions)
+
 
 class Block:
+    # blocks are kept by the thousand, so they go without a __dict__
+    __slots__ = ("transactions", "previous_block_hash", "timestamp",
+                 "nonce", "difficulty", "__root", "__digest", "__hex")
+
     def __init__(self, transactions, previous_block_hash,
-                 timestamp, nonce=randint(0, 10000)):
-        self.transactions = transactions
+                 timestamp, nonce=randint(0, 10000),
+                 difficulty=DEFAULT_DIFFICULTY, block_hash=None):
+        self.transactions = Transactions.of(transactions)
         self.previous_block_hash = previous_block_hash  # hex format
         if timestamp is None:
-            self.timestamp = datetime.datetime.now()
+            self.timestamp = str(datetime.datetime.now())
+        else:
+            self.timestamp = str(timestamp)
 
         self.nonce = nonce
-        self.this_hash = self.hash()
+        self.difficulty = difficulty
+        # the root and the hash are worked out when they're first needed,
+        # then kept. a block that came with its hash keeps that one,
+        # unless it is verified.
+        self.__root = None
+        self.__digest = None
+        self.__hex = block_hash
 
     def serialize(self):
-        return {"transactions": self.transactions,
+        return {"transactions": list(self.transactions),
                 "previous_block_hash": self.previous_block_hash,
-                "timestamp": str(self.timestamp),
-                "nonce": self.nonce}
+                "timestamp": self.timestamp,
+                "nonce": self.nonce,
+                "difficulty": self.difficulty,
+                "hash": self.hexdigest()}
+
+    def root(self):
+        """ the merkle root of the transactions """
+        # only the root goes into the header, so they're hashed the once
+        if self.__root is None:
+            self.__root = merkle_root(self.transactions)
+        return self.__root
+
+    def header(self):
+        """ the fixed-size header that the block is hashed by """
+        return HEADER_PREFIX.pack(previous_digest(self.previous_block_hash),
+                                  self.root(),
+                                  timestamp_micros(self.timestamp)) + \
+            HEADER_TAIL.pack(self.nonce, self.difficulty)
 
     def hash(self):
-        return sha256(json.dumps(self.serialize()).encode('utf-8'))
+        return sha256(self.header())
+
+    def rehash(self):
+        """ forget the hash, e.g. once the nonce has changed """
+        self.__digest = None
+        self.__hex = None
+
+    def digest(self):
+        if self.__digest is None:
+            if self.__hex is None:
+                self.__digest = self.hash().digest()
+            else:
+                self.__digest = bytes.fromhex(self.__hex)
+        return self.__digest
+
+    def hexdigest(self):
+        if self.__hex is None:
+            self.__hex = self.digest().hex()
+        return self.__hex
+
+    def verify(self):
+        """ False if the block isn't the one its hash says it is """
+        # this is the only place a block's hash is checked, and only
+        # blocks from peers need it. ours, the tracker's and those in
+        # our store are taken at their word.
+        claimed = self.__hex
+        self.rehash()
+        return claimed is None or claimed == self.hexdigest()
+
+    @classmethod
+    def deserialize(cls, serialized):
+        """ the block exactly as it was serialized, hash and all """
+        return cls(serialized["transactions"],
+                   serialized["previous_block_hash"],
+                   serialized["timestamp"],
+                   serialized["nonce"],
+                   serialized.get("difficulty", DEFAULT_DIFFICULTY),
+                   serialized.get("hash"))
+
+
+def previous_digest(previous_block_hash):
+    # the genesis block has no previous block
+    if previous_block_hash == 0:
+        return bytes(32)
+    return bytes.fromhex(previous_block_hash)
+
+
+def timestamp_micros(timestamp):
+    t = datetime.datetime.fromisoformat(timestamp)
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (t - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def block_id(serialized):
+    """ the identifier a serialized block is announced by """
+    # it is taken at its word here; see Block.verify
+    block_hash = serialized.get("hash")
+    if block_hash is None:
+        block_hash = Block.deserialize(serialized).hexdigest()
+    return block_hash
+
+
+def transaction_digest(transaction):
+    return sha256(json.dumps(transaction, sort_keys=True)
+                  .encode('utf-8')).digest()
+
+
+def transaction_id(transaction):
+    """ the identifier a transaction is announced by """
+    return transaction_digest(transaction).hex()
+
+
+# a merkle tree over transaction digests, pairing nodes level by level
+# and pairing the last node of an odd level with itself. every level is
+# kept, so that appending a leaf only rehashes the path up from it.
+class MerkleTree:
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        for leaf in leaves:
+            self.append(leaf)
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+
+        level = 0
+        n = len(self.levels[0]) - 1
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            left = nodes[n - n % 2]
+            right = nodes[n - n % 2 + 1] if n - n % 2 + 1 < len(nodes) \
+                else left
+
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            parent = sha256(left + right).digest()
+            if n // 2 < len(parents):
+                parents[n // 2] = parent
+            else:
+                parents.append(parent)
+
+            level += 1
+            n //= 2
+
+    def root(self):
+        if not self.levels[0]:
+            return bytes(32)
+        return self.levels[-1][0]
+
+
+def merkle_root(transactions):
+    return MerkleTree(transaction_digest(t) for t in transactions).root()
+
+
+# how many hex digits of a transaction's identifier a compact block
+# lists it by. a collision just means the whole block has to be sent.
+SHORT_ID_LENGTH = 16
+
+
+def short_id(transaction):
+    return transaction_id(transaction)[:SHORT_ID_LENGTH]
+
+
+def block_header(serialized):
+    """ everything in a serialized block but its transactions """
+    return {"previous_block_hash": serialized["previous_block_hash"],
+            "timestamp": serialized["timestamp"],
+            "nonce": serialized["nonce"],
+            "difficulty": serialized.get("difficulty", DEFAULT_DIFFICULTY)}
+
+
+def block_of(header, transactions, block_hash):
+    """ put a serialized block back together from its header """
+    return {"transactions": transactions,
+            "previous_block_hash": header["previous_block_hash"],
+            "timestamp": header["timestamp"],
+            "nonce": header["nonce"],
+            "difficulty": header.get("difficulty", DEFAULT_DIFFICULTY),
+            "hash": block_hash}
+
+
+# a node syncing with the tracker describes its chain by the hashes of
+# the blocks at these heights: the last few, then ever further apart down
+# to the genesis block, so that the point where two chains part can be
+# found to within a few blocks from a handful of hashes.
+LOCATOR_DENSE = 8
+
+
+def locator_heights(height):
+    heights = []
+    h = height - 1
+    step = 1
+    while h > 0:
+        heights.append(h)
+        if len(heights) >= LOCATOR_DENSE:
+            step *= 2
+        h -= step
+
+    if height > 0:
+        heights.append(0)
+    return heights
+
+
+def new_transaction(sender, receiver, amount):
+    # the nonce keeps two otherwise identical
+    # transactions from sharing an identifier
+    return {'sender': sender,
+            'receiver': receiver,
+            'amount': amount,
+            'nonce': getrandbits(63)}
+
+
+def difficulty_target(difficulty):
+    # a hash meets the difficulty when its first `difficulty` hex digits
+    # are zero, i.e. when the raw digest is below 2^(256 - 4 * difficulty)
+    return (1 << (256 - 4 * difficulty)).to_bytes(32, byteorder='big')
+
+
+# the header of a block minus its nonce and difficulty. the rest of the
+# header is fed into a hash state once, and each nonce attempt only has
+# to copy that state and append the last 12 bytes, however many
+# transactions the block holds.
+class BlockTemplate:
+    def __init__(self, block):
+        self.previous = previous_digest(block.previous_block_hash)
+        self.timestamp = timestamp_micros(block.timestamp)
+        self.difficulty = block.difficulty
+        self.tree = MerkleTree(transaction_digest(t)
+                               for t in block.transactions)
+        self.__prepare()
+
+    def __prepare(self):
+        self.prefix = HEADER_PREFIX.pack(self.previous, self.tree.root(),
+                                         self.timestamp)
+        self.state = sha256(self.prefix)
+
+    def add(self, transaction):
+        """ append a transaction, rehashing only its path to the root """
+        self.tree.append(transaction_digest(transaction))
+        self.__prepare()
+
+    # hash objects can't be pickled, so only ship the
+    # prefix to worker processes and rebuild the state there
+    def __getstate__(self):
+        return {"prefix": self.prefix, "difficulty": self.difficulty}
+
+    def __setstate__(self, state):
+        self.prefix = state["prefix"]
+        self.difficulty = state["difficulty"]
+        self.state = sha256(self.prefix)
+
+    def hash(self, nonce):
+        h = self.state.copy()
+        h.update(HEADER_TAIL.pack(nonce, self.difficulty))
+        return h
 
 
 class Blockchain:
-    def __init__(self, blocks, unconfirmed):
+    def __init__(self, blocks, unconfirmed, store=None):
         self.blocks = blocks
-        self.unconfirmed = unconfirmed
+        # the transactions waiting for a block, see mempool.Mempool
+        self.unconfirmed = Mempool()
+        # the store.BlockStore that blocks are kept in, if any
+        self.store = store
+        # held while the blocks, the balances or the unconfirmed
+        # transactions change, so that a transaction is always checked
+        # against balances and commitments that add up
+        self.lock = RLock()
+        self.__rebuild_index()
+        self.hold(unconfirmed)
+
+        self.closing = Event()
+        if store is not None and store.sync_interval > 0:
+            Thread(target=self.__sync_idle, args=(), daemon=True).start()
 
     @classmethod
-    def by_tracker(cls, initial_balance):
-        return cls(*Blockchain.get_genesis_block_list(initial_balance))
+    def by_tracker(cls, initial_balance, store=None):
+        if store is None:
+            return cls(*Blockchain.get_genesis_block_list(initial_balance))
+
+        # a store that already holds a chain carries on with it
+        chain = cls.by_store(store)
+        if not chain.blocks:
+            blocks, _ = Blockchain.get_genesis_block_list(initial_balance)
+            for block in blocks:
+                chain.add_block(block)
+        return chain
 
     @classmethod
-    def by_serialized(cls, serialized_chain):
-        return cls(*Blockchain.deserialize_chain(serialized_chain))
+    def by_serialized(cls, serialized_chain, store=None):
+        blocks, unconfirmed = Blockchain.deserialize_chain(serialized_chain)
+        if store is None:
+            return cls(blocks, unconfirmed)
+
+        # only the blocks that the store doesn't already have are written
+        chain = cls.by_store(store)
+        chain.adopt(blocks)
+        chain.hold(unconfirmed)
+        return chain
+
+    @classmethod
+    def by_store(cls, store):
+        return cls(store.blocks(Block.deserialize), [], store)
+
+    @classmethod
+    def by_sync(cls, store=None):
+        """ the chain a node has before it syncs with the tracker """
+        if store is None:
+            return cls([], [])
+        return cls.by_store(store)
 
     @staticmethod
     def get_genesis_block_list(initial_balance):
@@ -54,10 +427,7 @@ class Blockchain:
     def deserialize_chain(serialized_chain):
         blocks = []
         for b in serialized_chain["blocks"]:
-            trans = b["transactions"]
-            h = b["previous_block_hash"]
-            t = util.deserialize_timestamp(b["timestamp"])
-            blocks.append(Block(trans, h, t))
+            blocks.append(Block.deserialize(b))
         return (blocks, serialized_chain["unconfirmed"])
 
     def serialize_blocks(self):
@@ -67,38 +437,216 @@ class Blockchain:
         return serialized_blocks
 
     def serialize(self):
-        return {"blocks": self.serialize_blocks(),
-                "unconfirmed": self.unconfirmed}
+        with self.lock:
+            return {"blocks": self.serialize_blocks(),
+                    "unconfirmed": list(self.unconfirmed)}
+
+    def __rebuild_index(self):
+        # the height of each block by its hash. a store keeps its own.
+        self.heights = {}
+        if not self.store:
+            for height, block in enumerate(self.blocks):
+                self.heights[block.hexdigest()] = height
+
+        # the genesis transaction credits every account, so rather than
+        # tracking it per account it is kept as a single running total
+        self.genesis_credit = 0
+        # net change to each account from the confirmed blocks
+        self.balances = {}
+
+        # a store remembers the balances as of some height,
+        # so only the blocks after that have to be read
+        start = 0
+        checkpoint = self.store.checkpoint() if self.store else None
+        if checkpoint and checkpoint["height"] <= len(self.blocks):
+            start = checkpoint["height"]
+            self.genesis_credit = checkpoint["genesis_credit"]
+            self.balances = dict((ident, amount) for ident, amount
+                                 in checkpoint["balances"])
+
+        for height in range(start, len(self.blocks)):
+            self.__apply_block(self.blocks[height], 1)
+
+    def __apply_block(self, block, sign):
+        for sender, receiver, amount in transfers(block.transactions):
+            amount = sign * amount
+
+            if sender == GENESIS_IDENT and receiver == GENESIS_IDENT:
+                self.genesis_credit += amount
+            elif sender != receiver:
+                self.balances[sender] = self.balances.get(sender, 0) - amount
+                self.balances[receiver] = \
+                    self.balances.get(receiver, 0) + amount
+
+    def tip(self):
+        """ the hash that the next block must follow """
+        # the genesis block follows nothing
+        if not len(self.blocks):
+            return 0
+        return self.hash_at(len(self.blocks) - 1)
 
     def add_block(self, block):
-        self.blocks.append(block)
-        self.unconfirmed = []
+        """ put a block on top; False if it doesn't follow our newest """
+        with self.lock:
+            # a block from another branch only gets in by way of
+            # replace_blocks, once that branch is the longer one
+            if block.previous_block_hash != self.tip():
+                return False
+
+            synced = self.blocks.append(block)
+            if not self.store:
+                self.heights[block.hexdigest()] = len(self.blocks) - 1
+            self.__apply_block(block, 1)
+            self.__confirm(block)
+
+            # once the blocks are on disk, so are the balances they add up to
+            if synced:
+                self.__save_checkpoint()
+            return True
+
+    def __confirm(self, block):
+        if not len(self.unconfirmed):
+            return
+
+        # only the transactions in the block are done with
+        self.unconfirmed.remove(transaction_id(t) for t in block.transactions)
+
+        # the rest have to still add up, since the block may have spent
+        # the same money in transactions that we never saw
+        held = self.unconfirmed.items()
+        self.unconfirmed.clear()
+        for key, transaction in held:
+            if self.check_transaction_validity(transaction):
+                self.unconfirmed.add(key, transaction)
+
+    def __save_checkpoint(self):
+        self.store.save_checkpoint(len(self.blocks), self.genesis_credit,
+                                   self.balances)
+
+    def hash_at(self, height):
+        """ the hash of the block at a height """
+        if self.store:
+            return self.store.block_id(height)
+        return self.blocks[height].hexdigest()
+
+    def height(self, block_hash):
+        """ the height of the block with the given hash, if we have it """
+        if self.store:
+            return self.store.height(block_hash)
+        return self.heights.get(block_hash, None)
+
+    def locator(self):
+        """ the hashes that describe our chain, see locator_heights """
+        return [self.hash_at(h) for h in locator_heights(len(self.blocks))]
+
+    def common_height(self, height, locator):
+        """ how many blocks a chain with the given locator shares with ours """
+        for h, block_hash in zip(locator_heights(height), locator):
+            if self.height(block_hash) == h:
+                return h + 1
+        return 0
+
+    def serialize_range(self, start, count):
+        """ up to `count` serialized blocks, starting at height `start` """
+        start = max(start, 0)
+        end = min(start + count, len(self.blocks))
+        if self.store:
+            # straight from disk, without loading them as blocks
+            return [self.store.get(h) for h in range(start, end)]
+        return [self.blocks[h].serialize() for h in range(start, end)]
+
+    def adopt(self, blocks):
+        """ make our blocks match `blocks`, keeping those we agree on """
+        height = 0
+        common = min(len(self.blocks), len(blocks))
+        while height < common and self.hash_at(height) == \
+                blocks[height].hexdigest():
+            height += 1
+
+        self.replace_blocks(height, blocks[height:])
+
+    def __sync_idle(self):
+        # the store only syncs when a block is appended, so the last
+        # blocks of a burst, and the balances they add up to, would
+        # otherwise wait for a block that may be a long time coming
+        wait = self.store.sync_interval
+        while not self.closing.wait(wait):
+            with self.lock:
+                if self.store.closed:
+                    return
+                wait = self.store.sync_due()
+                if wait <= 0:
+                    self.store.flush()
+                    self.__save_checkpoint()
+                    wait = self.store.sync_interval
+
+    def close(self):
+        """ make sure everything is on disk """
+        self.closing.set()
+        with self.lock:
+            if self.store and not self.store.closed:
+                self.store.flush()
+                self.__save_checkpoint()
+                self.store.close()
+
+    def replace_blocks(self, height, blocks):
+        """ replace every block from `height` onwards with `blocks` """
+        with self.lock:
+            if height > len(self.blocks):
+                return not blocks
+
+            # nothing is dropped unless the new blocks all fit
+            previous = self.hash_at(height - 1) if height > 0 else 0
+            for block in blocks:
+                if block.previous_block_hash != previous:
+                    return False
+                previous = block.hexdigest()
+
+            while len(self.blocks) > height:
+                block = self.blocks.pop()
+                self.heights.pop(block.hexdigest(), None)
+                self.__apply_block(block, -1)
+
+            for block in blocks:
+                self.add_block(block)
+            return True
+
+    def balance(self, ident):
+        """ confirmed balance of an account """
+        return self.genesis_credit + self.balances.get(ident, 0)
 
     def check_transaction_validity(self, tran2check):
         """ check blockchain to make sure transaction to be added is valid """
         sender = tran2check["sender"]
-        sender_balance = 0
 
-        for block in self.blocks:
-            for transaction in block.transactions:
-                tsender = transaction["sender"]
-                treceiver = transaction["receiver"]
-                amount = transaction["amount"]
+        # transactions still waiting for a block have already
+        # been promised, so they can't be spent a second time
+        available = self.balance(sender) - self.unconfirmed.committed(sender)
 
-                if tsender == GENESIS_IDENT and treceiver == GENESIS_IDENT:
-                    sender_balance += amount
-                elif tsender == sender:
-                    if treceiver != tsender:
-                        sender_balance -= amount
-                elif treceiver == sender:
-                    sender_balance += amount
+        return available >= tran2check["amount"]
 
-        return sender_balance >= tran2check["amount"]
+    def hold(self, transactions):
+        """ take on unconfirmed transactions that were already checked """
+        with self.lock:
+            for transaction in transactions:
+                self.unconfirmed.add(transaction_id(transaction), transaction)
 
     def add_unconfirmed_transaction(self, transaction):
-        valid = self.check_transaction_validity(transaction)
+        key = transaction_id(transaction)
+        with self.lock:
+            if key in self.unconfirmed:
+                # nothing wrong with it, we just have it already
+                return True
+
+            valid = self.check_transaction_validity(transaction)
 
-        if valid:
-            self.unconfirmed.append(transaction)
+            if valid:
+                self.unconfirmed.add(key, transaction)
 
         return valid
+
+    def add_unconfirmed_transactions(self, transactions):
+        """ add a batch of transactions; returns the ones that were invalid """
+        with self.lock:
+            return [t for t in transactions
+                    if not self.add_unconfirmed_transaction(t)]
@@ -0,0 +1,127 @@
+from .blockchain import GENESIS_IDENT, Transactions, transfers
+
+# numpy makes auditing a long chain fast, but isn't required
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# accounts are looked up by identifier directly, rather than sorted,
+# while the identifiers span at most this many times as many values as
+# there are transfers
+DENSE_SPAN = 4
+
+
+# the balance of every account, worked out from the blocks alone rather
+# than from a chain's running index. everyone starts with the genesis
+# credit, so it is returned separately along with the net change to each
+# account that appears in the blocks.
+def balances(blocks):
+    """ (genesis credit, {ident: balance}) as of the given blocks """
+    # the chain may grow while we read it
+    blocks = [blocks[h] for h in range(len(blocks))]
+
+    if np is not None:
+        try:
+            return __balances_numpy(blocks)
+        except OverflowError:
+            # some amount, or some total, doesn't fit in 64 bits
+            pass
+
+    return __balances_python(blocks)
+
+
+def __balances_python(blocks):
+    credit = 0
+    net = {}
+    for block in blocks:
+        for sender, receiver, amount in transfers(block.transactions):
+            if sender == GENESIS_IDENT and receiver == GENESIS_IDENT:
+                credit += amount
+            elif sender != receiver:
+                net[sender] = net.get(sender, 0) - amount
+                net[receiver] = net.get(receiver, 0) + amount
+
+    net.pop(GENESIS_IDENT, None)
+    return credit, dict((i, credit + n) for i, n in net.items())
+
+
+def __column(values):
+    # arrays of transactions are used in place, without a copy
+    return np.frombuffer(values, dtype=np.int64)
+
+
+def __columns(blocks):
+    senders = []
+    receivers = []
+    amounts = []
+
+    for block in blocks:
+        t = block.transactions
+        if isinstance(t, Transactions):
+            senders.append(__column(t.senders))
+            receivers.append(__column(t.receivers))
+            amounts.append(__column(t.amounts))
+        elif len(t) > 0:
+            s, r, a = zip(*transfers(t))
+            senders.append(np.array(s, dtype=np.int64))
+            receivers.append(np.array(r, dtype=np.int64))
+            amounts.append(np.array(a, dtype=np.int64))
+
+    if not senders:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    return (np.concatenate(senders),
+            np.concatenate(receivers),
+            np.concatenate(amounts))
+
+
+def __balances_numpy(blocks):
+    senders, receivers, amounts = __columns(blocks)
+
+    # numpy wraps around rather than raising when a sum overflows, so
+    # make sure that no total can come to more than 64 bits hold
+    if len(amounts) and \
+       max(int(amounts.max()), -int(amounts.min())) * len(amounts) >= 1 << 63:
+        raise OverflowError("amounts may overflow 64 bits")
+
+    # the genesis transaction credits every account at once
+    genesis = (senders == GENESIS_IDENT) & (receivers == GENESIS_IDENT)
+    credit = int(amounts[genesis].sum())
+
+    # sending to yourself changes nothing
+    moved = ~genesis & (senders != receivers)
+    senders = senders[moved]
+    receivers = receivers[moved]
+    amounts = amounts[moved]
+
+    accounts = np.concatenate((senders, receivers))
+    if len(accounts) == 0:
+        return credit, {}
+
+    # identifiers are handed out in order, so they can usually index an
+    # array directly. otherwise they are numbered 0..n first, which
+    # means sorting them.
+    low = int(accounts.min())
+    span = int(accounts.max()) - low + 1
+    if span <= DENSE_SPAN * len(accounts):
+        index = accounts - low
+        present = np.zeros(span, dtype=bool)
+        present[index] = True
+        idents = np.flatnonzero(present) + low
+    else:
+        idents, index = np.unique(accounts, return_inverse=True)
+        present = None
+
+    # total up what each account sent and received
+    net = np.zeros(span if present is not None else len(idents),
+                   dtype=np.int64)
+    np.subtract.at(net, index[:len(senders)], amounts)
+    np.add.at(net, index[len(senders):], amounts)
+    if present is not None:
+        net = net[present]
+
+    return credit, dict((int(i), credit + int(n))
+                        for i, n in zip(idents, net)
+                        if i != GENESIS_IDENT)
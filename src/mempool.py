@@ -0,0 +1,107 @@
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+# most transactions held at once, and roughly how much memory they may
+# take up between them
+DEFAULT_SIZE = 50000
+DEFAULT_BYTES = 64 * 1024 * 1024
+
+
+def footprint(transaction):
+    """ roughly how many bytes a transaction takes up in memory """
+    return sys.getsizeof(transaction) + \
+        sum(sys.getsizeof(v) for v in transaction.values())
+
+
+# the unconfirmed transactions, by identifier, in the order they came.
+# along with them it keeps how much each account has committed, so
+# that the same money can't be promised twice. once it holds `size`
+# transactions or `max_bytes` worth, the oldest are evicted first.
+class Mempool:
+    def __init__(self, size=DEFAULT_SIZE, max_bytes=DEFAULT_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.transactions = OrderedDict()
+        self.bytes = 0
+        self.pending = {}
+        self.lock = Lock()
+
+    def limit(self, size, max_bytes=DEFAULT_BYTES):
+        """ change the caps, evicting whatever no longer fits """
+        with self.lock:
+            self.size = size
+            self.max_bytes = max_bytes
+            self.__evict()
+
+    def add(self, key, transaction):
+        """ hold a transaction; False if it was already held """
+        with self.lock:
+            if key in self.transactions:
+                return False
+
+            self.transactions[key] = transaction
+            self.bytes += footprint(transaction)
+            self.__commit(transaction, 1)
+            self.__evict()
+            return True
+
+    def remove(self, keys):
+        """ forget the transactions with the given identifiers """
+        with self.lock:
+            for key in keys:
+                transaction = self.transactions.pop(key, None)
+                if transaction is not None:
+                    self.__forget(transaction)
+
+    def clear(self):
+        with self.lock:
+            self.transactions = OrderedDict()
+            self.bytes = 0
+            self.pending = {}
+
+    def committed(self, sender):
+        """ how much an account has promised in held transactions """
+        with self.lock:
+            return self.pending.get(sender, 0)
+
+    def __commit(self, transaction, sign):
+        sender = transaction["sender"]
+        if sender != transaction["receiver"]:
+            self.pending[sender] = \
+                self.pending.get(sender, 0) + sign * transaction["amount"]
+            if not self.pending[sender]:
+                del self.pending[sender]
+
+    def __forget(self, transaction):
+        self.bytes -= footprint(transaction)
+        self.__commit(transaction, -1)
+
+    def __evict(self):
+        while self.transactions and \
+              (len(self.transactions) > self.size or
+               self.bytes > self.max_bytes):
+            _, transaction = self.transactions.popitem(last=False)
+            self.__forget(transaction)
+
+    def items(self):
+        """ (identifier, transaction) for each held transaction, in order """
+        with self.lock:
+            return list(self.transactions.items())
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.transactions.get(key, default)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.transactions
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        # a snapshot, since other threads may add to it meanwhile
+        with self.lock:
+            transactions = list(self.transactions.values())
+        return iter(transactions)
@@ -1,6 +1,10 @@
 import json
+import asyncio
+from hashlib import sha256
+from threading import Lock
+from weakref import WeakKeyDictionary
 from enum import IntEnum, auto
-from . import pkc
+from . import pkc, binary
 
 
 class Kind(IntEnum):
@@ -57,6 +61,185 @@ class Kind(IntEnum):
     # peer sends a block to another peer
     PEER_BLOCK = auto()
 
+    # peer sends several transactions to another peer at once
+    PEER_TRANSACTIONS = auto()
+
+    # peer announces the transactions and blocks it has
+    PEER_INV = auto()
+
+    # peer asks for announced transactions and blocks it doesn't have
+    PEER_GETDATA = auto()
+
+    # peer sends a block as its header and the short
+    # identifiers of its transactions
+    PEER_COMPACT_BLOCK = auto()
+
+    # peer asks for the transactions of a compact
+    # block that it couldn't find among its own
+    PEER_GETBLOCKTXN = auto()
+
+    # peer sends the transactions asked for
+    PEER_BLOCKTXN = auto()
+
+    # tracker tells a node how long its chain is and how much
+    # of it the node already has, rather than sending all of it
+    TRACKER_SYNC = auto()
+
+    # node asks the tracker or a peer for a range of blocks
+    SYNC_GET_BLOCKS = auto()
+
+    # tracker or peer sends a range of blocks
+    SYNC_BLOCKS = auto()
+
+    # node asks the tracker for every block from some height on
+    SYNC_GET_CHAIN = auto()
+
+    # tracker sends the next chunk of the blocks asked for
+    SYNC_CHUNK = auto()
+
+    # tracker has sent every chunk
+    SYNC_END = auto()
+
+
+# how a message is encoded on the wire. JSON is always understood,
+# the binary codec is only used once both ends have said they support it.
+class Codec(IntEnum):
+    JSON = auto()
+    BINARY = auto()
+
+
+# blocks carry their hash in the binary schema since version 2
+FEATURE_BINARY = "binary2"
+# sessions without salts reused their keys, so the name changed with them
+FEATURE_SESSION = "session2"
+FEATURE_BATCH = "batch"
+FEATURE_GOSSIP = "gossip"
+FEATURE_COMPACT = "compact"
+FEATURE_SYNC = "sync"
+FEATURE_STREAM = "stream"
+
+# optional protocol features this implementation supports. they are
+# exchanged in NODE_KEYS/TRACKER_IDENT and PEER_IDENT/PEER_VERIFY.
+FEATURES = [FEATURE_BINARY,
+            FEATURE_SESSION,
+            FEATURE_BATCH,
+            FEATURE_GOSSIP,
+            FEATURE_COMPACT,
+            FEATURE_SYNC,
+            FEATURE_STREAM]
+
+# the most blocks sent in answer to a single SYNC_GET_BLOCKS
+SYNC_RANGE = 128
+
+
+def supports(features, feature):
+    # `features` are what the other end advertised, if anything
+    return bool(features) and feature in features and feature in FEATURES
+
+
+def negotiate_codec(features):
+    if supports(features, FEATURE_BINARY):
+        return Codec.BINARY
+    return Codec.JSON
+
+
+def negotiate_session(features, key_pair, public_key, salt, their_salt):
+    """ the session to switch to once the handshake is done, if any """
+    # `their_salt` is as the other end sent it, if it sent one
+    if supports(features, FEATURE_SESSION) and their_salt:
+        return pkc.Session(key_pair, public_key, salt,
+                           bytes.fromhex(their_salt))
+    return None
+
+
+def sync_blocks(chain, request):
+    """ the answer to a SYNC_GET_BLOCKS, from a blockchain.Blockchain """
+    count = min(request["count"], SYNC_RANGE)
+    return SyncBlocks(request["start"], len(chain.blocks),
+                      chain.serialize_range(request["start"], count))
+
+
+def stream_chain(chain, start):
+    """ the messages that stream a blockchain.Blockchain from `start` """
+    # only one chunk is built at a time, and the stream stops at
+    # however long the chain was when it started
+    height = len(chain.blocks)
+    digest = sha256()
+    seq = 0
+
+    for first in range(start, height, SYNC_RANGE):
+        count = min(SYNC_RANGE, height - first)
+        for h in range(first, first + count):
+            digest.update(chain.hash_at(h).encode())
+
+        yield SyncChunk(seq, chain.serialize_range(first, count))
+        seq += 1
+
+    yield SyncEnd(seq, height, digest.hexdigest())
+
+
+# follows a stream of chunks as they arrive, making sure that none went
+# missing or came out of order, and that the blocks add up to the digest
+class ChainStream:
+    def __init__(self):
+        self.seq = 0
+        self.digest = sha256()
+
+    def chunk(self, msg):
+        """ the serialized blocks of the next chunk """
+        if msg.msg["seq"] != self.seq:
+            raise ValueError
+        self.seq += 1
+        return msg.msg["blocks"]
+
+    def add(self, block_hash):
+        self.digest.update(block_hash.encode())
+
+    def end(self, msg):
+        if msg.msg["chunks"] != self.seq or \
+           msg.msg["digest"] != self.digest.hexdigest():
+            raise ValueError
+
+
+binary.schema(Kind.NODE_KEYS, [("public_key", "key"),
+                               ("verify_key", "key")])
+binary.schema(Kind.TRACKER_IDENT, [("ident", "int"),
+                                   ("public_key", "key"),
+                                   ("verify_key", "key")])
+binary.schema(Kind.TRACKER_CHAIN, [("blockchain", "chain")])
+binary.schema(Kind.NODE_PORT, [("port", "int")])
+binary.schema(Kind.TRACKER_PEERS, [("peers", "peers")])
+binary.schema(Kind.PEER_IDENT, [("ident", "int")])
+binary.schema(Kind.TRACKER_NEW_PEER, [("peer", "peer")])
+binary.schema(Kind.PEER_TRANSACTION, [("transaction", "tx")])
+binary.schema(Kind.PEER_BLOCK, [("block", "block")])
+binary.schema(Kind.PEER_TRANSACTIONS, [("transactions", "txs")])
+binary.schema(Kind.PEER_INV, [("transactions", "hashes"),
+                              ("blocks", "hashes")])
+binary.schema(Kind.PEER_GETDATA, [("transactions", "hashes"),
+                                  ("blocks", "hashes")])
+binary.schema(Kind.PEER_COMPACT_BLOCK, [("block", "hash"),
+                                        ("header", "header"),
+                                        ("short_ids", "short_ids")])
+binary.schema(Kind.PEER_GETBLOCKTXN, [("block", "hash"),
+                                      ("indexes", "ints")])
+binary.schema(Kind.PEER_BLOCKTXN, [("block", "hash"),
+                                   ("transactions", "txs")])
+binary.schema(Kind.TRACKER_SYNC, [("height", "int"),
+                                  ("common", "int"),
+                                  ("unconfirmed", "txs")])
+binary.schema(Kind.SYNC_GET_BLOCKS, [("start", "int"),
+                                     ("count", "int")])
+binary.schema(Kind.SYNC_BLOCKS, [("start", "int"),
+                                 ("height", "int"),
+                                 ("blocks", "blocks")])
+binary.schema(Kind.SYNC_GET_CHAIN, [("start", "int")])
+binary.schema(Kind.SYNC_CHUNK, [("seq", "int"),
+                                ("blocks", "blocks")])
+binary.schema(Kind.SYNC_END, [("chunks", "int"),
+                              ("height", "int"),
+                              ("digest", "hash")])
+
 
 # a JSON-serializable message
 class Message:
@@ -67,42 +250,75 @@ class Message:
     def to_string(self):
         return json.dumps(self.msg)
 
-    def send(self, sock, enc=None):
-        data = bytearray(self.to_string().encode())
+    def to_bytes(self, codec=Codec.JSON):
+        if codec == Codec.BINARY:
+            return binary.encode(self.msg)
+        return self.to_string().encode()
 
-        if enc:
-            data = bytes(data)
+    def encode(self, enc=None, codec=Codec.JSON):
+        data = self.to_bytes(codec)
+
+        if isinstance(enc, pkc.Session):
+            # one symmetric seal for an established session
+            data = enc.seal(data)
+        elif enc:
             # encrypt the message, also providing the receiver's public key
             data = enc[1].encrypt(data, enc[0])
             # sign the message with our signing key
             data = enc[1].sign(data)
-            data = bytearray(data)
 
-        # prepend the length of the message as a big-endian 32-bit number
-        # generally speaking, the length is not confidential
-        mlen = len(data).to_bytes(4, byteorder='big')
-        data = mlen + data
-        sock.send(data)
+        return data
+
+    def send(self, sock, enc=None, codec=Codec.JSON):
+        framer(sock).send_frame(self.encode(enc, codec))
+
+    async def send_async(self, writer, enc=None, codec=Codec.JSON):
+        # encryption and signing are pushed to the default executor
+        # so that they don't hold up the event loop. sealing with a
+        # session is cheap enough to do right here.
+        if enc and not isinstance(enc, pkc.Session):
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(None, self.encode, enc, codec)
+        else:
+            data = self.encode(enc, codec)
+
+        writer.writelines((header(data), data))
+        await writer.drain()
 
 
 class NodeKeys(Message):
-    def __init__(self, public_key, verify_key):
+    def __init__(self, public_key, verify_key, features=None):
         super().__init__(Kind.NODE_KEYS)
         self.msg["public_key"] = public_key
         self.msg["verify_key"] = verify_key
+        if features is not None:
+            self.msg["features"] = features
 
 
 class TrackerIdent(Message):
-    def __init__(self, ident, public_key, verify_key):
+    def __init__(self, ident, public_key, verify_key, features=None,
+                 salt=None):
         super().__init__(Kind.TRACKER_IDENT)
         self.msg["ident"] = ident
         self.msg["public_key"] = public_key
         self.msg["verify_key"] = verify_key
+        if features is not None:
+            self.msg["features"] = features
+        # the tracker's half of the session salt
+        if salt is not None:
+            self.msg["salt"] = salt.hex()
 
 
 class NodeIdent(Message):
-    def __init__(self):
+    def __init__(self, height=None, locator=None, salt=None):
         super().__init__(Kind.NODE_IDENT)
+        # a node that syncs says how much of the chain it already has
+        if height is not None:
+            self.msg["height"] = height
+            self.msg["locator"] = locator
+        # the node's half of the session salt
+        if salt is not None:
+            self.msg["salt"] = salt.hex()
 
 
 class TrackerChain(Message):
@@ -129,14 +345,21 @@ class TrackerPeers(Message):
 
 
 class PeerIdent(Message):
-    def __init__(self, ident):
+    def __init__(self, ident, features=None):
         super().__init__(Kind.PEER_IDENT)
         self.msg["ident"] = ident
+        if features is not None:
+            self.msg["features"] = features
 
 
 class PeerVerify(Message):
-    def __init__(self):
+    def __init__(self, features=None, salt=None):
         super().__init__(Kind.PEER_VERIFY)
+        if features is not None:
+            self.msg["features"] = features
+        # each peer sends its half of the session salt
+        if salt is not None:
+            self.msg["salt"] = salt.hex()
 
 
 class PeerAccept(Message):
@@ -150,9 +373,13 @@ class TrackerAccept(Message):
 
 
 class TrackerNewPeer(Message):
-    def __init__(self, peer):
+    def __init__(self, peer, connect=False):
         super().__init__(Kind.TRACKER_NEW_PEER)
         self.msg["peer"] = peer
+        # the receiver connects to the peer itself,
+        # rather than waiting for the peer to connect to it
+        if connect:
+            self.msg["connect"] = True
 
 
 class NodePeers(Message):
@@ -177,16 +404,110 @@ class PeerBlock(Message):
         self.msg["block"] = block
 
 
+class PeerTransactions(Message):
+    def __init__(self, transactions):
+        super().__init__(Kind.PEER_TRANSACTIONS)
+        self.msg["transactions"] = transactions
+
+
+class PeerInv(Message):
+    def __init__(self, transactions=(), blocks=()):
+        super().__init__(Kind.PEER_INV)
+        self.msg["transactions"] = list(transactions)
+        self.msg["blocks"] = list(blocks)
+
+
+class PeerGetData(Message):
+    def __init__(self, transactions=(), blocks=()):
+        super().__init__(Kind.PEER_GETDATA)
+        self.msg["transactions"] = list(transactions)
+        self.msg["blocks"] = list(blocks)
+
+
+class PeerCompactBlock(Message):
+    def __init__(self, block, header, short_ids):
+        super().__init__(Kind.PEER_COMPACT_BLOCK)
+        self.msg["block"] = block
+        self.msg["header"] = header
+        self.msg["short_ids"] = short_ids
+
+
+class PeerGetBlockTxn(Message):
+    def __init__(self, block, indexes):
+        super().__init__(Kind.PEER_GETBLOCKTXN)
+        self.msg["block"] = block
+        self.msg["indexes"] = indexes
+
+
+class PeerBlockTxn(Message):
+    def __init__(self, block, transactions):
+        super().__init__(Kind.PEER_BLOCKTXN)
+        self.msg["block"] = block
+        self.msg["transactions"] = transactions
+
+
+class TrackerSync(Message):
+    def __init__(self, height, common, unconfirmed):
+        super().__init__(Kind.TRACKER_SYNC)
+        self.msg["height"] = height
+        self.msg["common"] = common
+        self.msg["unconfirmed"] = unconfirmed
+
+
+class SyncGetBlocks(Message):
+    def __init__(self, start, count=SYNC_RANGE):
+        super().__init__(Kind.SYNC_GET_BLOCKS)
+        self.msg["start"] = start
+        self.msg["count"] = count
+
+
+class SyncBlocks(Message):
+    def __init__(self, start, height, blocks):
+        super().__init__(Kind.SYNC_BLOCKS)
+        self.msg["start"] = start
+        # how long the sender's chain is
+        self.msg["height"] = height
+        self.msg["blocks"] = blocks
+
+
+class SyncGetChain(Message):
+    def __init__(self, start):
+        super().__init__(Kind.SYNC_GET_CHAIN)
+        self.msg["start"] = start
+
+
+class SyncChunk(Message):
+    def __init__(self, seq, blocks):
+        super().__init__(Kind.SYNC_CHUNK)
+        self.msg["seq"] = seq
+        self.msg["blocks"] = blocks
+
+
+class SyncEnd(Message):
+    def __init__(self, chunks, height, digest):
+        super().__init__(Kind.SYNC_END)
+        self.msg["chunks"] = chunks
+        self.msg["height"] = height
+        # of the hashes of every block sent, in order
+        self.msg["digest"] = digest
+
+
+def __salt(j):
+    salt = j.get("salt")
+    return bytes.fromhex(salt) if salt is not None else None
+
+
 def __node_keys(j):
-    return NodeKeys(j["public_key"], j["verify_key"])
+    return NodeKeys(j["public_key"], j["verify_key"], j.get("features"))
 
 
 def __tracker_ident(j):
-    return TrackerIdent(j["ident"], j["public_key"], j["verify_key"])
+    return TrackerIdent(j["ident"], j["public_key"], j["verify_key"],
+                        j.get("features"), __salt(j))
 
 
 def __node_ident(j):
-    return NodeIdent()
+    return NodeIdent(j.get("height"), j.get("locator"), __salt(j))
 
 
 def __node_port(j):
@@ -202,7 +523,7 @@ def __tracker_peers(j):
 
 
 def __peer_ident(j):
-    return PeerIdent(j["ident"])
+    return PeerIdent(j["ident"], j.get("features"))
 
 
 def __peer_accept(j):
@@ -210,7 +531,7 @@ def __peer_accept(j):
 
 
 def __peer_verify(j):
-    return PeerVerify()
+    return PeerVerify(j.get("features"), __salt(j))
 
 
 def __tracker_accept(j):
@@ -218,7 +539,7 @@ def __tracker_accept(j):
 
 
 def __tracker_new_peer(j):
-    return TrackerNewPeer(j["peer"])
+    return TrackerNewPeer(j["peer"], j.get("connect", False))
 
 
 def __node_peers(j):
@@ -241,77 +562,263 @@ def __peer_block(j):
     return PeerBlock(j["block"])
 
 
+def __peer_transactions(j):
+    return PeerTransactions(j["transactions"])
+
+
+def __peer_inv(j):
+    return PeerInv(j["transactions"], j["blocks"])
+
+
+def __peer_getdata(j):
+    return PeerGetData(j["transactions"], j["blocks"])
+
+
+def __peer_compact_block(j):
+    return PeerCompactBlock(j["block"], j["header"], j["short_ids"])
+
+
+def __peer_getblocktxn(j):
+    return PeerGetBlockTxn(j["block"], j["indexes"])
+
+
+def __peer_blocktxn(j):
+    return PeerBlockTxn(j["block"], j["transactions"])
+
+
+def __tracker_sync(j):
+    return TrackerSync(j["height"], j["common"], j["unconfirmed"])
+
+
+def __sync_get_blocks(j):
+    return SyncGetBlocks(j["start"], j["count"])
+
+
+def __sync_blocks(j):
+    return SyncBlocks(j["start"], j["height"], j["blocks"])
+
+
+def __sync_get_chain(j):
+    return SyncGetChain(j["start"])
+
+
+def __sync_chunk(j):
+    return SyncChunk(j["seq"], j["blocks"])
+
+
+def __sync_end(j):
+    return SyncEnd(j["chunks"], j["height"], j["digest"])
+
+
+PARSERS = {Kind.NODE_KEYS: __node_keys,
+           Kind.TRACKER_IDENT: __tracker_ident,
+           Kind.NODE_IDENT: __node_ident,
+           Kind.NODE_PORT: __node_port,
+           Kind.NODE_LISTEN: __node_listen,
+           Kind.TRACKER_PEERS: __tracker_peers,
+           Kind.PEER_IDENT: __peer_ident,
+           Kind.PEER_VERIFY: __peer_verify,
+           Kind.PEER_ACCEPT: __peer_accept,
+           Kind.TRACKER_ACCEPT: __tracker_accept,
+           Kind.TRACKER_NEW_PEER: __tracker_new_peer,
+           Kind.NODE_PEERS: __node_peers,
+           Kind.NODE_DISCONNECT: __node_disconnect,
+           Kind.TRACKER_CHAIN: __tracker_chain,
+           Kind.PEER_TRANSACTION: __peer_transaction,
+           Kind.PEER_BLOCK: __peer_block,
+           Kind.PEER_TRANSACTIONS: __peer_transactions,
+           Kind.PEER_INV: __peer_inv,
+           Kind.PEER_GETDATA: __peer_getdata,
+           Kind.PEER_COMPACT_BLOCK: __peer_compact_block,
+           Kind.PEER_GETBLOCKTXN: __peer_getblocktxn,
+           Kind.PEER_BLOCKTXN: __peer_blocktxn,
+           Kind.TRACKER_SYNC: __tracker_sync,
+           Kind.SYNC_GET_BLOCKS: __sync_get_blocks,
+           Kind.SYNC_BLOCKS: __sync_blocks,
+           Kind.SYNC_GET_CHAIN: __sync_get_chain,
+           Kind.SYNC_CHUNK: __sync_chunk,
+           Kind.SYNC_END: __sync_end}
+
+
+def of_dict(j):
+    try:
+        return PARSERS[j["kind"]](j)
+    except Exception:
+        return None
+
+
 def of_string(s):
     try:
         j = json.loads(s)
-        k = j["kind"]
     except Exception:
         return None
 
-    msgs = {Kind.NODE_KEYS: __node_keys,
-            Kind.TRACKER_IDENT: __tracker_ident,
-            Kind.NODE_IDENT: __node_ident,
-            Kind.NODE_PORT: __node_port,
-            Kind.NODE_LISTEN: __node_listen,
-            Kind.TRACKER_PEERS: __tracker_peers,
-            Kind.PEER_IDENT: __peer_ident,
-            Kind.PEER_VERIFY: __peer_verify,
-            Kind.PEER_ACCEPT: __peer_accept,
-            Kind.TRACKER_ACCEPT: __tracker_accept,
-            Kind.TRACKER_NEW_PEER: __tracker_new_peer,
-            Kind.NODE_PEERS: __node_peers,
-            Kind.NODE_DISCONNECT: __node_disconnect,
-            Kind.TRACKER_CHAIN: __tracker_chain,
-            Kind.PEER_TRANSACTION: __peer_transaction,
-            Kind.PEER_BLOCK: __peer_block}
+    return of_dict(j)
+
+
+def of_bytes(data):
+    # binary messages are recognizable by their first byte,
+    # so we never need to be told which codec was used
+    if binary.is_binary(data):
+        try:
+            j = binary.decode(data)
+        except Exception:
+            return None
+        return of_dict(j)
 
     try:
-        return msgs[k](j)
-    except Exception:
+        return of_string(str(data, 'utf-8'))
+    except UnicodeDecodeError:
         return None
 
 
 DEFAULT_RECV = 4096
 
+HEADER_SIZE = 4
+
+
+def header(data):
+    # the length of the message as a big-endian 32-bit number
+    # generally speaking, the length is not confidential
+    return len(data).to_bytes(HEADER_SIZE, byteorder='big')
+
+
+# reads and writes length-prefixed frames on a socket. frames are read
+# straight into a reusable buffer, and whatever arrives past the end of
+# one frame is kept for the next.
+class Framer:
+    def __init__(self, sock, size=DEFAULT_RECV):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # unread data is buf[start:end]
+        self.start = 0
+        self.end = 0
+        self.send_lock = Lock()
+
+    def __fill(self, n):
+        # make sure that at least n unread bytes are buffered
+        if self.start + n > len(self.buf):
+            unread = self.end - self.start
+            if n > len(self.buf):
+                # too big for the buffer, so replace it. the old one may
+                # still be referenced by the frame that was last returned.
+                buf = bytearray(max(n, 2 * len(self.buf)))
+                buf[:unread] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.buf[:unread] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = unread
+
+        while self.end - self.start < n:
+            got = self.sock.recv_into(self.view[self.end:])
+            if not got:
+                raise ValueError
+            self.end += got
+
+    def recv_frame(self):
+        """ the next frame, which is only valid until the next call """
+        self.__fill(HEADER_SIZE)
+        size = int.from_bytes(self.view[self.start:self.start + HEADER_SIZE],
+                              'big')
+        self.start += HEADER_SIZE
+
+        if size == 0:
+            raise ValueError
 
-def recv(sock, enc=None):
-    data = bytearray()
-    size = None
-
-    while True:
-        if size is None:
-            packet = sock.recv(DEFAULT_RECV)
-        elif size <= 0:
-            break
-        else:
-            packet = sock.recv(size)
-
-        if not packet:
-            break
-        elif not data:
-            size = int.from_bytes(packet[0:4], 'big')
-            data.extend(packet[4:])
-            size -= len(data)
-        else:
-            data.extend(packet)
-            size -= len(packet)
+        self.__fill(size)
+        data = self.view[self.start:self.start + size]
+        self.start += size
 
-    if not data:
-        raise ValueError
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        return data
+
+    def send_frame(self, data):
+        h = header(data)
 
-    data = bytes(data)
+        # frames from different threads must not interleave
+        with self.send_lock:
+            if not hasattr(self.sock, "sendmsg"):
+                self.sock.sendall(h + data)
+                return
 
-    if enc:
+            sent = self.sock.sendmsg([h, data])
+            # pick up wherever a partial write left off
+            if sent < HEADER_SIZE:
+                self.sock.sendall(h[sent:])
+                self.sock.sendall(data)
+            elif sent < HEADER_SIZE + len(data):
+                self.sock.sendall(memoryview(data)[sent - HEADER_SIZE:])
+
+
+__framers = WeakKeyDictionary()
+__framers_lock = Lock()
+
+
+def framer(sock):
+    """ the framer belonging to a socket """
+    with __framers_lock:
+        f = __framers.get(sock, None)
+        if f is None:
+            f = __framers[sock] = Framer(sock)
+        return f
+
+
+def unseal(data, enc=None):
+    """ decode, leaving the replay check on a session to the caller """
+    counter = None
+    if isinstance(enc, pkc.Session):
+        try:
+            counter, data = enc.decrypt(data)
+        except Exception:
+            raise ValueError
+    elif enc:
         try:
             # verify the message with the sender's verify key
-            data = pkc.verify(data, enc[0])
+            data = pkc.verify(bytes(data), enc[0])
             # decrypt the message, providing the sender's public key
             data = enc[2].decrypt(data, enc[1])
         except Exception:
             # failed to verify/decrypt the message
             raise ValueError
 
+    return counter, of_bytes(data)
+
+
+def decode(data, enc=None):
+    counter, msg = unseal(data, enc)
+    if counter is not None:
+        enc.accept_counter(counter)
+    return msg
+
+
+def recv(sock, enc=None):
+    return decode(framer(sock).recv_frame(), enc)
+
+
+async def recv_frame_async(reader):
     try:
-        return of_string(data.decode())
-    except UnicodeDecodeError:
-        return None
+        size = int.from_bytes(await reader.readexactly(4), 'big')
+        data = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, OSError):
+        raise ValueError
+
+    if not data:
+        raise ValueError
+
+    return data
+
+
+async def recv_async(reader, enc=None):
+    data = await recv_frame_async(reader)
+
+    # verification and decryption are pushed to the default executor
+    if enc and not isinstance(enc, pkc.Session):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, decode, data, enc)
+
+    return decode(data, enc)
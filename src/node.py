@@ -1,15 +1,41 @@
+import time
 from queue import Queue
 from threading import Thread, Lock, Condition
-from . import blockchain, message, peer, util, pkc, proof_of_work
+from . import blockchain, message, peer, util, pkc, proof_of_work, pipeline
+from . import seen, store, mempool
+
+# how long to wait for the tracker to announce a peer
+# that is already trying to connect to us (seconds)
+ANNOUNCE_TIMEOUT = 5
+
+# how long to wait for an item we asked a peer for before
+# asking the next peer that announces it (seconds)
+REQUEST_TIMEOUT = 2
+
+# compact blocks that may wait on their missing transactions at once
+PARTIAL_BLOCKS = 64
 
 
 class Node:
     def __init__(self, tracker_hostname, tracker_port, port,
-                 hostname="localhost"):
+                 hostname="localhost", miners=None,
+                 workers=pipeline.DEFAULT_WORKERS,
+                 depth=pipeline.DEFAULT_DEPTH,
+                 outbox=pipeline.DEFAULT_OUTBOX,
+                 batch_window=pipeline.DEFAULT_WINDOW,
+                 batch_size=pipeline.DEFAULT_BATCH,
+                 gossip=False,
+                 seen_size=seen.DEFAULT_SIZE,
+                 mempool_size=mempool.DEFAULT_SIZE,
+                 data_dir=None):
         self.tracker_addr = (tracker_hostname, tracker_port)
         self.addr = (hostname, port)
         self.peers = {}
         self.peer_sockets = {}
+        self.peer_codecs = {}
+        self.peer_sessions = {}
+        self.peer_outboxes = {}
+        self.peer_features = {}
         self.ident = None
         self.socket = None
         self.tracker_socket = None
@@ -19,8 +45,42 @@ class Node:
         self.key_pair = pkc.KeyPair()
         self.tracker_public_key = None
         self.tracker_verify_key = None
+        self.tracker_codec = message.Codec.JSON
+        self.tracker_session = None
+        self.tracker_outbox = None
+        # the miner, and the blocks it finds
+        self.miner = None
         self.block_queue = None
         self.cv = Condition()
+        # notified whenever the tracker tells us about a new peer
+        self.announced = Condition()
+        # number of mining processes (None means one per core)
+        self.miners = miners
+        # decrypts messages from peers in parallel
+        self.pipeline = pipeline.Pipeline(workers, depth)
+        # messages that may wait to be sent to a peer
+        self.outbox = outbox
+        # transactions we send are gathered for up to batch_window
+        # milliseconds (or batch_size of them) and sent together
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.coalescer = None
+        # in gossip mode, new transactions and blocks are relayed to our
+        # peers by announcing them, and are only sent when asked for
+        self.gossip = gossip
+        # the transactions and blocks we've seen, by identifier
+        self.seen = seen.SeenCache(seen_size)
+        # when we last asked a peer for an item
+        self.requested = seen.SeenCache(seen_size)
+        # compact blocks waiting on transactions we didn't have
+        self.partial_blocks = seen.SeenCache(PARTIAL_BLOCKS)
+        # most unconfirmed transactions we hold at once
+        self.mempool_size = mempool_size
+        # where the chain is kept between runs, if anywhere
+        self.store = store.BlockStore(data_dir) if data_dir else None
+        # the peer we are catching up with, when we last asked it, and
+        # the blocks that showed we were behind
+        self.syncing = None
 
     def __unlock(self):
         try:
@@ -51,6 +111,27 @@ class Node:
 
         return msg
 
+    # what to encrypt messages to/from the tracker with: the session
+    # once the handshake has established one, otherwise our keys
+    def __tracker_enc(self, send=True):
+        if self.tracker_session:
+            return self.tracker_session
+        elif send:
+            return (self.tracker_public_key, self.key_pair)
+        return (self.tracker_verify_key,
+                self.tracker_public_key,
+                self.key_pair)
+
+    def __peer_enc(self, ident, send=True):
+        session = self.peer_sessions.get(ident, None)
+        if session:
+            return session
+
+        p = self.peers[ident]
+        if send:
+            return (p.public_key, self.key_pair)
+        return (p.verify_key, p.public_key, self.key_pair)
+
     def __try_connect(self):
         try:
             self.tracker_socket.connect(self.tracker_addr)
@@ -72,7 +153,8 @@ class Node:
         self.connected = True
 
         message.NodeKeys(self.key_pair.serialize_public_key(),
-                         self.key_pair.serialize_verify_key()) \
+                         self.key_pair.serialize_verify_key(),
+                         message.FEATURES) \
                .send(self.tracker_socket)
 
         # receive our identifier from the tracker
@@ -87,30 +169,54 @@ class Node:
             pkc.deserialize_public_key(msg.msg["public_key"])
         self.tracker_verify_key = \
             pkc.deserialize_verify_key(msg.msg["verify_key"])
+        self.tracker_codec = message.negotiate_codec(msg.msg.get("features"))
         util.printts("Node: received ident %d" % self.ident)
 
-        enc_recv = (self.tracker_verify_key,
-                    self.tracker_public_key,
-                    self.key_pair)
+        # if the tracker can sync us, tell it how much of the chain we have
+        features = msg.msg.get("features")
+        sync = message.supports(features, message.FEATURE_SYNC)
+        stream = message.supports(features, message.FEATURE_STREAM)
+        salt = pkc.new_salt()
+        if sync:
+            self.chain = blockchain.Blockchain.by_sync(self.store)
+            reply = message.NodeIdent(len(self.chain.blocks),
+                                      self.chain.locator(), salt)
+        else:
+            reply = message.NodeIdent(salt=salt)
 
-        enc_send = (self.tracker_public_key, self.key_pair)
+        codec = self.tracker_codec
+        reply.send(self.tracker_socket, self.__tracker_enc(), codec)
 
-        message.NodeIdent().send(self.tracker_socket, enc_send)
+        # having proven who we are, switch to a session if we can
+        self.tracker_session = \
+            message.negotiate_session(msg.msg.get("features"),
+                                      self.key_pair,
+                                      self.tracker_public_key,
+                                      salt, msg.msg.get("salt"))
+        enc_send = self.__tracker_enc()
+        enc_recv = self.__tracker_enc(send=False)
 
         # receive our blockchain from the tracker
-        msg = self.__recv_expect(self.tracker_socket,
-                                 message.Kind.TRACKER_CHAIN,
-                                 enc_recv)
-        if msg is False:
-            util.printts("Node %d: failed to receive TRACKER_CHAIN" %
-                         self.ident)
-            return False
+        if sync:
+            if not self.__sync_with_tracker(enc_send, enc_recv, stream):
+                return False
+        else:
+            msg = self.__recv_expect(self.tracker_socket,
+                                     message.Kind.TRACKER_CHAIN,
+                                     enc_recv)
+            if msg is False:
+                util.printts("Node %d: failed to receive TRACKER_CHAIN" %
+                             self.ident)
+                return False
 
-        self.chain = blockchain.Blockchain.by_serialized(msg.msg["blockchain"])
+            self.chain = blockchain.Blockchain.by_serialized(
+                msg.msg["blockchain"], self.store)
+        self.chain.unconfirmed.limit(self.mempool_size)
         util.printts("Node %d: received chain" % self.ident)
 
         # reply with the port we want to listen on
-        message.NodePort(self.addr[1]).send(self.tracker_socket, enc_send)
+        message.NodePort(self.addr[1]).send(self.tracker_socket, enc_send,
+                                            codec)
 
         msg = self.__recv_expect(self.tracker_socket,
                                  message.Kind.NODE_LISTEN,
@@ -129,7 +235,7 @@ class Node:
                      (self.ident, self.addr[0], self.addr[1]))
 
         # tell the tracker we've started listening
-        message.NodeListen().send(self.tracker_socket, enc_send)
+        message.NodeListen().send(self.tracker_socket, enc_send, codec)
 
         # receive our peers
         msg = self.__recv_expect(self.tracker_socket,
@@ -153,7 +259,7 @@ class Node:
                                           verify_key)
 
         # tell the tracker we received the peers
-        message.NodePeers().send(self.tracker_socket, enc_send)
+        message.NodePeers().send(self.tracker_socket, enc_send, codec)
 
         # wait for acceptance
         msg = self.__recv_expect(self.tracker_socket,
@@ -166,70 +272,188 @@ class Node:
 
         util.printts("Node %d: accepted by tracker" % self.ident)
 
-        # connect with all of our peers
-        rejected = []
-        for ident, p in self.peers.items():
-            # establish connection
+        # from here on, messages to the tracker are sent in the background
+        self.tracker_outbox = pipeline.Outbox(self.tracker_socket, enc_send,
+                                              codec, self.outbox)
+
+        # connect with all of our peers. we can't communicate
+        # with peers that rejected us, so they are dropped.
+        for p in list(self.peers.values()):
+            self.__connect_peer(p)
+
+        for ident in self.peers.keys():
+            self.__start_receiver(ident)
+
+        if self.batch_window > 0:
+            self.coalescer = pipeline.Coalescer(self.__broadcast_transactions,
+                                                self.batch_window,
+                                                self.batch_size)
+
+        # the miner runs for as long as we're connected,
+        # mining whatever unconfirmed transactions we have
+        self.block_queue = Queue()
+        self.miner = proof_of_work.ProofOfWork(self.chain, self.block_queue,
+                                               processes=self.miners)
+        self.miner.thread.start()
+
+        waiter = Thread(target=self.__block_waiter, args=(), daemon=False)
+        waiter.start()
+
+        return True
+
+    def __connect_peer(self, p):
+        """ establish a connection with a peer; False if it rejected us """
+        try:
             conn = util.newsock()
             conn.connect((p.host, p.port))
-            util.printts("Node %d: connected to peer %d on %s:%d" %
+        except OSError:
+            util.printts("Node %d: connection to peer %d on %s:%d refused" %
                          (self.ident, p.ident, p.host, p.port))
+            self.__remove_peer(None, p.ident)
+            return False
 
-            # tell them our identifier
-            message.PeerIdent(self.ident).send(conn)
+        util.printts("Node %d: connected to peer %d on %s:%d" %
+                     (self.ident, p.ident, p.host, p.port))
 
-            enc_send_p = (p.public_key, self.key_pair)
-            enc_recv_p = (p.verify_key, p.public_key, self.key_pair)
+        # tell them our identifier
+        message.PeerIdent(self.ident, message.FEATURES).send(conn)
 
-            # wait for the peer to ask for verification
-            reply = self.__recv_expect(conn, message.Kind.PEER_VERIFY,
-                                       enc_recv_p, disc=False)
-            if reply is False:
-                rejected.append((conn, p.ident))
-                util.printts("Node %d: rejected by peer %d on %s:%d, "
-                             "verify failed" %
-                             (self.ident, p.ident, p.host, p.port))
-                continue
+        enc_send = (p.public_key, self.key_pair)
+        enc_recv = (p.verify_key, p.public_key, self.key_pair)
 
-            util.printts("Node %d: verifying identity with peer %d" %
-                         (self.ident, p.ident))
-            message.PeerVerify().send(conn, enc_send_p)
-
-            # wait for acceptance
-            reply = self.__recv_expect(conn, message.Kind.PEER_ACCEPT,
-                                       enc_recv_p, disc=False)
-            if reply is False:
-                rejected.append((conn, p.ident))
-                util.printts("Node %d: rejected by peer %d on %s:%d, "
-                             "accept failed" %
-                             (self.ident, p.ident, p.host, p.port))
-                continue
+        # wait for the peer to ask for verification
+        reply = self.__recv_expect(conn, message.Kind.PEER_VERIFY,
+                                   enc_recv, disc=False)
+        if reply is False:
+            util.printts("Node %d: rejected by peer %d on %s:%d, "
+                         "verify failed" %
+                         (self.ident, p.ident, p.host, p.port))
+            self.__remove_peer(conn, p.ident)
+            return False
 
-            # register the connection
-            util.printts("Node %d: accepted by peer %d on %s:%d" %
+        # the peer told us what it supports while asking
+        features = reply.msg.get("features")
+        codec = message.negotiate_codec(features)
+        salt = pkc.new_salt()
+        session = message.negotiate_session(features, self.key_pair,
+                                            p.public_key, salt,
+                                            reply.msg.get("salt"))
+
+        util.printts("Node %d: verifying identity with peer %d" %
+                     (self.ident, p.ident))
+        message.PeerVerify(salt=salt).send(conn, enc_send, codec)
+
+        # wait for acceptance, which comes over the session if any
+        reply = self.__recv_expect(conn, message.Kind.PEER_ACCEPT,
+                                   session or enc_recv, disc=False)
+        if reply is False:
+            util.printts("Node %d: rejected by peer %d on %s:%d, "
+                         "accept failed" %
                          (self.ident, p.ident, p.host, p.port))
-            self.peer_sockets[p.ident] = conn
+            self.__remove_peer(conn, p.ident)
+            return False
 
-        # we can't communicate with peers that rejected us
-        for conn, ident in rejected:
-            self.__remove_peer(conn, ident)
+        # register the connection
+        util.printts("Node %d: accepted by peer %d on %s:%d" %
+                     (self.ident, p.ident, p.host, p.port))
+        self.peer_sockets[p.ident] = conn
+        self.peer_codecs[p.ident] = codec
+        self.peer_sessions[p.ident] = session
+        self.peer_features[p.ident] = features
+        return True
 
-        for ident in self.peers.keys():
-            self.__start_receiver(ident)
+    def __link_peer(self, p):
+        # a peer the tracker asked us to connect to after we joined
+        if self.__connect_peer(p):
+            self.__start_receiver(p.ident)
 
-        # wait for incoming unconfirmed transactions
-        # so that we can mine the current block
-        waiter = Thread(target=self.__block_waiter, args=(), daemon=False)
-        waiter.start()
+    def __sync_with_tracker(self, enc_send, enc_recv, stream=False):
+        msg = self.__recv_expect(self.tracker_socket,
+                                 message.Kind.TRACKER_SYNC,
+                                 enc_recv)
+        if msg is False:
+            util.printts("Node %d: failed to receive TRACKER_SYNC" %
+                         self.ident)
+            return False
+
+        # drop whatever we have past the point where we and the
+        # tracker agree, then fetch the rest a range at a time
+        height = msg.msg["height"]
+        unconfirmed = msg.msg["unconfirmed"]
+        self.chain.replace_blocks(msg.msg["common"], [])
+        util.printts("Node %d: have %d of %d blocks" %
+                     (self.ident, len(self.chain.blocks), height))
+
+        if stream and len(self.chain.blocks) < height:
+            if not self.__stream_from_tracker(enc_send, enc_recv):
+                return False
+
+        while len(self.chain.blocks) < height:
+            message.SyncGetBlocks(len(self.chain.blocks)) \
+                   .send(self.tracker_socket, enc_send, self.tracker_codec)
+
+            msg = self.__recv_expect(self.tracker_socket,
+                                     message.Kind.SYNC_BLOCKS,
+                                     enc_recv)
+            if msg is False:
+                util.printts("Node %d: failed to receive SYNC_BLOCKS" %
+                             self.ident)
+                return False
+
+            if msg.msg["start"] != len(self.chain.blocks) or \
+               not msg.msg["blocks"]:
+                util.printts("Node %d: tracker sent the wrong blocks" %
+                             self.ident)
+                self.disconnect()
+                return False
+
+            for block in msg.msg["blocks"]:
+                self.__append_block(blockchain.Block.deserialize(block))
 
+        self.chain.hold(unconfirmed)
         return True
 
-    def __start_receiver(self, ident, conn=None):
+    def __stream_from_tracker(self, enc_send, enc_recv):
+        # everything we're missing comes in one go, a chunk at a time
+        message.SyncGetChain(len(self.chain.blocks)) \
+               .send(self.tracker_socket, enc_send, self.tracker_codec)
+
+        stream = message.ChainStream()
+        try:
+            while True:
+                msg = message.recv(self.tracker_socket, enc_recv)
+                if msg and msg.kind == message.Kind.SYNC_CHUNK:
+                    for serialized in stream.chunk(msg):
+                        block = blockchain.Block.deserialize(serialized)
+                        stream.add(block.hexdigest())
+                        if not self.chain.add_block(block):
+                            raise ValueError
+                elif msg and msg.kind == message.Kind.SYNC_END:
+                    stream.end(msg)
+                    return True
+                else:
+                    raise ValueError
+        except ValueError:
+            util.printts("Node %d: failed to receive the chain" % self.ident)
+            self.disconnect()
+            return False
+
+    def __start_receiver(self, ident, conn=None, codec=None, session=None,
+                         features=None):
         self.__lock()
 
         # register the node and spawn a thread to listen for messages
         if conn:
             self.peer_sockets[ident] = conn
+            self.peer_codecs[ident] = codec
+            self.peer_sessions[ident] = session
+            self.peer_features[ident] = features
+
+        # messages to the peer are queued and sent by a writer of its own
+        self.peer_outboxes[ident] = pipeline.Outbox(self.peer_sockets[ident],
+                                                    self.__peer_enc(ident),
+                                                    self.peer_codecs[ident],
+                                                    self.outbox)
 
         thread = Thread(target=self.__recv_peer, args=(ident,), daemon=False)
         thread.start()
@@ -247,30 +471,47 @@ class Node:
         except OSError:
             return False
 
+        # the handshake may have to wait on the tracker, so it gets a
+        # thread of its own rather than holding up everyone else
+        Thread(target=self.__accept_peer, args=(conn, addr),
+               daemon=True).start()
+        return True
+
+    def __accept_peer(self, conn, addr):
         # the peer must identify themselves
         msg = self.__recv_expect(conn, message.Kind.PEER_IDENT, disc=False)
         if msg is False:
             util.printts("Node %d: rejecting connection %s:%d" %
                          (self.ident, addr[0], addr[1]))
             util.closesock(conn)
-            return True
+            return
 
         ident = msg.msg["ident"]
+        if ident not in self.peers:
+            # the peer may have beaten the tracker's announcement of it
+            with self.announced:
+                self.announced.wait_for(lambda: ident in self.peers,
+                                        ANNOUNCE_TIMEOUT)
+
         if ident not in self.peers:
             util.printts("Node %d: rejecting connection %s:%d" %
                          (self.ident, addr[0], addr[1]))
             util.closesock(conn)
-            return True
+            return
 
         pk = self.peers[ident].public_key
         enc_send = (pk, self.key_pair)
         enc_recv = (self.peers[ident].verify_key, pk, self.key_pair)
+        features = msg.msg.get("features")
+        codec = message.negotiate_codec(features)
 
         # the peer should verify their identity with us
         # since we were provided by the tracker with their
         # public key and verify key. this should let us
         # know if they are who they say they are.
-        message.PeerVerify().send(conn, enc_send)
+        salt = pkc.new_salt()
+        message.PeerVerify(message.FEATURES, salt) \
+               .send(conn, enc_send, codec)
 
         msg = self.__recv_expect(conn, message.Kind.PEER_VERIFY,
                                  enc_recv, disc=False)
@@ -278,25 +519,24 @@ class Node:
             util.printts("Node %d: rejecting connection %s:%d from peer %d" %
                          (self.ident, addr[0], addr[1], ident))
             util.closesock(conn)
-            return True
+            return
 
-        # tell them we've accepted them
-        message.PeerAccept().send(conn, enc_send)
+        # tell them we've accepted them. they have proven who
+        # they are, so this is where the session starts.
+        session = message.negotiate_session(features, self.key_pair, pk,
+                                            salt, msg.msg.get("salt"))
+        message.PeerAccept().send(conn, session or enc_send, codec)
         util.printts("Node %d: accepting connection from peer %d on %s:%d" %
                      (self.ident, ident, addr[0], addr[1]))
 
-        self.__start_receiver(ident, conn)
-
-        return True
+        self.__start_receiver(ident, conn, codec, session, features)
 
     def recv_tracker(self):
         if not (self.connected or self.tracker_socket):
             return False
 
         msg = None
-        enc_recv = (self.tracker_verify_key,
-                    self.tracker_public_key,
-                    self.key_pair)
+        enc_recv = self.__tracker_enc(send=False)
 
         msg = self.__recv_any(self.tracker_socket, enc_recv)
         if msg is False:
@@ -329,6 +569,15 @@ class Node:
 
                 self.__unlock()
 
+                with self.announced:
+                    self.announced.notify_all()
+
+                # the tracker may ask us to make the connection ourselves,
+                # when neither of us was told about the other on joining
+                if msg.msg.get("connect"):
+                    Thread(target=self.__link_peer,
+                           args=(self.peers[ident],), daemon=True).start()
+
         return True
 
     def disconnect(self):
@@ -340,44 +589,72 @@ class Node:
         else:
             util.printts("Node %d: disconnecting" % self.ident)
 
+        # send off any transactions still waiting for a batch. this
+        # has to happen before taking the lock, since a broadcast may
+        # need it to remove peers.
+        if self.coalescer:
+            self.coalescer.close()
+
         msg = message.NodeDisconnect()
 
-        def do_send(conn, enc=None):
+        def do_send(conn, enc=None, codec=message.Codec.JSON):
             try:
                 # the socket might contain a bad file descriptor
                 # (i.e. the connection is already gone)
                 # so just continue as normal if sending fails
-                msg.send(conn, enc)
+                msg.send(conn, enc, codec)
             except Exception:
                 pass
 
         self.__lock()
 
-        if self.tracker_public_key:
-            do_send(self.tracker_socket,
-                    (self.tracker_public_key, self.key_pair))
+        # another thread may have disconnected while we waited
+        if not self.connected:
+            self.__unlock()
+            return
+
+        # whatever is already queued goes out ahead of the disconnect
+        if self.tracker_outbox:
+            self.tracker_outbox.put(msg)
+            self.tracker_outbox.close()
+        elif self.tracker_public_key:
+            do_send(self.tracker_socket, self.__tracker_enc(),
+                    self.tracker_codec)
         else:
             do_send(self.tracker_socket)
 
         for p in self.peers.values():
             conn = self.peer_sockets.get(p.ident, None)
-            if conn:
-                do_send(conn, (p.public_key, self.key_pair))
+            outbox = self.peer_outboxes.get(p.ident, None)
+            if outbox:
+                outbox.put(msg)
+                outbox.close()
+            elif conn:
+                do_send(conn, self.__peer_enc(p.ident),
+                        self.peer_codecs[p.ident])
 
         util.closesock(self.tracker_socket)
         self.tracker_socket = None
+        self.tracker_outbox = None
         util.closesock(self.socket)
         self.socket = None
         self.peers = {}
         self.peer_sockets = {}
+        self.peer_codecs = {}
+        self.peer_sessions = {}
+        self.peer_outboxes = {}
+        self.peer_features = {}
         self.connected = False
+        self.pipeline.shutdown()
 
-        # block waiter might still be blocking on the
-        # condition variable. we need to unblock so
-        # the thread can gracefully terminate.
-        self.cv.acquire()
-        self.cv.notify()
-        self.cv.release()
+        if self.chain:
+            self.chain.close()
+
+        # stop the miner, and unblock the block waiter
+        # so that it can gracefully terminate
+        if self.miner:
+            self.miner.stop()
+            self.block_queue.put("STOP")
 
         self.__unlock()
 
@@ -386,19 +663,19 @@ class Node:
                      (self.ident, ident))
 
         conn = self.peer_sockets[ident]
-        enc_recv = (self.peers[ident].verify_key,
-                    self.peers[ident].public_key,
-                    self.key_pair)
+        enc_recv = self.__peer_enc(ident, send=False)
+        stream = self.pipeline.stream(conn, enc_recv)
 
         while self.connected:
-            msg = self.__recv_any(conn, enc_recv, disc=False)
-            if msg is False:
+            try:
+                msg = stream.recv()
+            except ValueError:
                 util.printts("Node %d: connection with peer %d broken" %
                              (self.ident, ident))
                 self.__remove_peer(conn, ident)
                 break
 
-            if not msg:
+            if not msg or not self.__fresh(msg):
                 continue
 
             if msg.kind == message.Kind.NODE_DISCONNECT:
@@ -409,11 +686,56 @@ class Node:
             elif msg.kind == message.Kind.PEER_TRANSACTION:
                 util.printts("Node %d: received transaction from peer %s" %
                              (self.ident, ident))
-                self.__recv_transaction(msg.msg["transaction"])
+                self.__recv_transactions([msg.msg["transaction"]], ident)
+            elif msg.kind == message.Kind.PEER_TRANSACTIONS:
+                util.printts("Node %d: received %d transactions from peer %s" %
+                             (self.ident, len(msg.msg["transactions"]), ident))
+                self.__recv_transactions(msg.msg["transactions"], ident)
             elif msg.kind == message.Kind.PEER_BLOCK:
                 util.printts("Node %d: received block from peer %s" %
                              (self.ident, ident))
-                self.__recv_block(msg.msg["block"])
+                self.__recv_block(msg.msg["block"], ident)
+            elif msg.kind == message.Kind.PEER_INV:
+                self.__recv_inv(ident, msg.msg)
+            elif msg.kind == message.Kind.PEER_GETDATA:
+                self.__recv_getdata(ident, msg.msg)
+            elif msg.kind == message.Kind.PEER_COMPACT_BLOCK:
+                util.printts("Node %d: received compact block from peer %s" %
+                             (self.ident, ident))
+                self.__recv_compact_block(ident, msg.msg)
+            elif msg.kind == message.Kind.PEER_GETBLOCKTXN:
+                self.__recv_getblocktxn(ident, msg.msg)
+            elif msg.kind == message.Kind.PEER_BLOCKTXN:
+                self.__recv_blocktxn(ident, msg.msg)
+            elif msg.kind == message.Kind.SYNC_GET_BLOCKS:
+                self.__send_to(ident, message.sync_blocks(self.chain,
+                                                          msg.msg))
+            elif msg.kind == message.Kind.SYNC_BLOCKS:
+                self.__recv_sync_blocks(ident, msg.msg)
+
+        stream.close()
+
+    def __fresh(self, msg):
+        """ False for transactions or a block we've already had """
+        # this is checked as soon as a message is decrypted, so that
+        # whatever reaches us along more than one path is only worked
+        # on the once
+        if msg.kind == message.Kind.PEER_TRANSACTION:
+            transaction = msg.msg["transaction"]
+            return self.seen.add(blockchain.transaction_id(transaction),
+                                 transaction)
+        elif msg.kind == message.Kind.PEER_TRANSACTIONS:
+            msg.msg["transactions"] = \
+                [t for t in msg.msg["transactions"]
+                 if self.seen.add(blockchain.transaction_id(t), t)]
+            return len(msg.msg["transactions"]) > 0
+        elif msg.kind == message.Kind.PEER_BLOCK:
+            # a block is only remembered once it has been verified
+            block = msg.msg["block"]
+            return not self.seen.known(blockchain.block_id(block))
+        elif msg.kind == message.Kind.PEER_COMPACT_BLOCK:
+            return not self.seen.known(msg.msg["block"])
+        return True
 
     def __remove_peer(self, conn, ident):
         self.__lock()
@@ -424,132 +746,428 @@ class Node:
         if ident in self.peers:
             self.peers.pop(ident, None)
             self.peer_sockets.pop(ident, None)
+            self.peer_codecs.pop(ident, None)
+            self.peer_sessions.pop(ident, None)
+
+        self.peer_features.pop(ident, None)
+        outbox = self.peer_outboxes.pop(ident, None)
+        if outbox:
+            outbox.close(flush=False)
 
         self.__unlock()
 
-    def __broadcast_message(self, msg):
-        util.printts("Node %d: sending a broadcast message" % self.ident)
+    def __bodies(self, features, items):
+        """ messages carrying the transactions and blocks listed in items """
+        msgs = []
+
+        transactions = [self.seen.get(i) for i in items["transactions"]]
+        transactions = [t for t in transactions if t is not None]
+        if len(transactions) > 1 and \
+           message.supports(features, message.FEATURE_BATCH):
+            msgs.append(message.PeerTransactions(transactions))
+        else:
+            msgs.extend(message.PeerTransaction(t) for t in transactions)
 
-        if msg.kind == message.Kind.PEER_BLOCK:
-            msg.send(self.tracker_socket,
-                     enc=(self.tracker_public_key, self.key_pair))
+        for i in items["blocks"]:
+            block = self.__block_body(i)
+            if block is None:
+                continue
+            elif message.supports(features, message.FEATURE_COMPACT):
+                msgs.append(self.__compact(i, block))
+            else:
+                msgs.append(message.PeerBlock(block))
+
+        return msgs
+
+    def __block_body(self, i):
+        """ a block we've seen or have in our chain, serialized """
+        block = self.seen.get(i)
+        if block is None:
+            # it may have been pushed out of the cache since
+            height = self.chain.height(i)
+            if height is not None:
+                block = self.chain.blocks[height].serialize()
+        return block
+
+    def __compact(self, i, block):
+        return message.PeerCompactBlock(i,
+                                        blockchain.block_header(block),
+                                        [blockchain.short_id(t)
+                                         for t in block["transactions"]])
+
+    def __messages_for(self, ident, msg):
+        """ the messages that carry msg to a peer, given what it supports """
+        features = self.peer_features.get(ident)
+
+        # peers that don't gossip get the bodies right away,
+        # and peers that can't take a batch get it one at a time
+        if msg.kind == message.Kind.PEER_INV and \
+           not message.supports(features, message.FEATURE_GOSSIP):
+            return self.__bodies(features, msg.msg)
+        elif msg.kind == message.Kind.PEER_TRANSACTIONS and \
+                not message.supports(features, message.FEATURE_BATCH):
+            return [message.PeerTransaction(t)
+                    for t in msg.msg["transactions"]]
+        elif msg.kind == message.Kind.PEER_COMPACT_BLOCK and \
+                not message.supports(features, message.FEATURE_COMPACT):
+            block = self.__block_body(msg.msg["block"])
+            return [message.PeerBlock(block)] if block is not None else []
+
+        return [msg]
+
+    def __send_to(self, ident, msg):
+        outbox = self.peer_outboxes.get(ident, None)
+        if outbox and not outbox.put(msg):
+            util.printts("Node %d: peer %d can't keep up, dropping it" %
+                         (self.ident, ident))
+            self.__remove_peer(self.peer_sockets.get(ident, None), ident)
+
+    def __broadcast_message(self, msg, exclude=None):
+        util.printts("Node %d: sending a broadcast message" % self.ident)
 
+        # this only queues the message. each connection's
+        # writer encrypts and sends its own copy.
         invalid = []
-        for ident, p in self.peers.items():
-            conn = self.peer_sockets.get(ident, None)
-            if conn:
-                msg.send(conn, enc=(p.public_key, self.key_pair))
-            else:
+        for ident in list(self.peers.keys()):
+            if ident == exclude:
+                continue
+
+            outbox = self.peer_outboxes.get(ident, None)
+            if not outbox:
+                invalid.append(ident)
+            elif not all(outbox.put(m)
+                         for m in self.__messages_for(ident, msg)):
+                util.printts("Node %d: peer %d can't keep up, dropping it" %
+                             (self.ident, ident))
                 invalid.append(ident)
 
         # we may have tried to send to peers that we never
-        # established a connection with, so it's best to
-        # remove them once we attempt to send them a message.
+        # established a connection with, or that have fallen
+        # too far behind, so it's best to remove them.
         for ident in invalid:
-            self.__remove_peer(None, ident)
+            self.__remove_peer(self.peer_sockets.get(ident, None), ident)
 
     def send_transaction(self, receiver, amount):
         # sending to ourselves is a no-op
         if self.ident == receiver:
             return
 
-        # don't allow sending to a peer that doesn't exist
-        if receiver not in self.peers:
+        # don't allow sending to a peer that doesn't exist. a node
+        # that gossips only knows its neighbours, so it can't tell.
+        if receiver not in self.peers and not self.gossip:
             util.printts("Node %d: peer %d doesn't exist" %
                          (self.ident, receiver))
             return
 
         # serialize the transaction before broadcast
-        transaction = {'sender': self.ident,
-                       'receiver': receiver,
-                       'amount': amount}
+        transaction = blockchain.new_transaction(self.ident, receiver, amount)
+        self.seen.add(blockchain.transaction_id(transaction), transaction)
 
-        self.__broadcast_message(message.PeerTransaction(transaction))
+        if self.coalescer:
+            self.coalescer.put(transaction)
+        else:
+            self.__broadcast_transactions([transaction])
 
         # make sure it is added to this node's list of unconfirmed transactions
         self.__recv_transaction(transaction)
 
+    def __broadcast_transactions(self, transactions, exclude=None):
+        if self.gossip:
+            msg = message.PeerInv([blockchain.transaction_id(t)
+                                   for t in transactions])
+        elif len(transactions) == 1:
+            msg = message.PeerTransaction(transactions[0])
+        else:
+            msg = message.PeerTransactions(transactions)
+
+        self.__broadcast_message(msg, exclude)
+
+    def __broadcast_block(self, block, exclude=None):
+        # our peers should already have most of the block's transactions,
+        # so unless they gossip they get it in compact form
+        i = blockchain.block_id(block)
+        if self.gossip:
+            msg = message.PeerInv(blocks=[i])
+        else:
+            msg = self.__compact(i, block)
+
+        self.__broadcast_message(msg, exclude)
+
+    def __recv_inv(self, ident, inv):
+        now = time.monotonic()
+
+        # ask for what we haven't seen, unless we've
+        # recently asked another peer for it
+        def wanted(i):
+            if i in self.seen:
+                return False
+            asked = self.requested.get(i)
+            if asked is not None and now - asked < REQUEST_TIMEOUT:
+                return False
+            self.requested.put(i, now)
+            return True
+
+        transactions = [i for i in inv["transactions"] if wanted(i)]
+        blocks = [i for i in inv["blocks"] if wanted(i)]
+        if transactions or blocks:
+            self.__send_to(ident, message.PeerGetData(transactions, blocks))
+
+    def __recv_getdata(self, ident, request):
+        for msg in self.__bodies(self.peer_features.get(ident), request):
+            self.__send_to(ident, msg)
+
+    def __recv_compact_block(self, ident, compact):
+        i = compact["block"]
+
+        # find the block's transactions among the ones we're holding,
+        # which are already kept by identifier
+        held = dict((key[:blockchain.SHORT_ID_LENGTH], t)
+                    for key, t in self.chain.unconfirmed.items())
+
+        transactions = [held.get(s) for s in compact["short_ids"]]
+        missing = [n for n, t in enumerate(transactions) if t is None]
+        if not missing:
+            self.__complete_block(ident, i, compact["header"], transactions)
+            return
+
+        self.partial_blocks.put(i, (compact["header"], transactions))
+        self.__send_to(ident, message.PeerGetBlockTxn(i, missing))
+
+    def __recv_getblocktxn(self, ident, request):
+        block = self.__block_body(request["block"])
+        if block is None:
+            return
+
+        transactions = block["transactions"]
+        self.__send_to(ident, message.PeerBlockTxn(
+            request["block"],
+            [transactions[n] for n in request["indexes"]
+             if 0 <= n < len(transactions)]))
+
+    def __recv_blocktxn(self, ident, reply):
+        i = reply["block"]
+        partial = self.partial_blocks.pop(i)
+        if partial is None:
+            return
+
+        header, transactions = partial
+        missing = [n for n, t in enumerate(transactions) if t is None]
+        if len(missing) != len(reply["transactions"]):
+            return
+
+        for n, t in zip(missing, reply["transactions"]):
+            transactions[n] = t
+
+        # if we had to ask for every transaction, the block is as the
+        # peer sent it, so there's no point in asking again
+        self.__complete_block(ident, i, header, transactions,
+                              retry=len(missing) < len(transactions))
+
+    def __complete_block(self, ident, i, header, transactions, retry=True):
+        block = blockchain.block_of(header, transactions, i)
+
+        if not self.__recv_block(block, ident) and retry:
+            # a short identifier matched the wrong transaction,
+            # so there's nothing for it but to ask for all of them
+            util.printts("Node %d: compact block from peer %d didn't match, "
+                         "asking for all of its transactions" %
+                         (self.ident, ident))
+            self.partial_blocks.put(i, (header, [None] * len(transactions)))
+            self.__send_to(ident, message.PeerGetBlockTxn(
+                i, list(range(len(transactions)))))
+
     def __recv_transaction(self, transaction):
+        self.__recv_transactions([transaction])
+
+    def __recv_transactions(self, transactions, source=None):
+        # the whole batch is added under a single acquisition
         self.cv.acquire()
 
-        valid = self.chain.add_unconfirmed_transaction(transaction)
-        if not valid:
+        invalid = self.chain.add_unconfirmed_transactions(transactions)
+        for transaction in invalid:
             util.printts("Node %d: received invalid transaction from peer %d" %
                          (self.ident, transaction["sender"]))
-        else:
-            # if the miner is running then it will have to start over
-            # since we just modified the list of unconfirmed transactions
-            if self.block_queue and self.block_queue.empty():
-                self.block_queue.put("STOP")
-
-            self.cv.notify()
 
         self.cv.release()
 
-    def __block_waiter(self):
-        while True:
-            self.cv.acquire()
+        # the miner takes the new transactions on board
+        if len(invalid) < len(transactions) and self.miner:
+            self.miner.update()
 
-            if not self.chain.unconfirmed:
-                self.cv.wait()
+        # pass the valid ones along to the rest of our peers
+        if self.gossip and source is not None:
+            valid = [t for t in transactions
+                     if not any(t is i for i in invalid)]
+            if valid:
+                self.__broadcast_transactions(valid, source)
 
-            self.cv.release()
-
-            if not self.connected:
+    def __block_waiter(self):
+        while True:
+            val = self.block_queue.get()
+            if val == "STOP" or not self.connected:
+                util.printts("Node %d: miner stopped" % self.ident)
                 break
 
-            thread = Thread(target=self.__mine, args=(), daemon=False)
-            thread.start()
-            thread.join()
-
-    def __mine(self):
-        util.printts("Node %d: starting mining thread" % self.ident)
+            # a block found just as the chain moved on is of no use
+            if val.previous_block_hash != self.chain.blocks[-1].hexdigest():
+                continue
 
-        # start mining block
-        self.block_queue = Queue()
-        worker = proof_of_work.ProofOfWork(self.chain, self.block_queue)
-        worker.thread.start()
-
-        val = self.block_queue.get()
-        if val == "STOP":
-            util.printts("Node %d: miner stopped" % self.ident)
-            worker.stop()
-            worker.thread.join()
-        else:
             util.printts("Node %d: finished mining" % self.ident)
             self.__send_block(val)
 
     def __send_block(self, block):
         # make sure it is added to this node's chain
         s = block.serialize()
-        self.__append_block(s)
-        self.__broadcast_message(message.PeerBlock(s))
+        self.seen.add(block.hexdigest(), s)
+        if not self.__append_block(block):
+            return
 
-    def __recv_block(self, block):
-        self.block_queue.put("STOP")
-        self.__append_block(block)
+        # the tracker keeps a copy of the chain too
+        if self.tracker_outbox:
+            self.tracker_outbox.put(message.PeerBlock(s))
+
+        self.__broadcast_block(s)
+
+    def __recv_block(self, block, source=None):
+        """ False if the block doesn't match its hash """
+        # another peer may have gotten the block to us first
+        i = blockchain.block_id(block)
+        if i in self.seen or self.chain.height(i) is not None:
+            return True
+
+        verified = self.__verified(block, source)
+        if verified is None:
+            return False
+        if not self.seen.add(i, block):
+            return True
+
+        # a block that follows one we never got means we've fallen
+        # behind, so it waits for the blocks we're missing
+        if source is None or \
+           self.chain.height(block["previous_block_hash"]) is not None or \
+           not self.__sync_with(source, len(self.chain.blocks), verified):
+            self.__append_block(verified)
+
+        if self.gossip:
+            self.__broadcast_block(block, source)
+        return True
+
+    def __verified(self, block, source):
+        # the block, if it is the one its hash says it is
+        verified = blockchain.Block.deserialize(block)
+        if verified.verify():
+            return verified
+
+        util.printts("Node %d: block from peer %s doesn't match its hash" %
+                     (self.ident, source))
+        return None
+
+    def __sync_with(self, ident, start, block=None):
+        """ ask a peer for its blocks from `start`; False if it can't """
+        if not message.supports(self.peer_features.get(ident),
+                                message.FEATURE_SYNC):
+            return False
+
+        # one peer at a time is enough. in the meantime, blocks from
+        # the others are taken as they come. a peer that stopped
+        # answering is taken over from, along with its waiting blocks.
+        now = time.monotonic()
+        waiting = []
+        if self.syncing:
+            other, asked, waiting = self.syncing
+            if other != ident and now - asked < REQUEST_TIMEOUT:
+                return False
+
+        if block is not None:
+            waiting.append(block)
+
+        util.printts("Node %d: catching up with peer %d from block %d" %
+                     (self.ident, ident, start))
+        self.syncing = (ident, now, waiting)
+        self.__send_to(ident, message.SyncGetBlocks(start))
+        return True
+
+    def __recv_sync_blocks(self, ident, reply):
+        if not self.syncing or self.syncing[0] != ident:
+            return
+
+        start = reply["start"]
+        blocks = reply["blocks"]
+
+        # our chains part somewhere before the range, so look further back
+        if blocks and start > 0 and \
+           self.chain.height(blocks[0]["previous_block_hash"]) is None:
+            self.__sync_with(ident, max(start - message.SYNC_RANGE, 0))
+            return
+
+        # a peer that sends a bad block isn't worth syncing with
+        verified = [self.__verified(block, ident) for block in blocks]
+        if None in verified:
+            self.syncing = None
+            return
+        for block, serialized in zip(verified, blocks):
+            self.seen.add(block.hexdigest(), serialized)
+
+        end = start + len(blocks)
+        done = not blocks or end >= reply["height"]
+
+        # the blocks that were waiting go on top, unless the peer
+        # had them too
+        if done:
+            known = set(block.hexdigest() for block in verified)
+            verified += [block for block in self.syncing[2]
+                         if block.hexdigest() not in known]
+            self.syncing = None
+            util.printts("Node %d: caught up with peer %d" %
+                         (self.ident, ident))
+
+        # what we don't have yet is the peer's branch
+        branch = [block for block in verified
+                  if self.chain.height(block.hexdigest()) is None]
+        if branch:
+            self.__take_branch(ident, branch, reply["height"])
+
+        if not done:
+            self.__sync_with(ident, end)
+
+    def __take_branch(self, ident, branch, height):
+        """ add a peer's blocks, switching to its chain if it's longer """
+        parent = self.chain.height(branch[0].previous_block_hash)
+        if parent is None:
+            return
+
+        # only as many of the blocks as follow on from each other
+        linked = branch[:1]
+        for block in branch[1:]:
+            if block.previous_block_hash != linked[-1].hexdigest():
+                break
+            linked.append(block)
+
+        common = parent + 1
+        if common == len(self.chain.blocks):
+            for block in linked:
+                self.__append_block(block)
+            return
+
+        # our chains part at `common`. the longer chain wins, and we
+        # keep our own when they are the same length
+        if max(height, common + len(linked)) <= len(self.chain.blocks):
+            return
+
+        util.printts("Node %d: switching to peer %d's chain from block %d" %
+                     (self.ident, ident, common))
+        if self.chain.replace_blocks(common, linked) and self.miner:
+            self.miner.update()
 
     def __append_block(self, block):
-        self.chain.add_block(blockchain.Block(block["transactions"],
-                                              block["previous_block_hash"],
-                                              None))
+        """ False if the block doesn't follow our newest one """
+        if not self.chain.add_block(block):
+            return False
 
-    def balance(self):
-        balance = 0
-        for block in self.chain.blocks:
-            for transaction in block.transactions:
-                sender = transaction["sender"]
-                receiver = transaction["receiver"]
-                amount = transaction["amount"]
-
-                if sender == blockchain.GENESIS_IDENT \
-                   and receiver == blockchain.GENESIS_IDENT:
-                    balance += amount
-                elif sender == self.ident:
-                    if receiver != self.ident:
-                        balance -= amount
-                else:
-                    if receiver == self.ident:
-                        balance += amount
+        # whatever the miner was working on is out of date
+        if self.miner:
+            self.miner.update()
+        return True
 
-        return balance
+    def balance(self):
+        return self.chain.balance(self.ident)
@@ -0,0 +1,233 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from threading import Thread, Condition
+from . import message, util
+
+# threads verifying and decrypting inbound frames
+DEFAULT_WORKERS = 4
+
+# frames from one connection that may be in flight at once
+DEFAULT_DEPTH = 64
+
+# placed on a stream once its connection is gone
+BROKEN = "BROKEN"
+
+
+# inbound messages are handled in stages. a reader per connection takes
+# frames off the socket, a pool of workers shared by every connection
+# verifies, decrypts and parses them (nacl releases the GIL while it
+# works), and the receiver gets the messages back in the order they were
+# sent.
+class Pipeline:
+    def __init__(self, workers=DEFAULT_WORKERS, depth=DEFAULT_DEPTH):
+        self.workers = workers
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def stream(self, sock, enc=None):
+        """ start reading the messages arriving on a socket """
+        s = Stream(self, sock, enc)
+        s.thread.start()
+        return s
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Stream:
+    def __init__(self, pipeline, sock, enc=None):
+        self.pipeline = pipeline
+        self.sock = sock
+        self.enc = enc
+        self.closed = False
+        # the reader blocks once this many frames are waiting
+        self.pending = Queue(maxsize=pipeline.depth)
+        self.thread = Thread(target=self.__read, args=(), daemon=True)
+
+    def __read(self):
+        f = message.framer(self.sock)
+
+        while not self.closed:
+            try:
+                # the frame is only valid until the next read,
+                # so the worker gets its own copy
+                data = bytes(f.recv_frame())
+                job = self.pipeline.executor.submit(message.unseal, data,
+                                                    self.enc)
+            except Exception:
+                break
+
+            self.pending.put(job)
+
+        if not self.closed:
+            self.pending.put(BROKEN)
+
+    def recv(self):
+        """ the next message; raises ValueError once the connection breaks """
+        job = self.pending.get()
+        if job is BROKEN:
+            self.close()
+            raise ValueError
+
+        try:
+            counter, msg = job.result()
+            # replays are checked here since the
+            # workers may finish out of order
+            if counter is not None:
+                self.enc.accept_counter(counter)
+        except Exception:
+            self.close()
+            raise ValueError
+
+        return msg
+
+    def close(self):
+        self.closed = True
+
+        # unblock the reader if it is waiting for room
+        try:
+            while True:
+                self.pending.get_nowait()
+        except Empty:
+            pass
+
+
+# messages waiting to be sent to a connection that hasn't caught up
+DEFAULT_OUTBOX = 256
+
+# how long to wait for an outbox to flush when it is closed (seconds)
+FLUSH_TIMEOUT = 1
+
+# placed on an outbox to stop its writer
+STOP = "STOP"
+
+
+# outbound messages to one connection. they are queued and then encrypted
+# and sent by a writer thread of the connection's own, so that a
+# broadcast only has to enqueue, and a slow connection only holds up
+# itself. the writer closes the socket if a send fails, which the
+# connection's receiver will notice.
+class Outbox:
+    def __init__(self, sock, enc=None, codec=message.Codec.JSON,
+                 depth=DEFAULT_OUTBOX):
+        self.sock = sock
+        self.enc = enc
+        self.codec = codec
+        self.closed = False
+        self.queue = Queue(maxsize=depth)
+        self.thread = Thread(target=self.__write, args=(), daemon=True)
+        self.thread.start()
+
+    def __write(self):
+        while True:
+            msg = self.queue.get()
+            if msg is STOP:
+                break
+
+            try:
+                msg.send(self.sock, self.enc, self.codec)
+            except Exception:
+                util.closesock(self.sock)
+                break
+
+    def put(self, msg):
+        """ queue a message; False if the connection can't keep up """
+        if self.closed:
+            return False
+
+        try:
+            self.queue.put_nowait(msg)
+        except Full:
+            return False
+
+        return True
+
+    def close(self, flush=True):
+        """ stop the writer, giving it a moment to send what's queued """
+        if self.closed:
+            return
+        self.closed = True
+
+        if not flush:
+            # nothing queued will be sent, so make room to stop
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+
+        try:
+            self.queue.put(STOP, timeout=FLUSH_TIMEOUT)
+        except Full:
+            return
+
+        self.thread.join(FLUSH_TIMEOUT)
+
+
+# how long the first item of a batch may wait for others (milliseconds)
+DEFAULT_WINDOW = 5
+
+# the most items sent in a single batch
+DEFAULT_BATCH = 256
+
+
+# gathers items into batches, handing each batch to `flush` once its first
+# item has waited `window` milliseconds or it has reached `count` items.
+# batches are flushed one at a time, in order, on the coalescer's thread.
+class Coalescer:
+    def __init__(self, flush, window=DEFAULT_WINDOW, count=DEFAULT_BATCH):
+        self.flush = flush
+        self.window = window / 1000
+        self.count = count
+        self.items = []
+        self.first = None
+        self.closed = False
+        self.cv = Condition()
+        self.thread = Thread(target=self.__run, args=(), daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        with self.cv:
+            if not self.items:
+                self.first = time.monotonic()
+            self.items.append(item)
+            self.cv.notify()
+
+    def __next_batch(self):
+        with self.cv:
+            while not self.items and not self.closed:
+                self.cv.wait()
+
+            # give the batch until its window closes to fill up
+            while len(self.items) < self.count and not self.closed:
+                left = self.first + self.window - time.monotonic()
+                if left <= 0:
+                    break
+                self.cv.wait(left)
+
+            batch = self.items[:self.count]
+            self.items = self.items[self.count:]
+            self.first = time.monotonic()
+            return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if not batch:
+                break
+
+            # a connection can go away mid-flush, which costs the batch.
+            # anything else is a bug, and is left to surface.
+            try:
+                self.flush(batch)
+            except OSError as e:
+                util.printts("Coalescer: failed to send a batch of %d: %s" %
+                             (len(batch), e))
+
+    def close(self):
+        """ flush whatever is waiting and stop """
+        with self.cv:
+            self.closed = True
+            self.cv.notify()
+        self.thread.join(FLUSH_TIMEOUT)
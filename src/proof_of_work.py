@@ -1,14 +1,87 @@
+import os
+import copy
+import multiprocessing
+from queue import Empty
+from random import getrandbits
 from . import blockchain, util
 from threading import Thread, Event
 
+# number of nonces a worker process tries before
+# checking whether its template has been replaced
+BATCH_SIZE = 4096
 
+# sent to a worker process in place of a template to make it exit
+STOP = "STOP"
+
+
+def _batch(template, nonce, step, target):
+    # the first nonce of a batch that satisfies the difficulty, if any
+    state = template.state
+    tail = blockchain.HEADER_TAIL.pack
+    difficulty = template.difficulty
+    for _ in range(BATCH_SIZE):
+        h = state.copy()
+        h.update(tail(nonce, difficulty))
+        if h.digest() < target:
+            return nonce
+        nonce += step
+    return None
+
+
+def _latest(templates, job):
+    # skip over any templates that have already been replaced
+    try:
+        while True:
+            job = templates.get_nowait()
+    except Empty:
+        return job
+
+
+def _search(templates, step, target, results):
+    # worker process: mine the latest template from `templates`, trying
+    # nonces start, start + step, start + 2 * step, ... and only looking
+    # for a newer one between batches. a template of None means there is
+    # nothing to mine until the next one.
+    job = _latest(templates, templates.get())
+    while job != STOP:
+        if job is None:
+            job = _latest(templates, templates.get())
+            continue
+
+        ident, template, nonce = job
+        while True:
+            found = _batch(template, nonce, step, target)
+            if found is not None:
+                results.put((ident, found))
+                job = _latest(templates, templates.get())
+                break
+
+            nonce += step * BATCH_SIZE
+            try:
+                job = _latest(templates, templates.get_nowait())
+                break
+            except Empty:
+                pass
+
+
+# a miner that keeps its thread and worker processes for as long as the
+# node is up. whenever the chain or its unconfirmed transactions change,
+# update() has it hand the workers a new template, which they switch to
+# between batches. every template gets an identifier, so that a nonce
+# found for one that has since been replaced can be thrown away.
 class ProofOfWork:
-    def __init__(self, chain, q, difficulty=5):
+    def __init__(self, chain, q, difficulty=5, processes=None):
         self.thread = Thread(target=self.__run, args=(), daemon=False)
         self._stop_event = Event()
+        self._update_event = Event()
         self.chain = chain
         self.q = q
         self.difficulty = difficulty
+        # mine on every core unless told otherwise
+        self.processes = processes or os.cpu_count() or 1
+        # the template being mined, if any, and the number of the last one
+        self.current = None
+        self.templates = 0
         super().__init__()
 
     def stop(self):
@@ -17,24 +90,112 @@ class ProofOfWork:
     def stopped(self):
         return self._stop_event.is_set()
 
+    def update(self):
+        """ mine on whatever the chain now holds """
+        self._update_event.set()
+
+    def __next_template(self):
+        with self.chain.lock:
+            previous = self.chain.blocks[-1].hexdigest()
+            transactions = list(self.chain.unconfirmed)
+        if not transactions:
+            return None
+
+        # transactions that only joined the end of the ones we're
+        # mining are added to the template, rather than starting over
+        current = self.current
+        if current is not None and current["previous"] == previous and \
+           transactions[:len(current["transactions"])] == \
+           current["transactions"]:
+            template = current["template"]
+            timestamp = current["timestamp"]
+            for t in transactions[len(current["transactions"]):]:
+                template.add(t)
+        else:
+            block = blockchain.Block([], previous, None,
+                                     difficulty=self.difficulty)
+            timestamp = block.timestamp
+            template = blockchain.BlockTemplate(block)
+            for t in transactions:
+                template.add(t)
+
+        self.templates += 1
+        return {"ident": self.templates,
+                "previous": previous,
+                "transactions": transactions,
+                "timestamp": timestamp,
+                "template": template,
+                "start": getrandbits(32)}
+
+    def __swap(self, channels):
+        self.current = self.__next_template()
+        if self.current is None:
+            for channel in channels:
+                channel.put(None)
+            return
+
+        # templates are sent in the background, so the workers get a
+        # copy that won't change when transactions are added to ours
+        template = copy.copy(self.current["template"])
+        for i, channel in enumerate(channels):
+            # partition the nonce space: worker i tries every
+            # processes-th nonce, starting at the start plus i
+            channel.put((self.current["ident"], template,
+                         self.current["start"] + i))
+
+    def __block(self, nonce):
+        current = self.current
+        util.printts("Number of rounds to complete pow: %d" %
+                     (nonce - current["start"]))
+        return blockchain.Block(current["transactions"],
+                                current["previous"],
+                                current["timestamp"],
+                                nonce,
+                                self.difficulty)
+
     def __run(self):
-        h = self.chain.blocks[-1].this_hash.hexdigest()
-        unconfirmed_block = blockchain.Block(self.chain.unconfirmed, h, None)
-        # keep incrementing nonce until we "crack"
-        # the hash or the thread gets stopped
-        n = 0
-        while True:
-            if self.stopped():
-                return
+        target = blockchain.difficulty_target(self.difficulty)
 
-            h = unconfirmed_block.this_hash = unconfirmed_block.hash()
-            if int(h.hexdigest()[:self.difficulty], 16) <= 0:
-                break
+        # each worker has its own channel, so they all get every template
+        results = multiprocessing.Queue()
+        channels = [multiprocessing.Queue() for _ in range(self.processes)]
+        workers = []
+        for channel in channels:
+            w = multiprocessing.Process(target=_search,
+                                        args=(channel,
+                                              self.processes,
+                                              target,
+                                              results),
+                                        daemon=True)
+            w.start()
+            workers.append(w)
+
+        self.update()
+        while not self.stopped():
+            if self._update_event.is_set():
+                self._update_event.clear()
+                self.__swap(channels)
+
+            try:
+                ident, nonce = results.get(timeout=0.1)
+            except Empty:
+                continue
+
+            # a nonce for a template we've moved on from is no use
+            if self.current is None or ident != self.current["ident"]:
+                continue
+
+            block = self.__block(nonce)
 
-            unconfirmed_block.nonce += 1
-            n += 1
+            # the workers have nothing to do until the chain changes
+            self.current = None
+            for channel in channels:
+                channel.put(None)
 
-        util.printts("Number of rounds to complete pow: %d" % n)
+            # push the new block onto the synchronized queue
+            self.q.put(block)
 
-        # push the unconfirmed block onto the synchronized queue
-        self.q.put(unconfirmed_block)
+        for channel in channels:
+            channel.put(STOP)
+        for w in workers:
+            w.join()
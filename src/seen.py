@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_SIZE = 100000
+
+
+# remembers up to `size` items (e.g. the transactions and blocks a node
+# has already received) along with an optional value for each. once
+# full, the least recently used items are forgotten first. every item
+# that turns out to be new counts as a miss, and every time one turns
+# up again as a hit.
+class SeenCache:
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key, value=None):
+        """ remember an item; False if it was already known """
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return False
+
+            self.items[key] = value
+            self.misses += 1
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+            return True
+
+    def known(self, key):
+        """ whether an item is known, counting it as a hit if it is """
+        with self.lock:
+            if key not in self.items:
+                return False
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def put(self, key, value):
+        """ remember an item, replacing its value if it was known """
+        with self.lock:
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        """ how many items are remembered, hits and misses """
+        with self.lock:
+            return {"size": len(self.items),
+                    "hits": self.hits,
+                    "misses": self.misses}
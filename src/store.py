@@ -0,0 +1,251 @@
+import os
+import json
+import struct
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# blocks are appended to a segment file as length-prefixed JSON records.
+# an index file holds a fixed-size entry per block, in height order, with
+# the block's hash and where its record is in the segment, so that a
+# store can be reopened by reading the index alone.
+SEGMENT = "blocks.dat"
+INDEX = "blocks.idx"
+CHECKPOINT = "balances.json"
+
+# hash, offset of the record, length of the record
+ENTRY = struct.Struct(">32sQI")
+RECORD_HEADER = struct.Struct(">I")
+
+# appends are only made durable every so often, since fsync is slow.
+# the store syncs after this many appends or this many seconds,
+# whichever comes first, and whenever it is flushed or closed. a chain
+# kept in a store syncs it itself once appends have waited that long.
+DEFAULT_SYNC_EVERY = 16
+DEFAULT_SYNC_INTERVAL = 1
+
+# how many blocks a StoredBlocks keeps loaded
+DEFAULT_CACHE = 256
+
+
+class BlockStore:
+    def __init__(self, path, sync_every=DEFAULT_SYNC_EVERY,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = Lock()
+
+        self.segment = open(os.path.join(path, SEGMENT), "a+b")
+        self.index = open(os.path.join(path, INDEX), "a+b")
+
+        # each block's hash and where its record is,
+        # and the height of each hash
+        self.entries = []
+        self.heights = {}
+        self.__load_index()
+
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.closed = False
+
+    def __load_index(self):
+        self.index.seek(0)
+        data = self.index.read()
+        segment_size = os.fstat(self.segment.fileno()).st_size
+
+        end = 0
+        for pos in range(0, len(data) - ENTRY.size + 1, ENTRY.size):
+            h, offset, length = ENTRY.unpack_from(data, pos)
+            # an entry whose record never made it to disk
+            # means we went down mid-append, so stop there
+            if offset != end or offset + length > segment_size:
+                break
+            self.heights[h.hex()] = len(self.entries)
+            self.entries.append((h.hex(), offset, length))
+            end = offset + length
+
+        # throw away anything past the last complete block
+        self.index.truncate(len(self.entries) * ENTRY.size)
+        self.segment.truncate(end)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def height(self, block_hash):
+        """ the height of the block with the given hash, if we have it """
+        return self.heights.get(block_hash, None)
+
+    def block_id(self, height):
+        """ the hash of the block at a height, without reading the block """
+        return self.entries[height][0]
+
+    def get(self, height):
+        """ the serialized block at a height """
+        with self.lock:
+            block_hash, offset, length = self.entries[height]
+            self.segment.seek(offset + RECORD_HEADER.size)
+            block = json.loads(self.segment.read(length - RECORD_HEADER.size))
+
+        # blocks stored before they carried their hash get the
+        # one from the index, so they needn't be hashed again
+        block.setdefault("hash", block_hash)
+        return block
+
+    def append(self, serialized, block_hash):
+        """ add a block; True if the store was synced as a result """
+        data = json.dumps(serialized).encode('utf-8')
+
+        with self.lock:
+            self.segment.seek(0, os.SEEK_END)
+            offset = self.segment.tell()
+            self.segment.write(RECORD_HEADER.pack(len(data)))
+            self.segment.write(data)
+
+            length = RECORD_HEADER.size + len(data)
+            self.index.write(ENTRY.pack(bytes.fromhex(block_hash),
+                                        offset, length))
+
+            self.heights[block_hash] = len(self.entries)
+            self.entries.append((block_hash, offset, length))
+
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or \
+               time.monotonic() - self.last_sync >= self.sync_interval:
+                self.__sync()
+                return True
+
+        return False
+
+    def truncate(self, height):
+        """ forget every block from `height` onwards """
+        with self.lock:
+            if height >= len(self.entries):
+                return
+
+            for block_hash, _, _ in self.entries[height:]:
+                self.heights.pop(block_hash, None)
+
+            offset = self.entries[height][1]
+            self.entries = self.entries[:height]
+            self.segment.truncate(offset)
+            self.index.truncate(height * ENTRY.size)
+            self.__sync()
+
+            # balances past the new tip no longer apply
+            checkpoint = self.checkpoint()
+            if checkpoint and checkpoint["height"] > height:
+                os.remove(os.path.join(self.path, CHECKPOINT))
+
+    def __sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def sync_due(self):
+        """ seconds until the appends so far are due to be synced """
+        with self.lock:
+            if not self.unsynced:
+                return self.sync_interval
+            return self.last_sync + self.sync_interval - time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.__sync()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.__sync()
+            self.closed = True
+            self.segment.close()
+            self.index.close()
+
+    def checkpoint(self):
+        """ the balances last saved, if any """
+        try:
+            with open(os.path.join(self.path, CHECKPOINT)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_checkpoint(self, height, genesis_credit, balances):
+        # written to the side and moved into place,
+        # so that a crash can't leave half a checkpoint
+        path = os.path.join(self.path, CHECKPOINT)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"height": height,
+                       "genesis_credit": genesis_credit,
+                       "balances": list(balances.items())}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def blocks(self, load, cache=DEFAULT_CACHE):
+        return StoredBlocks(self, load, cache)
+
+
+# the blocks of a store, as a list. a block is only read from disk when
+# it is asked for, and the most recently used ones are kept loaded.
+# `load` turns a serialized block into a block.
+class StoredBlocks:
+    def __init__(self, store, load, cache=DEFAULT_CACHE):
+        self.store = store
+        self.load = load
+        self.cache = OrderedDict()
+        self.cache_size = cache
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(len(self)))]
+
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError(height)
+
+        with self.lock:
+            block = self.cache.get(height, None)
+            if block is not None:
+                self.cache.move_to_end(height)
+                return block
+
+        block = self.load(self.store.get(height))
+        self.__remember(height, block)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def __remember(self, height, block):
+        with self.lock:
+            self.cache[height] = block
+            self.cache.move_to_end(height)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def append(self, block):
+        """ add a block; True if the store was synced as a result """
+        block_hash = block.hexdigest()
+        synced = self.store.append(block.serialize(), block_hash)
+        self.__remember(self.store.height(block_hash), block)
+        return synced
+
+    def pop(self):
+        block = self[-1]
+        height = len(self) - 1
+        with self.lock:
+            self.cache.pop(height, None)
+        self.store.truncate(height)
+        return block
@@ -1,18 +1,97 @@
+import random
 from threading import Thread, Lock
-from . import blockchain, message, peer, util, pkc
+from . import blockchain, message, peer, util, pkc, pipeline, store
 
 INITIAL_BALANCE = 10
 
 
+def select_peers(nodes, links, degree=None):
+    """ the existing nodes that a new node should connect to """
+    if degree is None:
+        return list(nodes.keys())
+
+    # the nodes with the fewest neighbours come first, so that the
+    # number of neighbours stays close to `degree` everywhere
+    idents = list(nodes.keys())
+    random.shuffle(idents)
+    idents.sort(key=lambda ident: len(links.get(ident, ())))
+    return idents[:degree]
+
+
+def link(links, ident, neighbours):
+    # neighbours may have left while the node was joining
+    neighbours = set(n for n in neighbours if n in links and n != ident)
+    links.setdefault(ident, set()).update(neighbours)
+    for n in neighbours:
+        links[n].add(ident)
+
+
+def unlink(links, ident):
+    """ forget a node; returns the nodes it was linked to """
+    neighbours = links.pop(ident, set())
+    for n in neighbours:
+        links.get(n, set()).discard(ident)
+    return neighbours
+
+
+def relink(links, idents, degree=None):
+    """ new links for any of `idents` left with fewer than `degree` """
+    # without a degree, everyone is already linked to everyone else.
+    # each of the nodes is linked to whoever has the fewest neighbours,
+    # until it has enough again or there's nobody left to link it to.
+    pairs = []
+    if degree is None:
+        return pairs
+
+    for ident in idents:
+        while ident in links and len(links[ident]) < degree:
+            candidates = [n for n in links
+                          if n != ident and n not in links[ident]]
+            if not candidates:
+                break
+            random.shuffle(candidates)
+            other = min(candidates, key=lambda n: len(links[n]))
+            link(links, ident, [other])
+            pairs.append((ident, other))
+    return pairs
+
+
+def append_block(chain, ident, block):
+    """ add a block that node `ident` mined to the tracker's chain """
+    # the tracker only ever gets blocks from nodes here, so this is the
+    # only place they are checked against their hash
+    verified = blockchain.Block.deserialize(block)
+    if not verified.verify():
+        util.printts("Tracker: block from node %s doesn't match "
+                     "its hash" % ident)
+    elif not chain.add_block(verified):
+        util.printts("Tracker: block from node %s doesn't follow "
+                     "the newest one" % ident)
+
+
 class Tracker:
-    def __init__(self, port, hostname="localhost"):
+    def __init__(self, port, hostname="localhost", backlog=5,
+                 workers=pipeline.DEFAULT_WORKERS,
+                 depth=pipeline.DEFAULT_DEPTH,
+                 degree=None, data_dir=None):
         self.addr = (hostname, port)
+        self.backlog = backlog
         self.nodes = {}
         self.node_sockets = {}
+        self.node_codecs = {}
+        self.node_sessions = {}
+        # who each node was told to connect to, or was told about.
+        # without a degree, every node is connected to every other.
+        self.links = {}
+        self.degree = degree
         self.ident_count = 1
         self.lock = Lock()
-        self.chain = blockchain.Blockchain.by_tracker(INITIAL_BALANCE)
+        # the chain carries on from the data directory, if there is one
+        self.chain = blockchain.Blockchain.by_tracker(
+            INITIAL_BALANCE, store.BlockStore(data_dir) if data_dir else None)
         self.key_pair = pkc.KeyPair()
+        # decrypts messages from nodes in parallel
+        self.pipeline = pipeline.Pipeline(workers, depth)
 
     def __unlock(self):
         try:
@@ -27,7 +106,7 @@ class Tracker:
         self.socket = util.newsock()
         self.socket.bind(self.addr)
         util.printts("Tracker: bind to %s:%d" % (self.addr[0], self.addr[1]))
-        self.socket.listen(5)
+        self.socket.listen(self.backlog)
         util.printts("Tracker: listen on %s:%d" % (self.addr[0], self.addr[1]))
 
     def accept(self):
@@ -48,12 +127,15 @@ class Tracker:
 
             public_key = pkc.deserialize_public_key(initial.msg["public_key"])
             verify_key = pkc.deserialize_verify_key(initial.msg["verify_key"])
+            codec = message.negotiate_codec(initial.msg.get("features"))
 
             # assign the next available identifier
             ident = self.ident_count
+            salt = pkc.new_salt()
             message.TrackerIdent(ident,
                                  self.key_pair.serialize_public_key(),
-                                 self.key_pair.serialize_verify_key()) \
+                                 self.key_pair.serialize_verify_key(),
+                                 message.FEATURES, salt) \
                    .send(conn)
 
             enc_send = (public_key, self.key_pair)
@@ -65,18 +147,61 @@ class Tracker:
                          "received identifier" %
                          (ident, addr[0], addr[1]))
 
-            # send the most current blockchain
-            message.TrackerChain(self.chain.serialize()).send(conn, enc_send)
-
-            # node must tell us what port they intend to listen on
+            # the node has proven who it is, so switch to a session if we can
+            session = message.negotiate_session(initial.msg.get("features"),
+                                                self.key_pair, public_key,
+                                                salt, reply.msg.get("salt"))
+            if session:
+                enc_send = enc_recv = session
+
+            # a node that syncs only fetches the blocks it is missing,
+            # otherwise send the most current blockchain. nodes may be
+            # adding blocks meanwhile, so what is sent is put together
+            # under the lock, but sent without holding it.
+            features = initial.msg.get("features")
+            if message.supports(features, message.FEATURE_SYNC):
+                with self.lock:
+                    height = len(self.chain.blocks)
+                    common = self.chain.common_height(
+                        reply.msg.get("height", 0),
+                        reply.msg.get("locator", []))
+                    msg = message.TrackerSync(height, common,
+                                              list(self.chain.unconfirmed))
+                msg.send(conn, enc_send, codec)
+                util.printts("Tracker: node %d has %d of %d blocks" %
+                             (ident, common, height))
+            else:
+                with self.lock:
+                    msg = message.TrackerChain(self.chain.serialize())
+                msg.send(conn, enc_send, codec)
+
+            # node must tell us what port they intend to listen on,
+            # once it has all the blocks it asked for
             reply = message.recv(conn, enc_recv)
+            while reply and reply.kind in (message.Kind.SYNC_GET_BLOCKS,
+                                           message.Kind.SYNC_GET_CHAIN):
+                if reply.kind == message.Kind.SYNC_GET_BLOCKS:
+                    with self.lock:
+                        msg = message.sync_blocks(self.chain, reply.msg)
+                    msg.send(conn, enc_send, codec)
+                else:
+                    # a chunk at a time, so as not to hold up the others
+                    chunks = message.stream_chain(self.chain,
+                                                  reply.msg["start"])
+                    while True:
+                        with self.lock:
+                            msg = next(chunks, None)
+                        if msg is None:
+                            break
+                        msg.send(conn, enc_send, codec)
+                reply = message.recv(conn, enc_recv)
             assert(reply and reply.kind == message.Kind.NODE_PORT)
             port = reply.msg["port"]
             util.printts("Tracker: node %d will listen on port %d" %
                          (ident, port))
 
             # tell the node that it must start listening
-            message.NodeListen().send(conn, enc_send)
+            message.NodeListen().send(conn, enc_send, codec)
 
             reply = message.recv(conn, enc_recv)
             assert(reply and reply.kind == message.Kind.NODE_LISTEN)
@@ -84,26 +209,29 @@ class Tracker:
                          (ident, port))
 
             # inform the node of its peers
+            chosen = select_peers(self.nodes, self.links, self.degree)
             peers = []
-            for p in self.nodes.values():
-                peers.append(p.serialize())
-            message.TrackerPeers(peers).send(conn, enc_send)
+            for n in chosen:
+                peers.append(self.nodes[n].serialize())
+            message.TrackerPeers(peers).send(conn, enc_send, codec)
 
             # wait for the node to inform us that it received the peers
             reply = message.recv(conn, enc_recv)
             assert(reply and reply.kind == message.Kind.NODE_PEERS)
             util.printts("Tracker: node %d accepted peers" % ident)
 
-            # inform existing nodes of their new peer
+            # inform the chosen nodes of their new peer
             new_peer = peer.Peer(addr[0], ident, port, public_key, verify_key)
             new_peer_s = new_peer.serialize()
-            for n in self.nodes.values():
+            for n in [self.nodes[c] for c in chosen if c in self.nodes]:
                 nconn = self.node_sockets[n.ident]
-                nenc = (n.public_key, self.key_pair)
-                message.TrackerNewPeer(new_peer_s).send(nconn, nenc)
+                nenc = self.node_sessions[n.ident] or \
+                    (n.public_key, self.key_pair)
+                ncodec = self.node_codecs[n.ident]
+                message.TrackerNewPeer(new_peer_s).send(nconn, nenc, ncodec)
 
             # inform the node that it has been accepted
-            message.TrackerAccept().send(conn, enc_send)
+            message.TrackerAccept().send(conn, enc_send, codec)
 
             self.__lock()
 
@@ -117,6 +245,9 @@ class Tracker:
                                           verify_key)
 
             self.node_sockets[ident] = conn
+            self.node_codecs[ident] = codec
+            self.node_sessions[ident] = session
+            link(self.links, ident, chosen)
             self.ident_count += 1
 
             self.__unlock()
@@ -150,6 +281,11 @@ class Tracker:
         self.socket = None
         self.nodes = {}
         self.node_sockets = {}
+        self.node_codecs = {}
+        self.node_sessions = {}
+        self.links = {}
+        self.pipeline.shutdown()
+        self.chain.close()
 
         self.__unlock()
 
@@ -158,12 +294,14 @@ class Tracker:
 
         conn = self.node_sockets[ident]
         n = self.nodes[ident]
-        enc_recv = (n.verify_key, n.public_key, self.key_pair)
+        enc_recv = self.node_sessions[ident] or \
+            (n.verify_key, n.public_key, self.key_pair)
+        stream = self.pipeline.stream(conn, enc_recv)
         msg = None
 
         while True:
             try:
-                msg = message.recv(conn, enc_recv)
+                msg = stream.recv()
             except Exception:
                 util.printts("Tracker: connection with node %d was broken" %
                              ident)
@@ -179,20 +317,51 @@ class Tracker:
                 break
             elif msg.kind == message.Kind.PEER_BLOCK:
                 util.printts("Tracker: received block from node %s" % ident)
-                self.__append_block(msg.msg["block"])
+                with self.lock:
+                    append_block(self.chain, ident, msg.msg["block"])
+
+        stream.close()
 
     def __remove_node(self, conn, ident):
         self.__lock()
 
         util.closesock(conn)
 
+        pairs = []
         if ident is not None and ident in self.nodes:
             self.nodes.pop(ident, None)
             self.node_sockets.pop(ident, None)
+            self.node_codecs.pop(ident, None)
+            self.node_sessions.pop(ident, None)
+            # its neighbours make up for the link they lost
+            pairs = relink(self.links, unlink(self.links, ident),
+                           self.degree)
 
         self.__unlock()
 
-    def __append_block(self, block):
-        self.chain.add_block(blockchain.Block(block["transactions"],
-                                              block["previous_block_hash"],
-                                              None))
+        for n, other in pairs:
+            self.__introduce(n, other)
+
+    def __announce(self, ident, about, connect=False):
+        # tell a node about another. a node that can't be
+        # reached will be noticed by its receiver.
+        n = self.nodes.get(ident, None)
+        other = self.nodes.get(about, None)
+        if n is None or other is None:
+            return False
+
+        enc = self.node_sessions[ident] or (n.public_key, self.key_pair)
+        try:
+            message.TrackerNewPeer(other.serialize(), connect) \
+                   .send(self.node_sockets[ident], enc,
+                         self.node_codecs[ident])
+        except (KeyError, OSError):
+            return False
+        return True
+
+    def __introduce(self, ident, other):
+        """ have two registered nodes connect, `ident` calling `other` """
+        util.printts("Tracker: linking node %d to node %d" % (ident, other))
+        # the one called hears of it first, so that it knows who's calling
+        if self.__announce(other, ident):
+            self.__announce(ident, other, connect=True)
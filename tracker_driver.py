@@ -3,8 +3,9 @@
 import signal
 import sys
 import cmd
+import argparse
 from threading import Thread
-from src import tracker, util
+from src import tracker, async_tracker, pipeline, util, ledger
 
 # global tracker object
 t = None
@@ -46,19 +47,65 @@ class TrackerShell(cmd.Cmd):
         "Show chain"
         print(t.chain.serialize())
 
+    def do_balances(self, line):
+        "Display the balance of every account, worked out from the chain"
+        credit, balances = ledger.balances(t.chain.blocks)
+        for ident in sorted(balances):
+            print("%d: %d" % (ident, balances[ident]))
+        print("any other account: %d" % credit)
+
     def emptyline(self):
         pass
 
 
 def main():
-    port = int(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=int)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run join handshakes concurrently on a "
+                             "single event loop")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help="listen backlog for incoming connections")
+    parser.add_argument("--max-joins", type=int,
+                        default=async_tracker.DEFAULT_MAX_JOINS,
+                        help="handshakes that may run at once (--async)")
+    parser.add_argument("--timeout", type=float,
+                        default=async_tracker.DEFAULT_TIMEOUT,
+                        help="seconds allowed per handshake step (--async)")
+    parser.add_argument("--workers", type=int,
+                        default=pipeline.DEFAULT_WORKERS,
+                        help="threads decrypting messages from nodes")
+    parser.add_argument("--queue-depth", type=int,
+                        default=pipeline.DEFAULT_DEPTH,
+                        help="messages from a node that may wait to be "
+                             "decrypted")
+    parser.add_argument("--degree", type=int, default=None,
+                        help="peers to give each new node, rather than "
+                             "every other node")
+    parser.add_argument("--data-dir", default=None,
+                        help="directory to keep the chain in between runs")
+    args = parser.parse_args()
+
+    port = args.port
     if util.is_port_in_use(port):
         util.printts("Tracker: port %d is already in use" % port)
         sys.exit(1)
 
     # create the tracker
     global t
-    t = tracker.Tracker(port)
+    if args.use_async:
+        t = async_tracker.AsyncTracker(
+            port,
+            backlog=args.backlog or async_tracker.DEFAULT_BACKLOG,
+            max_joins=args.max_joins,
+            timeout=args.timeout,
+            degree=args.degree,
+            data_dir=args.data_dir)
+    else:
+        t = tracker.Tracker(port, backlog=args.backlog or 5,
+                            workers=args.workers, depth=args.queue_depth,
+                            degree=args.degree,
+                            data_dir=args.data_dir)
 
     try:
         t.start()
@@ -72,8 +119,10 @@ def main():
         thread.start()
         return thread
 
-    # this is our only thread which will run forever
-    new_thread(accepter)
+    # this is our only thread which will run forever.
+    # the asynchronous tracker accepts nodes on its own event loop.
+    if not args.use_async:
+        new_thread(accepter)
 
     TrackerShell().cmdloop()
 